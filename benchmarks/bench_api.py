@@ -0,0 +1,246 @@
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection
+from threading import Thread, local
+from time import perf_counter
+from urllib.parse import urlsplit
+from uuid import uuid4
+import argparse
+import base64
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cf-service-broker'))
+
+import api
+import broker
+import executor
+import opstore
+import service
+from bench_service import BenchService, SERVICE_GUID, SYNC_PLAN_GUID, ASYNC_PLAN_GUID
+HEADERS = {'X-Broker-Api-Version': '2.7',
+           'Content-Type': 'application/json',
+           'Authorization': 'Basic ' + base64.b64encode(b"u:p").decode("ascii")}
+
+
+def make_broker(args):
+    BenchService.latency = args.latency
+    plans = [service.Plan(guid=SYNC_PLAN_GUID, name="sync", description="sync plan"),
+             service.Plan(guid=ASYNC_PLAN_GUID, name="async", description="async plan",
+                          provisionable_synchronously=False)]
+    plans += [service.Plan(guid="bench-plan-%d" % i, name="plan %d" % i, description="catalog padding")
+              for i in range(args.extra_plans)]
+    bench_service = BenchService(guid=SERVICE_GUID, name="bench", description="benchmark service", bindable=True,
+                                 plans={p.guid: p for p in plans})
+    # BROKER_OPERATIONS_DB applies, to compare with a broker started with serve.py, which needs it for several workers
+    return broker.Broker(service_list=[bench_service], operations=opstore.operations_from_environment(),
+                         executor=executor.BrokerExecutor(max_workers=args.workers, max_pending=args.max_pending,
+                                                          use_processes=not args.threads))
+
+
+class TestClientTransport:
+    def __init__(self):
+        self._local = local()
+
+    def request(self, method, path, body=None):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = api.app.test_client()
+        resp = client.open(path, method=method, headers=HEADERS, data=body)
+        return resp.status_code, resp.data
+
+
+class HTTPTransport:
+    # A real threaded WSGI server on localhost, or with url an already running broker, with one keep-alive
+    # connection per client thread
+    def __init__(self, url=None):
+        self.server = None
+        if url is None:
+            from werkzeug.serving import make_server
+            self.server = make_server('127.0.0.1', 0, api.app, threaded=True)
+            logging.getLogger('werkzeug').setLevel(logging.WARNING)
+            self.host, self.port = '127.0.0.1', self.server.server_port
+            Thread(target=self.server.serve_forever, daemon=True).start()
+        else:
+            parts = urlsplit(url)
+            self.host, self.port = parts.hostname, parts.port or 80
+        self._local = local()
+
+    def request(self, method, path, body=None):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = HTTPConnection(self.host, self.port)
+        conn.request(method, path, body=body, headers=HEADERS)
+        resp = conn.getresponse()
+        return resp.status, resp.read()
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+
+
+def create_body(plan_id, accepts_incomplete=False):
+    return json.dumps({"organization_guid": "org", "space_guid": "space", "service_id": SERVICE_GUID,
+                       "plan_id": plan_id, "accepts_incomplete": accepts_incomplete})
+
+
+def scenario_catalog(transport):
+    return [transport.request('GET', '/v2/catalog')]
+
+
+def scenario_sync_provision(transport):
+    return [transport.request('PUT', '/v2/service_instances/' + str(uuid4()), create_body(SYNC_PLAN_GUID))]
+
+
+def scenario_async_provision(transport):
+    return [transport.request('PUT', '/v2/service_instances/' + str(uuid4()), create_body(ASYNC_PLAN_GUID, True))]
+
+
+def scenario_bind_unbind(transport):
+    path = '/v2/service_instances/%s/service_bindings/%s' % (uuid4(), uuid4())
+    body = json.dumps({"service_id": SERVICE_GUID, "plan_id": SYNC_PLAN_GUID, "app_guid": "app"})
+    return [transport.request('PUT', path, body),
+            transport.request('DELETE', path + '?service_id=%s&plan_id=%s' % (SERVICE_GUID, SYNC_PLAN_GUID))]
+
+
+polled_instances = []
+
+
+def scenario_last_operation(transport):
+    if not polled_instances:
+        for _ in range(16):
+            instance_id = str(uuid4())
+            transport.request('PUT', '/v2/service_instances/' + instance_id, create_body(ASYNC_PLAN_GUID, True))
+            polled_instances.append(instance_id)
+    instance_id = polled_instances[int(perf_counter() * 1e6) % len(polled_instances)]
+    return [transport.request('GET', '/v2/service_instances/%s/last_operation' % instance_id)]
+
+
+SCENARIOS = {
+    'catalog': scenario_catalog,
+    'sync_provision': scenario_sync_provision,
+    'async_provision': scenario_async_provision,
+    'bind_unbind': scenario_bind_unbind,
+    'last_operation': scenario_last_operation,
+}
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))]
+
+
+def run_scenario(transport, func, concurrency, requests):
+    func(transport)  # warm up caches, connections and executor workers
+    latencies = []
+    errors = 0
+
+    def one(_):
+        start = perf_counter()
+        responses = func(transport)
+        return perf_counter() - start, sum(1 for status, _ in responses if status >= 500 or status == 429)
+
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for latency, failed in pool.map(one, range(requests)):
+            latencies.append(latency)
+            errors += failed
+    elapsed = perf_counter() - start
+    latencies.sort()
+    return {"requests": requests,
+            "errors": errors,
+            "rps": requests / elapsed,
+            "mean_ms": statistics.mean(latencies) * 1000,
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p95_ms": percentile(latencies, 95) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline_path, current_path, threshold):
+    with open(baseline_path) as f:
+        baseline = {(r['scenario'], r['concurrency']): r for r in json.load(f)['results']}
+    with open(current_path) as f:
+        current = json.load(f)['results']
+    regressed = False
+    print("%-16s %5s %12s %12s %8s" % ("scenario", "conc", "base p95 ms", "p95 ms", "change"))
+    for r in current:
+        base = baseline.get((r['scenario'], r['concurrency']))
+        if base is None:
+            continue
+        change = (r['p95_ms'] - base['p95_ms']) / base['p95_ms'] if base['p95_ms'] else 0.0
+        flag = ""
+        if change > threshold:
+            regressed = True
+            flag = "  REGRESSION"
+        print("%-16s %5d %12.2f %12.2f %+7.1f%%%s" % (r['scenario'], r['concurrency'], base['p95_ms'], r['p95_ms'],
+                                                    change * 100, flag))
+    return 1 if regressed else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure latency and throughput of the broker API")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help="comma separated, from: %(default)s")
+    parser.add_argument('--concurrency', default='1,8,32', help="comma separated client thread counts")
+    parser.add_argument('--requests', type=int, default=500, help="requests per scenario and concurrency level")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds each service call sleeps")
+    parser.add_argument('--extra-plans', type=int, default=0, help="additional plans to pad the catalog with")
+    parser.add_argument('--workers', type=int, default=4, help="broker executor workers")
+    parser.add_argument('--max-pending', type=int, default=1024, help="broker executor queue bound")
+    parser.add_argument('--threads', action='store_true', help="use a thread pool executor instead of processes")
+    parser.add_argument('--http', action='store_true', help="drive a real WSGI server instead of the test client")
+    parser.add_argument('--url', help="drive a broker already serving bench_services.json at this URL, e.g. one "
+                                      "started with serve.py; --latency and the executor options don't apply")
+    parser.add_argument('--output', help="write results as JSON to this file")
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CURRENT'),
+                        help="compare two result files and exit non-zero on p95 regressions")
+    parser.add_argument('--threshold', type=float, default=0.10, help="p95 regression threshold for --compare")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        return compare(args.compare[0], args.compare[1], args.threshold)
+
+    api.app.logger.disabled = True
+    logging.getLogger().setLevel(logging.WARNING)
+    if not args.url:
+        api.broker = make_broker(args)
+    transport = HTTPTransport(args.url) if args.http or args.url else TestClientTransport()
+    results = []
+    try:
+        for name in args.scenarios.split(','):
+            for concurrency in [int(c) for c in args.concurrency.split(',')]:
+                r = run_scenario(transport, SCENARIOS[name], concurrency, args.requests)
+                r.update(scenario=name, concurrency=concurrency)
+                results.append(r)
+                print("%-16s conc=%-4d rps=%9.1f p50=%8.2fms p95=%8.2fms p99=%8.2fms errors=%d" %
+                      (name, concurrency, r['rps'], r['p50_ms'], r['p95_ms'], r['p99_ms'], r['errors']))
+    finally:
+        if args.http or args.url:
+            transport.close()
+        if not args.url:
+            api.broker.shutdown()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"revision": git_revision(),
+                       "python": platform.python_version(),
+                       "platform": platform.platform(),
+                       "settings": {k: v for k, v in vars(args).items() if k not in ('output', 'compare')},
+                       "results": results}, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,34 @@
+from time import sleep
+import os
+import service
+
+# Catalog metadata for serving BenchService from a separate broker process, see bench_services.json
+SERVICE_GUID = 'bench-service'
+SYNC_PLAN_GUID = 'bench-sync-plan'
+ASYNC_PLAN_GUID = 'bench-async-plan'
+
+
+class BenchService(service.BaseService):
+    # Does nothing but sleep for latency seconds, so the numbers measure the broker rather than a backend.
+    # BENCH_LATENCY sets it in brokers started for --url.
+    latency = float(os.environ.get('BENCH_LATENCY', 0))
+
+    def _wait(self):
+        if self.latency:
+            sleep(self.latency)
+
+    def create_instance(self, instance_id, plan_id, parameters, organization_guid, space_guid):
+        self._wait()
+
+    def delete_instance(self, instance_id):
+        self._wait()
+
+    def modify_instance(self, instance_id, plan_id, parameters, previous_values):
+        self._wait()
+
+    def bind(self, instance_id, binding_id, plan_id, app_guid, parameters):
+        self._wait()
+        return {"binding": binding_id}
+
+    def unbind(self, instance_id, binding_id, plan_id):
+        self._wait()
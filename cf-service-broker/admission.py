@@ -0,0 +1,175 @@
+from threading import Lock
+from time import monotonic
+from typing import Dict
+from exceptions import RateLimitedError
+from executor import URGENT, NORMAL
+import json
+import math
+import os
+import logging
+
+logging.basicConfig(level=logging.DEBUG)
+log = logging.getLogger()
+
+# Cleanup must still get through when a backend is being flooded with provisions
+PRIORITIES = {'delete': URGENT, 'unbind': URGENT, 'create': NORMAL, 'modify': NORMAL, 'bind': NORMAL}
+
+
+def priority_of(operation: str) -> int:
+    return PRIORITIES.get(operation, NORMAL)
+
+
+class Limit:
+    # rate is operations per second refilling a bucket of burst tokens; max_concurrency caps operations in flight,
+    # of which reserve are kept back for deletes and unbinds.  Deletes and unbinds are not rate limited.
+    __slots__ = ('rate', 'burst', 'max_concurrency', 'reserve')
+
+    def __init__(self, rate: float=None, burst: float=None, max_concurrency: int=None, reserve: int=0):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate or 0)
+        self.max_concurrency = max_concurrency
+        self.reserve = reserve
+
+    @classmethod
+    def from_dict(cls, d: dict) -> 'Limit':
+        return cls(**{k: d[k] for k in cls.__slots__ if k in d})
+
+
+class _Counter:
+    __slots__ = ('limit', 'tokens', 'stamp', 'in_flight')
+
+    def __init__(self, limit: Limit, now: float):
+        self.limit = limit
+        self.tokens = limit.burst
+        self.stamp = now
+        self.in_flight = 0
+
+    def wait(self, now: float, priority: int) -> float:
+        # Seconds until this operation could be admitted, 0 if it can be now.  None means "when something finishes".
+        limit = self.limit
+        if limit.max_concurrency is not None:
+            allowed = limit.max_concurrency if priority == URGENT else limit.max_concurrency - limit.reserve
+            if self.in_flight >= allowed:
+                return None
+        if limit.rate is None or priority == URGENT:
+            return 0
+        self.refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / limit.rate
+
+    def refill(self, now: float):
+        if self.limit.rate is not None:
+            self.tokens = min(self.limit.burst, self.tokens + (now - self.stamp) * self.limit.rate)
+        self.stamp = now
+
+    def take(self, priority: int):
+        self.in_flight += 1
+        if self.limit.rate is not None and priority != URGENT:
+            self.tokens -= 1
+
+    @property
+    def idle(self) -> bool:
+        return self.in_flight == 0 and self.tokens >= self.limit.burst
+
+
+class Admission:
+    __slots__ = ('_controller', '_counters')
+
+    def __init__(self, controller: 'AdmissionController', counters: tuple):
+        self._controller = controller
+        self._counters = counters
+
+    def release(self, *args):
+        # Safe to call more than once, and usable directly as a future's done callback
+        counters, self._counters = self._counters, ()
+        if counters:
+            self._controller._release(counters)
+
+
+class AdmissionController:
+    # Checked by the broker before it submits work: token bucket rate limits and concurrency caps per service guid,
+    # per plan guid and per organization guid.  organization_limit applies to each organization separately, unless
+    # organization_limits has an entry for it.  Requests over a limit fail fast with RateLimitedError.
+    def __init__(self, service_limits: Dict[str, Limit]=None, plan_limits: Dict[str, Limit]=None,
+                 organization_limits: Dict[str, Limit]=None, organization_limit: Limit=None,
+                 retry_after: float=1, max_counters: int=10000):
+        self.service_limits = service_limits or {}
+        self.plan_limits = plan_limits or {}
+        self.organization_limits = organization_limits or {}
+        self.organization_limit = organization_limit
+        # Suggested wait when a concurrency cap is hit, since there is no telling when something will finish
+        self.retry_after = retry_after
+        self.max_counters = max_counters
+        self.rejected = 0
+        self._counters = {}
+        self._lock = Lock()
+        self._unlimited = Admission(self, ())
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.service_limits or self.plan_limits or self.organization_limits or self.organization_limit)
+
+    def admit(self, operation: str, service_id: str, plan_id: str, organization_guid: str=None) -> Admission:
+        if not self.enabled:
+            return self._unlimited
+        priority = priority_of(operation)
+        with self._lock:
+            now = monotonic()
+            counters = [c for c in (self._counter(('service', service_id), self.service_limits.get(service_id), now),
+                                    self._counter(('plan', plan_id), self.plan_limits.get(plan_id), now),
+                                    self._counter(('organization', organization_guid),
+                                                  self.organization_limits.get(organization_guid,
+                                                                               self.organization_limit)
+                                                  if organization_guid else None, now))
+                        if c is not None]
+            # All or nothing, so a request refused by one limit doesn't use up the others
+            waits = [c.wait(now, priority) for c in counters]
+            if any(w != 0 for w in waits):
+                self.rejected += 1
+                raise RateLimitedError(max(self.retry_after if w is None else w for w in waits if w != 0))
+            for c in counters:
+                c.take(priority)
+        return Admission(self, tuple(counters))
+
+    def _counter(self, key: tuple, limit: Limit, now: float) -> _Counter:
+        if limit is None:
+            return None
+        counter = self._counters.get(key)
+        if counter is None:
+            if len(self._counters) >= self.max_counters:
+                self._sweep(now)
+            counter = self._counters[key] = _Counter(limit, now)
+        return counter
+
+    def _sweep(self, now: float):
+        # Drops counters that are back to their initial state, so one per organization ever seen isn't kept forever
+        for key, counter in list(self._counters.items()):
+            counter.refill(now)
+            if counter.idle:
+                del self._counters[key]
+
+    def _release(self, counters: tuple):
+        with self._lock:
+            for c in counters:
+                c.in_flight -= 1
+
+
+def retry_after_header(e: RateLimitedError) -> str:
+    return str(max(1, math.ceil(e.retry_after)))
+
+
+def admission_from_environment() -> AdmissionController:
+    # BROKER_LIMITS_CONFIG names a JSON file like
+    # {"services": {"<guid>": {"rate": 5, "burst": 10, "max_concurrency": 20, "reserve": 2}},
+    #  "plans": {"<guid>": {...}}, "organizations": {"<guid>": {...}}, "organization": {...}, "retry_after": 1}
+    path = os.environ.get('BROKER_LIMITS_CONFIG')
+    if not path:
+        return AdmissionController()
+    with open(path) as f:
+        config = json.load(f)
+    log.info("loaded admission limits from %s", path)
+    return AdmissionController(
+        service_limits={k: Limit.from_dict(v) for k, v in config.get('services', {}).items()},
+        plan_limits={k: Limit.from_dict(v) for k, v in config.get('plans', {}).items()},
+        organization_limits={k: Limit.from_dict(v) for k, v in config.get('organizations', {}).items()},
+        organization_limit=Limit.from_dict(config['organization']) if 'organization' in config else None,
+        retry_after=config.get('retry_after', 1))
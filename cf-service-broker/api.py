@@ -1,24 +1,144 @@
-from flask import Flask, request
-from utils import check_api_version, basic_auth, json_data_in, json_response
+from flask import Flask, Response, request, g, make_response, got_request_exception
+from time import monotonic, perf_counter, sleep
+from utils import check_api_version, authenticated, json_data_in, json_response, etag_response, error_response, \
+    rate_limited_response, validated
+from admission import admission_from_environment
+from inventory import inventory_from_environment
+from journal import journal_from_environment
+from executor import executor_from_environment
+from opstore import operations_from_environment
+from auth import authenticator_from_environment
 from broker import Broker
+from profiling import SORT_KEYS, profiler_from_environment
+from progress import SSE_KEEPALIVE, sse_message
+from reconcile import reconciler_from_environment
+from registry import services_from_environment
+from schema import BATCH_CREATE, BATCH_DELETE, BATCH_LAST_OPERATION, BIND, PROVISION, UPDATE, validate
+from workqueue import work_queue_from_environment
 from exceptions import *
+import atexit
+import gzip
 import logging
+import metrics
+import os
 
 logging.basicConfig(level=logging.DEBUG)
 log = logging.getLogger()
 
 app = Flask(__name__)
+app.config.setdefault('BROKER_GZIP_CATALOG', True)
+app.config.setdefault('BROKER_MAX_BATCH_SIZE', 500)
+app.config.setdefault('BROKER_PROGRESS_POLL_INTERVAL', 0.5)
+app.config.setdefault('BROKER_PROGRESS_KEEPALIVE', 15)
+# JSON responses at least this many bytes long are gzipped for clients that accept it; 0 turns that off
+app.config.setdefault('BROKER_GZIP_MIN_SIZE', int(os.environ.get('BROKER_GZIP_MIN_SIZE', 1024)))
 
 api_version = check_api_version(2.7)
-broker_auth = basic_auth('u', 'p')
-broker = Broker()
+broker_auth = authenticated(authenticator_from_environment(default={'u': 'p'}))
+broker = Broker(service_list=services_from_environment(), admission=admission_from_environment(),
+                journal=journal_from_environment(), operations=operations_from_environment(),
+                work_queue=work_queue_from_environment(), inventory=inventory_from_environment(),
+                profiler=profiler_from_environment(), executor=executor_from_environment())
+broker.recover()
+reconciler = reconciler_from_environment(broker)
+atexit.register(lambda: broker.shutdown(wait=False))
+atexit.register(reconciler.stop)
+
+metrics.registry.register(metrics.Gauge('broker_executor_pending', 'Service operations queued or running on the executor',
+                                        lambda: broker.executor.pending))
+metrics.registry.register(metrics.Gauge('broker_executor_stuck', 'Executor workers held by timed out operations',
+                                        lambda: len(broker.executor.stuck)))
+metrics.registry.register(metrics.Gauge('broker_async_operations', 'Async operations in the operation store by state',
+                                        lambda: broker.operations.count_by_state(), ('state',)))
+
+
+@app.before_request
+def start_timer():
+    g.request_started = perf_counter()
+
+
+@app.after_request
+def record_request_duration(response):
+    started = g.get('request_started')
+    if started is not None:
+        rule = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.http_request_duration.observe(perf_counter() - started, rule, request.method, response.status_code)
+    return response
+
+
+@app.after_request
+def compress_response(response):
+    # Big batch results and the like; the catalog is gzipped once up front and already has its Content-Encoding
+    min_size = app.config['BROKER_GZIP_MIN_SIZE']
+    if (not min_size or response.is_streamed or response.mimetype != 'application/json' or
+            'Content-Encoding' in response.headers or 'ETag' in response.headers or
+            not request.accept_encodings['gzip']):
+        return response
+    body = response.get_data()
+    if len(body) >= min_size:
+        response.set_data(gzip.compress(body, compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+        response.vary.add('Accept-Encoding')
+    return response
+
+
+def count_unhandled_exception(sender, exception, **extra):
+    metrics.errors.inc(exception.__class__.__name__)
+
+
+got_request_exception.connect(count_unhandled_exception, app)
+
+
+@app.route('/metrics', methods=('GET',))
+def get_metrics():
+    return make_response((metrics.registry.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'}))
+
+
+@app.route('/admin/profiles', methods=('GET',))
+@broker_auth
+def get_profiles():
+    if broker.profiler is None:
+        return json_response({"description": "profiling is not enabled"}, 404)
+    return json_response({"profiles": broker.profiler.summary()}, 200)
+
+
+@app.route('/admin/profiles/<service_id>/<plan_id>/<operation>', methods=('GET',))
+@broker_auth
+def get_profile(service_id, plan_id, operation):
+    sort = request.args.get('sort', 'cumulative')
+    if sort not in SORT_KEYS:
+        return json_response({"description": "sort must be one of " + ", ".join(SORT_KEYS)}, 400)
+    report = broker.profiler.report((service_id, plan_id, operation), sort, request.args.get('limit', 30, type=int)) \
+        if broker.profiler is not None else None
+    if report is None:
+        return json_response({}, 404)
+    return make_response((report, 200, {'Content-Type': 'text/plain'}))
+
+
+@app.route('/admin/profiles/dump', methods=('POST',))
+@broker_auth
+def post_profiles_dump():
+    if broker.profiler is None or not broker.profiler.dump_dir:
+        return json_response({"description": "profiling is not enabled or BROKER_PROFILE_DIR is not set"}, 409)
+    return json_response({"files": broker.profiler.dump()}, 200)
+
+
+@app.route('/admin/profiles', methods=('DELETE',))
+@broker_auth
+def delete_profiles():
+    if broker.profiler is not None:
+        broker.profiler.reset()
+    return json_response({}, 200)
 
 
 @app.route('/v2/catalog', methods=('GET',))
 @api_version
 @broker_auth
 def get_catalog():
-    return json_response(broker.service_catalog(), 200)
+    catalog = broker.serialized_catalog()
+    if app.config['BROKER_GZIP_CATALOG'] and request.accept_encodings['gzip']:
+        return etag_response(catalog.gzip_body, catalog.gzip_etag, content_encoding='gzip')
+    return etag_response(catalog.body, catalog.etag)
 
 
 @app.route('/v2/service_instances/<instance_id>/last_operation', methods=('GET',))
@@ -26,24 +146,70 @@ def get_catalog():
 @broker_auth
 def get_last_operation(instance_id):
     try:
-        return json_response({"state": broker.get_provisioning_state(instance_id)}, 202)
+        return json_response(broker.get_operation(instance_id).as_dict(), 202)
+    except NoSuchEntityError as e:
+        return error_response(e, 410)
     except AsyncOperationStateNotHandledError:
         return json_response({"error": "The async operation was not in a state the broker could understand"}, 500)
 
 
+@app.route('/v2/service_instances/<instance_id>/last_operation/stream', methods=('GET',))
+@api_version
+@broker_auth
+def get_last_operation_stream(instance_id):
+    # Server-Sent Events: one message per change to the operation, ending with the one that finishes it.  The store is
+    # polled rather than subscribed to, so this also works when another process is running the operation.
+    try:
+        op = broker.get_operation(instance_id)
+    except NoSuchEntityError as e:
+        return error_response(e, 410)
+    interval = app.config['BROKER_PROGRESS_POLL_INTERVAL']
+    keepalive = app.config['BROKER_PROGRESS_KEEPALIVE']
+
+    def events(op):
+        last, last_sent = None, monotonic()
+        while op is not None:
+            event = op.as_event()
+            if event != last:
+                yield sse_message(event)
+                last, last_sent = event, monotonic()
+            elif monotonic() - last_sent >= keepalive:
+                yield SSE_KEEPALIVE
+                last_sent = monotonic()
+            if op.finished:
+                return
+            sleep(interval)
+            op = broker.operations.get(instance_id)
+    return Response(events(op), 200, {'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache',
+                                      'X-Accel-Buffering': 'no'})
+
+
 @app.route('/v2/service_instances/<instance_id>', methods=('PUT',))
 @api_version
 @broker_auth
 @json_data_in
+@validated(PROVISION)
 def put_create_instance(data, instance_id):
     try:
         broker.create_instance(instance_id=instance_id, **data)
     except ProvisioningAsynchronously:
         return json_response({}, 202)
     except CannotProvisionSynchronouslyError as e:
-        return json_response(e.msg, 422)
-    except ServiceConflictError:
-        return json_response({}, 409)
+        return error_response(e, 422)
+    except (UnknownServiceError, UnknownPlanError) as e:
+        return error_response(e, 400)
+    except (BrokerBusyError, OperationCancelledError) as e:
+        return error_response(e, 503)
+    except OperationTimeoutError as e:
+        return error_response(e, 504)
+    except ServiceBusyError as e:
+        return error_response(e, 429)
+    except RateLimitedError as e:
+        return rate_limited_response(e)
+    except ServiceConflictError as e:
+        return error_response(e, 409)
+    except IdenticalRequestCompleted as e:
+        return json_response(e.msg, 200)
     else:
         return json_response({}, 201)
 
@@ -63,9 +229,19 @@ def delete_delete_instance(instance_id):
     except ProvisioningAsynchronously:
         return json_response({}, 202)
     except CannotProvisionSynchronouslyError as e:
-        return json_response(e.msg, 422)
-    except NoSuchEntityError:
-        return json_response({}, 410)
+        return error_response(e, 422)
+    except (UnknownServiceError, UnknownPlanError) as e:
+        return error_response(e, 400)
+    except (BrokerBusyError, OperationCancelledError) as e:
+        return error_response(e, 503)
+    except OperationTimeoutError as e:
+        return error_response(e, 504)
+    except ServiceBusyError as e:
+        return error_response(e, 429)
+    except RateLimitedError as e:
+        return rate_limited_response(e)
+    except NoSuchEntityError as e:
+        return error_response(e, 410)
     else:
         return json_response({}, 200)
 
@@ -74,6 +250,7 @@ def delete_delete_instance(instance_id):
 @api_version
 @broker_auth
 @json_data_in
+@validated(UPDATE)
 def patch_modify_instance(data, instance_id):
     try:
         broker.modify_instance(instance_id=instance_id, **data)
@@ -82,11 +259,24 @@ def patch_modify_instance(data, instance_id):
     except ProvisioningAsynchronously:
         return json_response({}, 202)
     except CannotProvisionSynchronouslyError as e:
-        return json_response(e.msg, 422)
+        return error_response(e, 422)
+    except (UnknownServiceError, UnknownPlanError) as e:
+        return error_response(e, 400)
+    except (BrokerBusyError, OperationCancelledError) as e:
+        return error_response(e, 503)
+    except OperationTimeoutError as e:
+        return error_response(e, 504)
+    except ServiceBusyError as e:
+        return error_response(e, 429)
+    except RateLimitedError as e:
+        return rate_limited_response(e)
     except UnsupportedPlanChangeError as e:
-        return json_response(e.msg, 422)
+        return error_response(e, 422)
     except CurrentlyNotPossiblePlanChangeError as e:
-        return json_response(e.msg, 422)
+        return error_response(e, 422)
+    except IdenticalRequestCompleted as e:
+        # Nothing to change
+        return json_response(e.msg, 200)
     else:
         return json_response({}, 201)
 
@@ -95,15 +285,20 @@ def patch_modify_instance(data, instance_id):
 @api_version
 @broker_auth
 @json_data_in
+@validated(BIND)
 def put_bind(data, instance_id, binding_id):
     try:
         credentials = broker.bind_instance(instance_id=instance_id, binding_id=binding_id, **data)
-    except BindingNotSupportedError as e:
-        return json_response(e.msg, 400)
+    except (UnknownServiceError, UnknownPlanError, BindingNotSupportedError) as e:
+        return error_response(e, 400)
     except BindingExistsError as e:
-        return json_response(e.msg, 409)
+        return error_response(e, 409)
     except AppGUIDRequiredError as e:
-        return json_response(e.msg, 422)
+        return error_response(e, 422)
+    except RateLimitedError as e:
+        return rate_limited_response(e)
+    except IdenticalRequestCompleted as e:
+        return json_response({"credentials": e.msg}, 200)
     else:
         return json_response({"credentials": credentials}, 201)
 
@@ -119,10 +314,98 @@ def delete_unbind(instance_id, binding_id):
         return json_response({"description": "either service_id or plan_id missing from request query params"}, 400)
     try:
         broker.unbind_instance(instance_id=instance_id, binding_id=binding_id, service_id=service_id, plan_id=plan_id)
-    except NoSuchEntityError:
-        return json_response({}, 410)
+    except (UnknownServiceError, UnknownPlanError) as e:
+        return error_response(e, 400)
+    except RateLimitedError as e:
+        return rate_limited_response(e)
+    except NoSuchEntityError as e:
+        return error_response(e, 410)
     else:
         return json_response({}, 200)
 
+# Status codes for batch items, matching what the single-item routes above return for the same exceptions
+BATCH_ERROR_STATUS = {
+    ProvisioningAsynchronously: 202,
+    IdenticalRequestCompleted: 200,
+    CannotProvisionSynchronouslyError: 422,
+    BrokerBusyError: 503,
+    OperationCancelledError: 503,
+    OperationTimeoutError: 504,
+    ServiceBusyError: 429,
+    RateLimitedError: 429,
+    ServiceConflictError: 409,
+    NoSuchEntityError: 410,
+    UnknownServiceError: 400,
+    UnknownPlanError: 400,
+    InvalidRequestError: 400,
+}
+
+
+def batch_item(instance_id, result, success_code):
+    if not isinstance(result, Exception):
+        return {"instance_id": instance_id, "status": success_code, "body": result}
+    status = BATCH_ERROR_STATUS.get(type(result), 500)
+    if status == 500:
+        # Items are validated against the schema first, so anything else is a bug rather than a bad request
+        log.error("batch operation on instance %s failed: %r", instance_id, result)
+    body = result.msg if hasattr(result, 'msg') else {}
+    return {"instance_id": instance_id, "status": status, "body": body}
+
+
+@app.route('/v2/batch/service_instances', methods=('POST',))
+@api_version
+@broker_auth
+@json_data_in
+def post_batch_service_instances(data):
+    items = data.get('operations')
+    if not isinstance(items, list):
+        return json_response({"description": "operations list missing from request body"}, 400)
+    if len(items) > app.config['BROKER_MAX_BATCH_SIZE']:
+        return json_response({"description": "at most %d operations per batch" % app.config['BROKER_MAX_BATCH_SIZE']},
+                             413)
+    results = [None] * len(items)
+    batches = {'create': [], 'delete': []}
+    schemas = {'create': BATCH_CREATE, 'delete': BATCH_DELETE}
+    for position, item in enumerate(items):
+        item = dict(item) if isinstance(item, dict) else {}
+        action = item.pop('action', None)
+        if action not in batches:
+            results[position] = {"instance_id": item.get('instance_id'), "status": 400,
+                                 "body": {"description": "action must be one of create, delete"}}
+            continue
+        try:
+            batches[action].append((position, validate(schemas[action], item)))
+        except InvalidRequestError as e:
+            results[position] = batch_item(item.get('instance_id'), e, 400)
+    for action, run, success_code in (('create', broker.create_instances, 201),
+                                      ('delete', broker.delete_instances, 200)):
+        batch = batches[action]
+        for (position, item), result in zip(batch, run([item for _, item in batch])):
+            results[position] = batch_item(item.get('instance_id'), result, success_code)
+    return json_response({"results": results}, 200)
+
+
+@app.route('/v2/batch/last_operation', methods=('POST',))
+@api_version
+@broker_auth
+@json_data_in
+@validated(BATCH_LAST_OPERATION)
+def post_batch_last_operation(data):
+    instance_ids = data['instance_ids']
+    if len(instance_ids) > app.config['BROKER_MAX_BATCH_SIZE']:
+        return json_response({"description": "at most %d instance_ids per batch" % app.config['BROKER_MAX_BATCH_SIZE']},
+                             413)
+    # One result per requested id and in the same order, repeated ids included
+    ops = broker.get_provisioning_states(instance_ids)
+    results = []
+    for instance_id in instance_ids:
+        op = ops[instance_id]
+        if op is None:
+            results.append({"instance_id": instance_id, "status": 410, "body": {}})
+        else:
+            results.append({"instance_id": instance_id, "status": 200, "body": op.as_dict()})
+    return json_response({"results": results}, 200)
+
+
 if __name__ == '__main__':
     app.run(debug=1)
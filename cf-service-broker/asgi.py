@@ -0,0 +1,360 @@
+from urllib.parse import parse_qs
+from admission import admission_from_environment, retry_after_header
+from async_broker import AsyncBroker
+from executor import executor_from_environment
+from inventory import inventory_from_environment
+from journal import journal_from_environment
+from opstore import operations_from_environment
+from auth import Authenticator, authenticator_from_environment
+from codec import EMPTY_OBJECT, encoded_msg
+from exceptions import *
+from progress import SSE_KEEPALIVE, sse_message
+from reconcile import reconciler_from_environment
+from registry import services_from_environment
+from schema import BIND, PROVISION, UPDATE, validate
+from workqueue import work_queue_from_environment
+import asyncio
+import base64
+import codec
+import gzip
+import os
+import re
+import logging
+
+logging.basicConfig(level=logging.DEBUG)
+log = logging.getLogger()
+
+
+class Request:
+    def __init__(self, scope: dict, body: bytes):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope['headers']}
+        self.args = {k: v[0] for k, v in parse_qs(scope.get('query_string', b'').decode('latin-1')).items()}
+        self.body = body
+
+    @property
+    def content_type(self):
+        return self.headers.get('content-type', '').split(';')[0].strip()
+
+    @property
+    def accepts_gzip(self) -> bool:
+        for coding in self.headers.get('accept-encoding', '').split(','):
+            name, _, params = coding.partition(';')
+            if name.strip() == 'gzip':
+                return params.replace(' ', '') not in ('q=0', 'q=0.0')
+        return False
+
+    def if_none_match(self, etag: str) -> bool:
+        # Whether If-None-Match names etag, weakly compared as it is for GET
+        header = self.headers.get('if-none-match')
+        if header is None:
+            return False
+        tags = [t.strip() for t in header.split(',')]
+        return '*' in tags or etag in [t[2:] if t.startswith('W/') else t for t in tags]
+
+    def authorization(self):
+        try:
+            scheme, credentials = self.headers['authorization'].split(' ', 1)
+            if scheme.lower() != 'basic':
+                return None
+            username, password = base64.b64decode(credentials).decode('utf-8').split(':', 1)
+        except (KeyError, ValueError):
+            return None
+        return username, password
+
+
+class BrokerApp:
+    # The single-instance /v2 routes of api.py as a plain ASGI application driving an AsyncBroker.  The batch
+    # routes, /metrics and /admin/profiles are only served by api.py.  Handlers return
+    # (status, body) where body is a dict or pre-encoded bytes for JSON responses, a str for text/plain ones, or an
+    # async iterator of bytes for event streams, optionally followed by a list of extra headers.
+    def __init__(self, broker: AsyncBroker, authenticator: Authenticator, api_version: float=2.7,
+                 progress_poll_interval: float=0.5, progress_keepalive: float=15, gzip_min_size: int=1024,
+                 gzip_catalog: bool=True):
+        self.broker = broker
+        self.authenticator = authenticator
+        self.api_version = api_version
+        self.progress_poll_interval = progress_poll_interval
+        self.progress_keepalive = progress_keepalive
+        # JSON responses at least this many bytes long are gzipped for clients that accept it; 0 turns that off
+        self.gzip_min_size = gzip_min_size
+        # As BROKER_GZIP_CATALOG in api.py, the catalog is served from its gzipped copy to clients that accept it
+        self.gzip_catalog = gzip_catalog
+        self.reconciler = None
+        self.routes = [
+            ('GET', re.compile(r'^/v2/catalog$'), self.get_catalog, None),
+            ('GET', re.compile(r'^/v2/service_instances/(?P<instance_id>[^/]+)/last_operation$'),
+             self.get_last_operation, None),
+            ('GET', re.compile(r'^/v2/service_instances/(?P<instance_id>[^/]+)/last_operation/stream$'),
+             self.get_last_operation_stream, None),
+            ('PUT', re.compile(r'^/v2/service_instances/(?P<instance_id>[^/]+)$'), self.put_create_instance, PROVISION),
+            ('DELETE', re.compile(r'^/v2/service_instances/(?P<instance_id>[^/]+)$'), self.delete_delete_instance,
+             None),
+            ('PATCH', re.compile(r'^/v2/service_instances/(?P<instance_id>[^/]+)$'), self.patch_modify_instance,
+             UPDATE),
+            ('PUT', re.compile(r'^/v2/service_instances/(?P<instance_id>[^/]+)/service_bindings/(?P<binding_id>[^/]+)$'),
+             self.put_bind, BIND),
+            ('DELETE',
+             re.compile(r'^/v2/service_instances/(?P<instance_id>[^/]+)/service_bindings/(?P<binding_id>[^/]+)$'),
+             self.delete_unbind, None),
+        ]
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+        request = Request(scope, body)
+        await self._send(send, *await self.dispatch(request), accepts_gzip=request.accepts_gzip)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                # Resumed operations are submitted from the event loop, so recovery waits for it to be running
+                self.broker.recover()
+                self.reconciler = reconciler_from_environment(self.broker)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.reconciler is not None:
+                    self.reconciler.stop()
+                self.broker.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _send(self, send, status, content, headers=(), accepts_gzip=False):
+        if status == 304:
+            # No body, so no content type either
+            await send({'type': 'http.response.start', 'status': status, 'headers': list(headers)})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+        if hasattr(content, '__aiter__'):
+            await send({'type': 'http.response.start', 'status': status,
+                        'headers': [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache')]})
+            async for chunk in content:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+        if isinstance(content, str):
+            body, content_type = content.encode('utf-8'), b'text/plain'
+        elif isinstance(content, bytes):
+            body, content_type = content, b'application/json'
+        else:
+            body, content_type = EMPTY_OBJECT if content == {} else codec.dumps(content), b'application/json'
+        headers = list(headers)
+        if (accepts_gzip and self.gzip_min_size and content_type == b'application/json' and
+                len(body) >= self.gzip_min_size and
+                not any(k in (b'content-encoding', b'etag') for k, _ in headers)):
+            # Bodies with an ETag are left alone, the tag is for exactly those bytes
+            body = gzip.compress(body, compresslevel=6)
+            headers += [(b'content-encoding', b'gzip'), (b'vary', b'accept-encoding')]
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', content_type), (b'content-length', str(len(body)).encode())] +
+                               headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def dispatch(self, request: Request):
+        path_matched = False
+        for method, pattern, handler, schema in self.routes:
+            match = pattern.match(request.path)
+            if not match:
+                continue
+            path_matched = True
+            if method == request.method:
+                break
+        else:
+            return (405, "Method not allowed") if path_matched else (404, "Not found")
+        client_api_version = request.headers.get('x-broker-api-version')
+        if not client_api_version or float(client_api_version) < self.api_version:
+            return 409, ("This broker implements version %s of the broker API, your client supports %s" %
+                         (self.api_version, client_api_version))
+        credentials = request.authorization()
+        if credentials is None:
+            return 401, "Not authorized"
+        if not self.authenticator.check_cached(*credentials):
+            # A full check hashes the password, which takes long enough to stall every other request on the loop
+            loop = asyncio.get_running_loop()
+            if not await loop.run_in_executor(None, self.authenticator.check, *credentials):
+                return 401, "Not authorized"
+        args = []
+        if schema is not None:
+            if request.content_type != 'application/json':
+                return 409, ("Unsupported content type %s in request, application/json expected" %
+                             request.content_type)
+            try:
+                args.append(validate(schema, codec.loads(request.body)))
+            except InvalidRequestError as e:
+                return 400, encoded_msg(e)
+            except ValueError:
+                return 400, {"description": "request body is not valid JSON"}
+        try:
+            return await handler(request, *args, **match.groupdict())
+        except RateLimitedError as e:
+            return 429, encoded_msg(e), [(b'retry-after', retry_after_header(e).encode('ascii'))]
+        except Exception:
+            log.exception("unhandled error in %s %s", request.method, request.path)
+            return 500, {}
+
+    async def get_catalog(self, request):
+        # With a strong ETag per representation, and 304 for a client that already has it, as utils.etag_response
+        catalog = self.broker.serialized_catalog()
+        if self.gzip_catalog and request.accepts_gzip:
+            body, etag, headers = catalog.gzip_body, catalog.gzip_etag, [(b'content-encoding', b'gzip')]
+        else:
+            body, etag, headers = catalog.body, catalog.etag, []
+        quoted = '"%s"' % etag
+        headers += [(b'etag', quoted.encode('latin-1')), (b'vary', b'accept-encoding')]
+        if request.if_none_match(quoted):
+            return 304, None, [h for h in headers if h[0] != b'content-encoding']
+        return 200, body, headers
+
+    async def get_last_operation(self, request, instance_id):
+        try:
+            return 202, self.broker.get_operation(instance_id).as_dict()
+        except NoSuchEntityError:
+            return 410, {}
+        except AsyncOperationStateNotHandledError:
+            return 500, {"error": "The async operation was not in a state the broker could understand"}
+
+    async def get_last_operation_stream(self, request, instance_id):
+        try:
+            op = self.broker.get_operation(instance_id)
+        except NoSuchEntityError:
+            return 410, {}
+        return 200, self._progress_events(instance_id, op)
+
+    async def _progress_events(self, instance_id, op):
+        loop = asyncio.get_running_loop()
+        last, last_sent = None, loop.time()
+        while op is not None:
+            event = op.as_event()
+            if event != last:
+                yield sse_message(event)
+                last, last_sent = event, loop.time()
+            elif loop.time() - last_sent >= self.progress_keepalive:
+                yield SSE_KEEPALIVE
+                last_sent = loop.time()
+            if op.finished:
+                return
+            await asyncio.sleep(self.progress_poll_interval)
+            op = self.broker.operations.get(instance_id)
+
+    async def put_create_instance(self, request, data, instance_id):
+        try:
+            await self.broker.create_instance(instance_id=instance_id, **data)
+        except ProvisioningAsynchronously:
+            return 202, {}
+        except CannotProvisionSynchronouslyError as e:
+            return 422, encoded_msg(e)
+        except (UnknownServiceError, UnknownPlanError) as e:
+            return 400, encoded_msg(e)
+        except (BrokerBusyError, OperationCancelledError) as e:
+            return 503, encoded_msg(e)
+        except OperationTimeoutError as e:
+            return 504, encoded_msg(e)
+        except ServiceBusyError as e:
+            return 429, encoded_msg(e)
+        except ServiceConflictError:
+            return 409, {}
+        except IdenticalRequestCompleted as e:
+            return 200, encoded_msg(e)
+        else:
+            return 201, {}
+
+    async def delete_delete_instance(self, request, instance_id):
+        try:
+            service_id = request.args['service_id']
+            plan_id = request.args['plan_id']
+        except KeyError:
+            return 400, {"description": "either service_id or plan_id missing from request query params"}
+        accepts_incomplete = request.args.get('accepts_incomplete', False)
+        try:
+            await self.broker.delete_instance(instance_id, service_id, plan_id, accepts_incomplete)
+        except ProvisioningAsynchronously:
+            return 202, {}
+        except CannotProvisionSynchronouslyError as e:
+            return 422, encoded_msg(e)
+        except (UnknownServiceError, UnknownPlanError) as e:
+            return 400, encoded_msg(e)
+        except (BrokerBusyError, OperationCancelledError) as e:
+            return 503, encoded_msg(e)
+        except OperationTimeoutError as e:
+            return 504, encoded_msg(e)
+        except ServiceBusyError as e:
+            return 429, encoded_msg(e)
+        except NoSuchEntityError:
+            return 410, {}
+        else:
+            return 200, {}
+
+    async def patch_modify_instance(self, request, data, instance_id):
+        try:
+            await self.broker.modify_instance(instance_id=instance_id, **data)
+        except NotImplementedError:
+            return 501, {}
+        except ProvisioningAsynchronously:
+            return 202, {}
+        except CannotProvisionSynchronouslyError as e:
+            return 422, encoded_msg(e)
+        except (UnknownServiceError, UnknownPlanError) as e:
+            return 400, encoded_msg(e)
+        except (BrokerBusyError, OperationCancelledError) as e:
+            return 503, encoded_msg(e)
+        except OperationTimeoutError as e:
+            return 504, encoded_msg(e)
+        except ServiceBusyError as e:
+            return 429, encoded_msg(e)
+        except UnsupportedPlanChangeError as e:
+            return 422, encoded_msg(e)
+        except CurrentlyNotPossiblePlanChangeError as e:
+            return 422, encoded_msg(e)
+        except IdenticalRequestCompleted as e:
+            return 200, e.msg
+        else:
+            return 201, {}
+
+    async def put_bind(self, request, data, instance_id, binding_id):
+        try:
+            credentials = await self.broker.bind_instance(instance_id=instance_id, binding_id=binding_id, **data)
+        except (UnknownServiceError, UnknownPlanError, BindingNotSupportedError) as e:
+            return 400, encoded_msg(e)
+        except BindingExistsError as e:
+            return 409, encoded_msg(e)
+        except AppGUIDRequiredError as e:
+            return 422, encoded_msg(e)
+        except IdenticalRequestCompleted as e:
+            return 200, {"credentials": e.msg}
+        else:
+            return 201, {"credentials": credentials}
+
+    async def delete_unbind(self, request, instance_id, binding_id):
+        try:
+            service_id = request.args['service_id']
+            plan_id = request.args['plan_id']
+        except KeyError:
+            return 400, {"description": "either service_id or plan_id missing from request query params"}
+        try:
+            await self.broker.unbind_instance(instance_id=instance_id, binding_id=binding_id, service_id=service_id,
+                                              plan_id=plan_id)
+        except (UnknownServiceError, UnknownPlanError) as e:
+            return 400, encoded_msg(e)
+        except NoSuchEntityError:
+            return 410, {}
+        else:
+            return 200, {}
+
+
+broker = AsyncBroker(service_list=services_from_environment(), admission=admission_from_environment(),
+                     journal=journal_from_environment(), operations=operations_from_environment(),
+                     work_queue=work_queue_from_environment(), inventory=inventory_from_environment(),
+                     executor=executor_from_environment())
+app = BrokerApp(broker, authenticator_from_environment(default={'u': 'p'}),
+                gzip_min_size=int(os.environ.get('BROKER_GZIP_MIN_SIZE', 1024)))
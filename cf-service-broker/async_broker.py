@@ -0,0 +1,225 @@
+from functools import partial
+from time import time
+from typing import Iterable, Callable, Any
+from admission import priority_of
+from broker import Broker, SYNC_TIMEOUT
+from cancellation import CancellationToken
+from idempotency import request_hash
+from opstore import Operation
+from exceptions import *
+from executor import NORMAL
+from progress import ProgressReporter, QUEUED, RUNNING, run_reporting
+import asyncio
+import logging
+
+logging.basicConfig(level=logging.DEBUG)
+log = logging.getLogger()
+
+
+class AsyncBroker(Broker):
+    # Same catalog, operation store and executor as Broker, but every operation is a coroutine.  Methods of an
+    # AsyncBaseService are awaited directly; plain BaseService methods run on the executor as they do in Broker,
+    # so a sync provision no longer ties up a web worker thread while it waits.
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # The event loop only keeps weak references to tasks, so hold on to the async ones until they finish
+        self._tasks = set()
+
+    async def create_instance(self, instance_id: str, organization_guid: str, plan_id: str, service_id: str,
+                              space_guid: str,
+                              parameters: dict=None,
+                              accepts_incomplete: bool=False) -> dict:
+        service, plan = self.resolve(service_id, plan_id)
+        key = ('instance', instance_id)
+        body_hash = request_hash(organization_guid, plan_id, service_id, space_guid, parameters)
+        request, owner = self.requests.begin(key, body_hash)
+        if not owner:
+            if request.body_hash != body_hash:
+                raise ServiceConflictError
+            if request.asynchronous and not request.future.done():
+                raise ProvisioningAsynchronously
+            dashboard_url = await asyncio.wait_for(asyncio.wrap_future(request.future), timeout=SYNC_TIMEOUT)
+            raise IdenticalRequestCompleted(self._create_result(dashboard_url))
+        try:
+            request.asynchronous = not self._match_synchronicity(service_id, plan_id, accepts_incomplete)
+            future, sync = self._start(instance_id, 'create', service_id, plan_id, accepts_incomplete,
+                                       service.create_instance, instance_id, plan_id, parameters, organization_guid,
+                                       space_guid, organization_guid=organization_guid)
+        except Exception as e:
+            self.requests.fail(key, request, e)
+            raise
+        self.requests.track(key, request, future)
+        if not sync:
+            await self._journaled()
+            raise ProvisioningAsynchronously
+        return self._create_result(await future)
+
+    async def create_instances(self, requests: Iterable[dict]) -> list:
+        return await asyncio.gather(*[self._call_batch_item(self.create_instance, r) for r in requests],
+                                    return_exceptions=True)
+
+    async def delete_instance(self, instance_id: str, service_id: str, plan_id: str,
+                              accepts_incomplete: bool=False) -> dict:
+        service, plan = self.resolve(service_id, plan_id)
+        self.requests.forget_instance(instance_id)
+        self.binding_cache.invalidate(instance_id)
+        await self._run(instance_id, 'delete', service_id, plan_id, accepts_incomplete,
+                        service.delete_instance, instance_id)
+        return {}
+
+    async def delete_instances(self, requests: Iterable[dict]) -> list:
+        return await asyncio.gather(*[self._call_batch_item(self.delete_instance, r) for r in requests],
+                                    return_exceptions=True)
+
+    async def modify_instance(self, instance_id: str, service_id: str, plan_id: str, parameters: str,
+                              previous_values: str,
+                              accepts_incomplete: bool=False) -> dict:
+        service, plan = self.resolve(service_id, plan_id)
+        if not service.plan_updateable:
+            raise UnsupportedPlanChangeError
+        sync = self._match_synchronicity(service_id, plan_id, accepts_incomplete)
+        update, merged = self.updates.submit(instance_id, service_id, plan_id, parameters, previous_values, sync)
+        if sync:
+            # Shielded, a request that gives up mustn't cancel the update for the others merged into it
+            result = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(update.future)),
+                                            timeout=SYNC_TIMEOUT if merged else None)
+            return self._modify_result(result)
+        if not merged and update.future.done():
+            return self._modify_result(update.future.result())
+        await self._journaled()
+        raise ProvisioningAsynchronously
+
+    async def bind_instance(self, instance_id: str, binding_id: str, service_id: str, plan_id: str,
+                            app_guid: str=None, parameters: dict=None) -> dict:
+        # Resolved first, a request tracked by begin() must always be finished
+        service, plan = self.resolve(service_id, plan_id)
+        key = ('binding', instance_id, binding_id)
+        body_hash = request_hash(service_id, plan_id, app_guid, parameters)
+        request, owner = self.requests.begin(key, body_hash)
+        if not owner:
+            if request.body_hash != body_hash:
+                raise BindingExistsError
+            raise IdenticalRequestCompleted(await asyncio.wait_for(asyncio.wrap_future(request.future),
+                                                                   timeout=SYNC_TIMEOUT))
+        credentials = self.binding_cache.get(instance_id, binding_id, body_hash) if service.cache_bindings else None
+        if credentials is None:
+            try:
+                admission = self.admission.admit('bind', service_id, plan_id)
+                try:
+                    credentials = await self._call(self._profiled(service.bind, service_id, plan_id, 'bind', True),
+                                                   instance_id, binding_id, plan_id, app_guid, parameters)
+                finally:
+                    admission.release()
+            except Exception as e:
+                self.requests.fail(key, request, e)
+                raise
+            if service.cache_bindings:
+                self.binding_cache.put(instance_id, binding_id, body_hash, credentials)
+        self.inventory.add_binding(instance_id, binding_id, service_id, plan_id)
+        self.requests.succeed(key, request, credentials)
+        return credentials
+
+    async def unbind_instance(self, instance_id: str, binding_id: str, service_id: str, plan_id: str):
+        self.requests.forget(('binding', instance_id, binding_id))
+        self.binding_cache.invalidate(instance_id, binding_id)
+        service, plan = self.resolve(service_id, plan_id)
+        admission = self.admission.admit('unbind', service_id, plan_id)
+        try:
+            await self._call(self._profiled(service.unbind, service_id, plan_id, 'unbind', True), instance_id,
+                             binding_id, plan_id)
+        finally:
+            admission.release()
+        self.inventory.remove_binding(instance_id, binding_id)
+
+    async def _call_batch_item(self, method: Callable, request: dict) -> dict:
+        # Bad keyword arguments have to raise inside the coroutine for gather to report them per item
+        return await method(**request)
+
+    async def _call(self, func: Callable, *func_args) -> Any:
+        # Binding calls never went through the executor in Broker, keep it that way but off the event loop
+        if asyncio.iscoroutinefunction(func):
+            return await func(*func_args)
+        return await asyncio.get_running_loop().run_in_executor(None, func, *func_args)
+
+    async def _run(self, instance_id: str, operation: str, service_id: str, plan_id: str, accepts_incomplete: bool,
+                   func: Callable, *func_args) -> Any:
+        future, sync = self._start(instance_id, operation, service_id, plan_id, accepts_incomplete,
+                                   func, *func_args)
+        if not sync:
+            await self._journaled()
+            raise ProvisioningAsynchronously
+        return await future
+
+    def _record_operation(self, instance_id: str, operation: str, service_id: str, plan_id: str, phase: str,
+                          func_args: tuple):
+        # On the event loop, which mustn't wait for the journal's fsync: the 202 waits in _journaled() instead
+        if self.journal is not None:
+            self.journal.start(instance_id, operation, service_id, plan_id, func_args, wait=False)
+        self.operations.put(Operation(instance_id, operation, phase=phase))
+
+    async def _journaled(self):
+        # Until the start records of the operations begun so far are on disk, so the operation a client is
+        # answered 202 for survives a crash, as in Broker
+        if self.journal is not None:
+            await asyncio.wrap_future(self.journal.committed())
+
+    def _enqueue_operation(self, instance_id: str, operation: str, service_id: str, plan_id: str,
+                           func_args: tuple) -> asyncio.Future:
+        return asyncio.wrap_future(super()._enqueue_operation(instance_id, operation, service_id, plan_id, func_args))
+
+    def _execute_operation(self, instance_id: str, operation: str, service_id: str, plan_id: str, sync: bool,
+                           func: Callable, *func_args) -> asyncio.Future:
+        # The create's or modify's parameters, for the inventory, before func_args is wrapped for run_reporting
+        parameters = func_args[2] if operation != 'delete' else None
+        timeout = self._timeout(plan_id, sync)
+        token = CancellationToken(time() + timeout if timeout is not None else None)
+        coroutine = self._is_coroutine_function(func)
+        reporter = None
+        if not sync:
+            # Coroutines report straight into the store from the event loop and start running immediately
+            reporter = ProgressReporter(instance_id, (lambda event: self._on_progress(*event)) if coroutine else
+                                        self.executor.progress_sink)
+        func = self._profiled(self._bind_keywords(func, token, reporter), service_id, plan_id, operation)
+        if not sync:
+            self._record_operation(instance_id, operation, service_id, plan_id, RUNNING if coroutine else QUEUED,
+                                   func_args)
+            if not coroutine:
+                func, func_args = run_reporting, (reporter, func) + func_args
+        try:
+            future = self._submit(service_id, timeout, token, func, *func_args, priority=priority_of(operation))
+        except Exception as e:
+            if not sync:
+                self._fail_operation(instance_id, e)
+            raise
+        self._observe(future, service_id, plan_id, operation)
+        self._track_inventory(future, instance_id, operation, service_id, plan_id, parameters)
+        if not sync:
+            future.add_done_callback(lambda f: self._finish_operation(instance_id, f))
+        return future
+
+    def _submit(self, service_id: str, timeout: float, token: CancellationToken, func: Callable,
+                *func_args, priority: int=NORMAL) -> asyncio.Future:
+        if not self._is_coroutine_function(func):
+            future = self.executor.submit(service_id, func, *func_args, priority=priority)
+            if timeout is not None:
+                self.deadlines.watch(timeout, lambda: self._expire(future, token, timeout))
+            return asyncio.wrap_future(future)
+        self.executor.acquire(service_id)
+        task = asyncio.ensure_future(self._with_timeout(func(*func_args), timeout, token))
+        task.add_done_callback(lambda t: self.executor.release(service_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    @staticmethod
+    def _is_coroutine_function(func: Callable) -> bool:
+        return asyncio.iscoroutinefunction(func.func if isinstance(func, partial) else func)
+
+    @staticmethod
+    async def _with_timeout(coro, timeout: float, token: CancellationToken) -> Any:
+        # Coroutines can be cancelled for real, so a timeout stops the service method at its next await
+        try:
+            return await asyncio.wait_for(coro, timeout)
+        except asyncio.TimeoutError:
+            token.cancel()
+            raise OperationTimeoutError("operation timed out after %ss" % timeout)
@@ -0,0 +1,139 @@
+from getpass import getpass
+from threading import Lock
+from time import time
+from cache import MemoryCacheStore
+import hashlib
+import hmac
+import json
+import os
+import sys
+import logging
+
+logging.basicConfig(level=logging.DEBUG)
+log = logging.getLogger()
+
+HASH_SCHEME = 'pbkdf2_sha256'
+HASH_ITERATIONS = 200000
+
+
+def hash_password(password: str, salt: bytes=None, iterations: int=HASH_ITERATIONS) -> str:
+    salt = salt if salt is not None else os.urandom(16)
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, iterations)
+    return '%s$%d$%s$%s' % (HASH_SCHEME, iterations, salt.hex(), digest.hex())
+
+
+def verify_password(password: str, hashed: str) -> bool:
+    scheme, iterations, salt, digest = hashed.split('$')
+    if scheme != HASH_SCHEME:
+        raise ValueError("unsupported password hash scheme %s" % scheme)
+    candidate = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), bytes.fromhex(salt), int(iterations))
+    return hmac.compare_digest(candidate, bytes.fromhex(digest))
+
+
+def parse_credentials(lines) -> dict:
+    # One "username:password" per line, where password is either a hash_password() string or plain text to be
+    # hashed on load.  Blank lines and lines starting with # are ignored.
+    credentials = {}
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        username, _, password = line.partition(':')
+        credentials[username] = password if password.startswith(HASH_SCHEME + '$') else hash_password(password)
+    return credentials
+
+
+class Authenticator:
+    # Checks basic auth credentials against salted password hashes.  A successful check is remembered for
+    # cache_ttl seconds under an HMAC of the username and password, so repeated requests from the Cloud Controller
+    # skip the deliberately slow hash.
+    def __init__(self, credentials: dict=None, cache_size: int=256, cache_ttl: float=300):
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self._cache_key = os.urandom(32)
+        self._lock = Lock()
+        self.set_credentials(credentials or {})
+
+    @classmethod
+    def from_passwords(cls, passwords: dict, **kwargs):
+        return cls({username: hash_password(password) for username, password in passwords.items()}, **kwargs)
+
+    def set_credentials(self, credentials: dict):
+        # username -> hash_password() string.  Replacing the credentials forgets every cached check.
+        with self._lock:
+            self.credentials = dict(credentials)
+            self._verified = MemoryCacheStore(max_entries=self.cache_size)
+            self._dummy_hash = hash_password('', iterations=self._iterations())
+
+    def _iterations(self):
+        for hashed in self.credentials.values():
+            return int(hashed.split('$')[1])
+        return HASH_ITERATIONS
+
+    def _key(self, username: str, password: str) -> bytes:
+        return hmac.new(self._cache_key, ('%s:%s' % (username, password)).encode('utf-8'), 'sha256').digest()
+
+    def check_cached(self, username: str, password: str) -> bool:
+        # Whether the credentials passed a check less than cache_ttl seconds ago, without hashing the password
+        entry = self._verified.get(self._key(username, password))
+        return entry is not None and entry[0] >= time()
+
+    def check(self, username: str, password: str) -> bool:
+        cache_key = self._key(username, password)
+        verified = self._verified
+        entry = verified.get(cache_key)
+        if entry is not None and entry[0] >= time():
+            return True
+        hashed = self.credentials.get(username)
+        # Unknown users still pay for a hash so response times don't reveal which usernames exist
+        valid = verify_password(password, hashed if hashed is not None else self._dummy_hash) and hashed is not None
+        if valid:
+            verified.set(cache_key, time() + self.cache_ttl, True)
+        return valid
+
+
+class FileAuthenticator(Authenticator):
+    # Reads credentials with parse_credentials() and re-reads the file when it changes, checking its modification
+    # time at most every reload_interval seconds, so credentials can be rotated without a restart.
+    def __init__(self, path: str, reload_interval: float=5, **kwargs):
+        self.path = path
+        self.reload_interval = reload_interval
+        self._mtime = None
+        self._last_checked = 0
+        super().__init__(**kwargs)
+        self.reload()
+
+    def reload(self):
+        self._last_checked = time()
+        mtime = os.stat(self.path).st_mtime
+        if mtime == self._mtime:
+            return
+        with open(self.path) as f:
+            credentials = parse_credentials(f)
+        log.info("loaded %d broker credentials from %s", len(credentials), self.path)
+        self._mtime = mtime
+        self.set_credentials(credentials)
+
+    def check(self, username: str, password: str) -> bool:
+        if time() - self._last_checked >= self.reload_interval:
+            try:
+                self.reload()
+            except OSError:
+                log.exception("could not reload broker credentials from %s, keeping the current ones", self.path)
+        return super().check(username, password)
+
+
+def authenticator_from_environment(default: dict=None) -> Authenticator:
+    # BROKER_CREDENTIALS_FILE names a credentials file, otherwise BROKER_CREDENTIALS holds a JSON object of
+    # username -> password, otherwise the default username -> password pairs are used
+    if os.environ.get('BROKER_CREDENTIALS_FILE'):
+        return FileAuthenticator(os.environ['BROKER_CREDENTIALS_FILE'])
+    if os.environ.get('BROKER_CREDENTIALS'):
+        passwords = json.loads(os.environ['BROKER_CREDENTIALS'])
+        return Authenticator(parse_credentials('%s:%s' % item for item in passwords.items()))
+    return Authenticator.from_passwords(default or {})
+
+
+if __name__ == '__main__':
+    # Prints a credentials file line: python auth.py <username>
+    print('%s:%s' % (sys.argv[1], hash_password(getpass())))
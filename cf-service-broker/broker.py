@@ -1,78 +1,516 @@
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import Future
+from functools import partial
+from inspect import iscoroutinefunction
+from time import perf_counter, time
 from typing import Iterable, Callable, Any
+from admission import AdmissionController, priority_of
+from cache import BindingCache
+from cancellation import CancellationToken, DeadlineWatcher, accepts_cancel_token, accepts_keyword
+from catalog import SerializedCatalog
 from exceptions import *
+from executor import BrokerExecutor
+from idempotency import RequestTracker, request_hash
+from inventory import MemoryInventory
+from journal import OperationJournal
+from opstore import MemoryOperationStore, Operation, STATES, SUCCEEDED, FAILED
+from profiling import Profiler
+from progress import ProgressReporter, QUEUED, accepts_progress, run_reporting
+from registry import implementation
 from service import Plan
+from updates import NO_CHANGES, PendingUpdate, UpdateQueue, diff_instance, merge_parameters
+from workqueue import CoroutineRunner, Job, WorkQueue, WorkerNode
+import metrics
 import logging
 
 logging.basicConfig(level=logging.DEBUG)
 log = logging.getLogger()
 
+SYNC_TIMEOUT = 59
+# Service methods that an operation kind recorded in the journal re-runs
+OPERATION_METHODS = {'create': 'create_instance', 'delete': 'delete_instance', 'modify': 'modify_instance'}
+
 
 class Broker:
-    def __init__(self, service_list: Iterable=None):
-        if service_list is None:
-            self.services = {}
-        else:
-            self.services = {s.guid: s for s in service_list}
-        self.async_ops = {}
+    def __init__(self, service_list: Iterable=None, executor: BrokerExecutor=None,
+                 operations: MemoryOperationStore=None, requests: RequestTracker=None,
+                 binding_cache: BindingCache=None, sync_timeout: float=SYNC_TIMEOUT, async_timeout: float=None,
+                 admission: AdmissionController=None, journal: OperationJournal=None, work_queue: WorkQueue=None,
+                 inventory: MemoryInventory=None, profiler: Profiler=None):
+        self.services = {}
+        # plan guid -> (service, plan), and names -> guids, maintained by add_service/remove_service
+        self.plan_index = {}
+        self.service_ids_by_name = {}
+        self.plan_ids_by_name = {}
+        for service in service_list or ():
+            self._index_service(service)
+        self.executor = executor if executor is not None else BrokerExecutor()
+        self.operations = operations if operations is not None else MemoryOperationStore()
+        self.requests = requests if requests is not None else RequestTracker()
+        self.binding_cache = binding_cache if binding_cache is not None else BindingCache()
+        self.admission = admission if admission is not None else AdmissionController()
+        # Instances and bindings that exist as far as the broker knows, for the reconciler to check services against
+        self.inventory = inventory if inventory is not None else MemoryInventory()
+        # One update of an instance at a time, later PATCHes merged while they wait
+        self.updates = UpdateQueue(self._start_update)
+        # Optional, profiles selected service calls; without one service calls aren't touched at all
+        self.profiler = profiler
+        if profiler is not None:
+            self.executor.profile_listeners.append(profiler.add)
+        # Optional write-ahead record of async operations; call recover() once at startup to act on it
+        self.journal = journal
+        # Defaults for plans that don't set their own, in seconds; async_timeout=None lets async operations run forever
+        self.sync_timeout = sync_timeout
+        self.async_timeout = async_timeout
+        self.deadlines = DeadlineWatcher()
+        self.executor.listeners.append(self._on_progress)
+        self._serialized_catalog = None
+        # With a work queue shared between nodes, async operations are queued for whichever node claims them.  The
+        # operation store should then be shared too, so any node can answer last_operation.
+        self.node = WorkerNode(self, work_queue) if work_queue is not None else None
+        if self.node is not None:
+            self.node.start()
+
+    def shutdown(self, wait: bool=True):
+        if self.node is not None:
+            self.node.stop()
+        self.executor.shutdown(wait=wait)
+        if self.journal is not None:
+            self.journal.close()
+        if self.profiler is not None and self.profiler.dump_dir:
+            self.profiler.dump()
+
+    def recover(self):
+        # Rebuilds the operation store from the journal after a restart.  Operations that were still in progress
+        # are re-run if their service is idempotent and the journal has their arguments, otherwise marked failed.
+        if self.journal is None:
+            return
+        resumed = failed = 0
+        for op, entry in self.journal.operations():
+            if op.finished:
+                self.operations.put(op)
+                continue
+            service = self.services.get(entry['service_id'])
+            if (service is not None and service.idempotent and entry.get('args') is not None and
+                    entry['plan_id'] in self.plan_index and op.kind in OPERATION_METHODS):
+                log.info("resuming interrupted %s of instance %s", op.kind, op.instance_id)
+                self._resume(service, op.kind, entry)
+                resumed += 1
+            else:
+                log.warning("%s of instance %s was interrupted by a restart, marking it failed", op.kind,
+                            op.instance_id)
+                self.operations.put(op)
+                self._update_operation(op.instance_id, FAILED, "interrupted by a broker restart")
+                failed += 1
+        log.info("recovered operations from the journal: %d resumed, %d failed", resumed, failed)
+
+    def _resume(self, service, kind: str, entry: dict):
+        instance_id, args = entry['instance_id'], entry['args']
+        future = self._execute_operation(instance_id, kind, entry['service_id'], entry['plan_id'], False,
+                                         getattr(service, OPERATION_METHODS[kind]), *args)
+        if kind == 'create':
+            # So a retry of the original PUT attaches to the re-run instead of provisioning again
+            _, plan_id, parameters, organization_guid, space_guid = args
+            request, owner = self.requests.begin(('instance', instance_id),
+                                                 request_hash(organization_guid, plan_id, entry['service_id'],
+                                                              space_guid, parameters))
+            if owner:
+                request.asynchronous = True
+                self.requests.track(('instance', instance_id), request, future)
+
+    def add_service(self, service):
+        if service.guid in self.services:
+            self._unindex_service(self.services[service.guid])
+        self._index_service(service)
+        self._serialized_catalog = None
+
+    def remove_service(self, service_id: str):
+        self._unindex_service(self.services[service_id])
+        self._serialized_catalog = None
+
+    def _index_service(self, service):
+        self.services[service.guid] = service
+        self.service_ids_by_name[service.name] = service.guid
+        for plan in service.plans.values():
+            self.plan_index[plan.guid] = (service, plan)
+            self.plan_ids_by_name[(service.guid, plan.name)] = plan.guid
+
+    def _unindex_service(self, service):
+        del self.services[service.guid]
+        self.service_ids_by_name.pop(service.name, None)
+        for plan in service.plans.values():
+            self.plan_index.pop(plan.guid, None)
+            self.plan_ids_by_name.pop((service.guid, plan.name), None)
+
+    def resolve(self, service_id: str, plan_id: str) -> (Any, Plan):
+        # Validates the ids from a request up front, so unknown ones fail cleanly instead of as a KeyError
+        service = self.services.get(service_id)
+        if service is None:
+            raise UnknownServiceError
+        entry = self.plan_index.get(plan_id)
+        if entry is None or entry[0] is not service:
+            raise UnknownPlanError
+        return entry
 
     def service_catalog(self) -> dict:
         return {"services": [s.as_dict() for s in self.services.values()]}
 
+    def serialized_catalog(self) -> SerializedCatalog:
+        if self._serialized_catalog is None:
+            self._serialized_catalog = SerializedCatalog(self.service_catalog())
+        return self._serialized_catalog
+
+    def get_operation(self, instance_id: str) -> Operation:
+        op = self.operations.get(instance_id)
+        if op is None:
+            raise NoSuchEntityError
+        if op.state not in STATES:
+            raise AsyncOperationStateNotHandledError
+        return op
+
     def get_provisioning_state(self, instance_id: str) -> str:
-        future = self.async_ops[instance_id]
-        if future.running():
-            return "in progress"
-        if future.exception():
-            return "failed"
-        if future.done():
-            return "succeeded"
-        raise AsyncOperationStateNotHandledError
+        return self.get_operation(instance_id).state
+
+    def get_provisioning_states(self, instance_ids: Iterable[str]) -> dict:
+        # instance_id -> Operation, or None for instances with no known operation
+        instance_ids = list(instance_ids)
+        ops = self.operations.get_many(instance_ids)
+        return {i: ops.get(i) for i in instance_ids}
 
     def create_instance(self, instance_id: str, organization_guid: str, plan_id: str, service_id: str, space_guid: str,
                         parameters: dict=None,
                         accepts_incomplete: bool=False) -> dict:
-        service = self.services[service_id]
-        dashboard_url = self._run(instance_id, service_id, plan_id, accepts_incomplete,
-                                  service.create_instance, instance_id, plan_id, parameters, organization_guid, space_guid)
-        if dashboard_url:
-            return {"dashboard_url": dashboard_url}
-        else:
-            return {}
+        return self._start_create_instance(instance_id, organization_guid, plan_id, service_id, space_guid,
+                                           parameters, accepts_incomplete)()
+
+    def create_instances(self, requests: Iterable[dict]) -> list:
+        return self._run_batch(self._start_create_instance, requests)
 
     def delete_instance(self, instance_id: str, service_id: str, plan_id: str,
                         accepts_incomplete: bool=False) -> dict:
-        service = self.services[service_id]
-        self._run(instance_id, service_id, plan_id, accepts_incomplete,
-                  service.delete_instance, instance_id)
-        return {}
+        return self._start_delete_instance(instance_id, service_id, plan_id, accepts_incomplete)()
+
+    def delete_instances(self, requests: Iterable[dict]) -> list:
+        return self._run_batch(self._start_delete_instance, requests)
 
     def modify_instance(self, instance_id: str, service_id: str, plan_id: str, parameters: str, previous_values: str,
                         accepts_incomplete: bool=False) -> dict:
-        service = self.services[service_id]
+        service, plan = self.resolve(service_id, plan_id)
         if not service.plan_updateable:
             raise UnsupportedPlanChangeError
-        self._run(instance_id, service_id, plan_id, accepts_incomplete,
-                  service.modify_instance, instance_id, plan_id, parameters, previous_values)
-        return {}
+        sync = self._match_synchronicity(service_id, plan_id, accepts_incomplete)
+        update, merged = self.updates.submit(instance_id, service_id, plan_id, parameters, previous_values, sync)
+        if sync:
+            return self._modify_result(update.future.result(timeout=SYNC_TIMEOUT if merged else None))
+        if not merged and update.future.done():
+            # Refused before it started, or there was nothing to change
+            return self._modify_result(update.future.result())
+        raise ProvisioningAsynchronously
 
     def bind_instance(self, instance_id: str, binding_id: str, service_id: str, plan_id: str,
                       app_guid: str=None, parameters: dict=None) -> dict:
-        return self.services[service_id].bind(instance_id, binding_id, plan_id, app_guid, parameters)
+        service, plan = self.resolve(service_id, plan_id)
+        key = ('binding', instance_id, binding_id)
+        body_hash = request_hash(service_id, plan_id, app_guid, parameters)
+        request, owner = self.requests.begin(key, body_hash)
+        if not owner:
+            if request.body_hash != body_hash:
+                raise BindingExistsError
+            raise IdenticalRequestCompleted(request.future.result(timeout=SYNC_TIMEOUT))
+        credentials = self.binding_cache.get(instance_id, binding_id, body_hash) if service.cache_bindings else None
+        if credentials is None:
+            try:
+                admission = self.admission.admit('bind', service_id, plan_id)
+                try:
+                    credentials = self._profiled(service.bind, service_id, plan_id, 'bind', True)(
+                        instance_id, binding_id, plan_id, app_guid, parameters)
+                finally:
+                    admission.release()
+            except Exception as e:
+                self.requests.fail(key, request, e)
+                raise
+            if service.cache_bindings:
+                self.binding_cache.put(instance_id, binding_id, body_hash, credentials)
+        self.inventory.add_binding(instance_id, binding_id, service_id, plan_id)
+        self.requests.succeed(key, request, credentials)
+        return credentials
 
     def unbind_instance(self, instance_id: str, binding_id: str, service_id: str, plan_id: str):
-        self.services[service_id].unbind(instance_id, binding_id, plan_id)
+        self.requests.forget(('binding', instance_id, binding_id))
+        self.binding_cache.invalidate(instance_id, binding_id)
+        service, plan = self.resolve(service_id, plan_id)
+        admission = self.admission.admit('unbind', service_id, plan_id)
+        try:
+            self._profiled(service.unbind, service_id, plan_id, 'unbind', True)(instance_id, binding_id, plan_id)
+        finally:
+            admission.release()
+        self.inventory.remove_binding(instance_id, binding_id)
+
+    def _start_create_instance(self, instance_id: str, organization_guid: str, plan_id: str, service_id: str,
+                               space_guid: str,
+                               parameters: dict=None,
+                               accepts_incomplete: bool=False) -> Callable[[], dict]:
+        service, plan = self.resolve(service_id, plan_id)
+        key = ('instance', instance_id)
+        body_hash = request_hash(organization_guid, plan_id, service_id, space_guid, parameters)
+        request, owner = self.requests.begin(key, body_hash)
+        if not owner:
+            # A retry of a request that is in flight or recently done: attach to it instead of provisioning again
+            if request.body_hash != body_hash:
+                raise ServiceConflictError
+            if request.asynchronous and not request.future.done():
+                raise ProvisioningAsynchronously
+
+            def result():
+                raise IdenticalRequestCompleted(self._create_result(request.future.result(timeout=SYNC_TIMEOUT)))
+            return result
+        try:
+            request.asynchronous = not self._match_synchronicity(service_id, plan_id, accepts_incomplete)
+            future, sync = self._start(instance_id, 'create', service_id, plan_id, accepts_incomplete,
+                                       service.create_instance, instance_id, plan_id, parameters, organization_guid,
+                                       space_guid, organization_guid=organization_guid)
+        except Exception as e:
+            self.requests.fail(key, request, e)
+            raise
+        self.requests.track(key, request, future)
+        if not sync:
+            raise ProvisioningAsynchronously
+
+        def result():
+            return self._create_result(future.result())
+        return result
+
+    @staticmethod
+    def _modify_result(result) -> dict:
+        if result is NO_CHANGES:
+            raise IdenticalRequestCompleted({})
+        return {}
+
+    def _start_update(self, instance_id: str, update: PendingUpdate, deferred: bool) -> Future:
+        # Started by self.updates, None if the update leaves the instance as it is.  A deferred async update
+        # answers its requests through the operation record the update before it left in progress.
+        try:
+            future = self._submit_update(instance_id, update)
+        except Exception as e:
+            if deferred and not update.sync:
+                self._fail_operation(instance_id, e)
+            raise
+        if future is None and deferred and not update.sync:
+            self._update_operation(instance_id, SUCCEEDED)
+        return future
 
-    def _run(self, instance_id: str, service_id: str, plan_id: str, accepts_incomplete: bool, func: Callable, *func_args) -> Any:
+    def _submit_update(self, instance_id: str, update: PendingUpdate) -> Future:
+        service, plan = self.resolve(update.service_id, update.plan_id)
+        func = service.modify_instance
+        # Without a record of what was applied before there is nothing to diff against, the service gets diff=None
+        applied = self.inventory.get_instance(instance_id)
+        if applied is not None:
+            diff = diff_instance(applied[1], applied[2], update.plan_id,
+                                 merge_parameters(applied[2], update.parameters))
+            if diff.empty:
+                log.info("update of instance %s changes nothing, not calling the service", instance_id)
+                return None
+            # Service methods opt in to the diff by declaring the keyword, like the cancellation token
+            if accepts_keyword(implementation(func), 'diff'):
+                func = partial(func, diff=diff)
+        future, sync = self._start(instance_id, 'modify', update.service_id, update.plan_id, not update.sync, func,
+                                   instance_id, update.plan_id, update.parameters, update.previous_values)
+        return future
+
+    @staticmethod
+    def _create_result(dashboard_url: str) -> dict:
+        if dashboard_url:
+            return {"dashboard_url": dashboard_url}
+        else:
+            return {}
+
+    def _start_delete_instance(self, instance_id: str, service_id: str, plan_id: str,
+                               accepts_incomplete: bool=False) -> Callable[[], dict]:
+        service, plan = self.resolve(service_id, plan_id)
+        self.requests.forget_instance(instance_id)
+        self.binding_cache.invalidate(instance_id)
+        future, sync = self._start(instance_id, 'delete', service_id, plan_id, accepts_incomplete,
+                                   service.delete_instance, instance_id)
+        if not sync:
+            raise ProvisioningAsynchronously
+
+        def result():
+            future.result()
+            return {}
+        return result
+
+    def _run_batch(self, start: Callable, requests: Iterable[dict]) -> list:
+        # Every request is submitted before any is waited on, so the sync ones run concurrently on the executor.
+        # Each entry in the returned list is either the operation's result or the exception it raised.
+        started = []
+        for request in requests:
+            try:
+                started.append(start(**request))
+            except Exception as e:
+                started.append(e)
+        results = []
+        for item in started:
+            if isinstance(item, Exception):
+                results.append(item)
+                continue
+            try:
+                results.append(item())
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def _start(self, instance_id: str, operation: str, service_id: str, plan_id: str, accepts_incomplete: bool,
+               func: Callable, *func_args, organization_guid: str=None) -> (Future, bool):
         # The _match_synchronicity call must come first because it may raise an exception
         sync = self._match_synchronicity(service_id, plan_id, accepts_incomplete)
-        executor = ProcessPoolExecutor(max_workers=1)
-        future = executor.submit(func, *func_args)
-        if sync:
-            return future.result(timeout=59)
+        admission = self.admission.admit(operation, service_id, plan_id, organization_guid)
+        try:
+            future = self._submit_operation(instance_id, operation, service_id, plan_id, sync, func, *func_args)
+        except Exception:
+            admission.release()
+            raise
+        future.add_done_callback(admission.release)
+        return future, sync
+
+    def run_job(self, job: Job) -> Future:
+        # Runs an operation claimed from the work queue on this node's executor, whatever kind of broker this is
+        service, plan = self.resolve(job.service_id, job.plan_id)
+        func = getattr(service, OPERATION_METHODS[job.kind])
+        if iscoroutinefunction(func):
+            func = CoroutineRunner(func)
+        return Broker._execute_operation(self, job.instance_id, job.kind, job.service_id, job.plan_id, False, func,
+                                         *job.args)
+
+    def _submit_operation(self, instance_id: str, operation: str, service_id: str, plan_id: str, sync: bool,
+                          func: Callable, *func_args) -> Future:
+        if sync or self.node is None:
+            return self._execute_operation(instance_id, operation, service_id, plan_id, sync, func, *func_args)
+        return self._enqueue_operation(instance_id, operation, service_id, plan_id, func_args)
+
+    def _enqueue_operation(self, instance_id: str, operation: str, service_id: str, plan_id: str,
+                           func_args: tuple) -> Future:
+        self._record_operation(instance_id, operation, service_id, plan_id, QUEUED, func_args)
+        try:
+            return self.node.submit(instance_id, operation, service_id, plan_id, func_args, priority_of(operation))
+        except Exception as e:
+            self._fail_operation(instance_id, e)
+            raise
+
+    def _execute_operation(self, instance_id: str, operation: str, service_id: str, plan_id: str, sync: bool,
+                           func: Callable, *func_args) -> Future:
+        # The create's or modify's parameters, for the inventory, before func_args is wrapped for run_reporting
+        parameters = func_args[2] if operation != 'delete' else None
+        timeout = self._timeout(plan_id, sync)
+        token = CancellationToken(time() + timeout if timeout is not None else None)
+        reporter = None if sync else ProgressReporter(instance_id, self.executor.progress_sink)
+        func = self._profiled(self._bind_keywords(func, token, reporter), service_id, plan_id, operation)
+        if not sync:
+            # Recorded before submitting, so a worker's first progress event always finds the operation
+            self._record_operation(instance_id, operation, service_id, plan_id, QUEUED, func_args)
+            func, func_args = run_reporting, (reporter, func) + func_args
+        try:
+            future = self.executor.submit(service_id, func, *func_args, priority=priority_of(operation))
+        except Exception as e:
+            if not sync:
+                self._fail_operation(instance_id, e)
+            raise
+        self._observe(future, service_id, plan_id, operation)
+        self._track_inventory(future, instance_id, operation, service_id, plan_id, parameters)
+        if not sync:
+            future.add_done_callback(lambda f: self._finish_operation(instance_id, f))
+        if timeout is not None:
+            self.deadlines.watch(timeout, lambda: self._expire(future, token, timeout))
+        return future
+
+    @staticmethod
+    def _bind_keywords(func: Callable, token: CancellationToken, reporter: ProgressReporter) -> Callable:
+        # Service methods opt in to a cancellation token and a progress reporter by declaring the keywords
+        keywords = {}
+        target = implementation(func.func if isinstance(func, partial) else func)
+        if accepts_cancel_token(target):
+            keywords['cancel_token'] = token
+        if reporter is not None and accepts_progress(target):
+            keywords['progress'] = reporter
+        return partial(func, **keywords) if keywords else func
+
+    def _profiled(self, func: Callable, service_id: str, plan_id: str, operation: str,
+                  in_process: bool=False) -> Callable:
+        if self.profiler is None:
+            return func
+        # Calls made on a process pool send their profile back through the executor's event queue
+        sink = self.profiler.add if in_process or not self.executor.use_processes else None
+        return self.profiler.wrap(func, service_id, plan_id, operation, sink)
+
+    def _timeout(self, plan_id: str, sync: bool) -> float:
+        plan = self.plan_index[plan_id][1] if plan_id in self.plan_index else None
+        timeout = (plan.sync_timeout if sync else plan.async_timeout) if plan is not None else None
+        if timeout is None:
+            timeout = self.sync_timeout if sync else self.async_timeout
+        return timeout
+
+    def _expire(self, future: Future, token: CancellationToken, timeout: float):
+        if future.done():
+            return
+        log.warning("operation timed out after %ss, cancelling it", timeout)
+        # Abandoned first, so a worker that notices the token and gives up can't answer with its own error instead
+        self.executor.abandon(future, OperationTimeoutError("operation timed out after %ss" % timeout))
+        token.cancel()
+
+    def _observe(self, future: Future, service_id: str, plan_id: str, operation: str):
+        submitted = perf_counter()
+
+        def done(f):
+            outcome = 'cancelled' if f.cancelled() else 'failed' if f.exception() is not None else 'succeeded'
+            metrics.operation_duration.observe(perf_counter() - submitted, service_id, plan_id, operation, outcome)
+        future.add_done_callback(done)
+
+    def _track_inventory(self, future: Future, instance_id: str, operation: str, service_id: str, plan_id: str,
+                         parameters: dict=None):
+        # parameters are the create's, or the modify's to merge into the ones applied before
+        def done(f):
+            if f.cancelled() or f.exception() is not None:
+                return
+            if operation == 'delete':
+                self.inventory.remove_instance(instance_id)
+                return
+            applied = self.inventory.get_instance(instance_id) if operation == 'modify' else None
+            self.inventory.add_instance(instance_id, service_id, plan_id,
+                                        merge_parameters(applied[2] if applied is not None else None, parameters))
+        future.add_done_callback(done)
+
+    def _record_operation(self, instance_id: str, operation: str, service_id: str, plan_id: str, phase: str,
+                          func_args: tuple):
+        if self.journal is not None:
+            self.journal.start(instance_id, operation, service_id, plan_id, func_args)
+        self.operations.put(Operation(instance_id, operation, phase=phase))
+
+    def _update_operation(self, instance_id: str, state: str, description: str=None):
+        self.operations.update(instance_id, state, description)
+        if self.journal is not None:
+            self.journal.finish(instance_id, state, description)
+
+    def _finish_operation(self, instance_id: str, future: Future):
+        waiting = self.updates.waiting(instance_id)
+        if waiting is not None and not waiting.sync and not future.cancelled() and future.exception() is None:
+            # PATCHes merged into the update that runs next were answered 202 and poll this record too, it stays in
+            # progress until that update records its own outcome
+            return
+        if future.cancelled():
+            self._update_operation(instance_id, FAILED, "operation was cancelled")
+            return
+        e = future.exception()
+        if e is None:
+            self._update_operation(instance_id, SUCCEEDED)
         else:
-            self.async_ops[instance_id] = future
-            raise ProvisioningAsynchronously
+            log.error("async operation on instance %s failed: %r", instance_id, e)
+            self._fail_operation(instance_id, e)
+
+    def _fail_operation(self, instance_id: str, e: Exception):
+        self._update_operation(instance_id, FAILED, str(e) or e.__class__.__name__)
+
+    def _on_progress(self, instance_id: str, percent: float=None, phase: str=None, description: str=None):
+        self.operations.progress(instance_id, percent, phase, description)
+        if self.journal is not None:
+            self.journal.progress(instance_id, percent, phase, description)
 
     def _match_synchronicity(self, service_id: str, plan_id: str, accepts_incomplete: bool=False) -> bool:
         # accepts_incomplete=False and provisionable_synchronously=False -> CannotProvisionSynchronouslyException
@@ -81,7 +519,7 @@ class Broker:
         # accepts_incomplete=True  and provisionable_synchronously=True  -> sync
         if not service_id or not plan_id:
             return True
-        plan = self.services[service_id].plans[plan_id]
+        service, plan = self.resolve(service_id, plan_id)
         if not accepts_incomplete and not plan.provisionable_synchronously:
             raise CannotProvisionSynchronouslyError
         return plan.provisionable_synchronously
@@ -0,0 +1,78 @@
+from collections import OrderedDict
+from threading import Lock
+from time import time
+import metrics
+
+
+class MemoryCacheStore:
+    # LRU of key -> (expires, value) kept in this process only, so cached credentials never leave memory.  Keys are
+    # tuples, indexed by their first item so a group of them can be found without a scan.
+    def __init__(self, max_entries: int=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._groups = {}
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, expires: float, value):
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            self._groups.setdefault(key[0], set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._unindex(self._entries.popitem(last=False)[0])
+
+    def delete(self, key):
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._unindex(key)
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries)
+
+    def group(self, first) -> list:
+        # The keys whose first item is first
+        with self._lock:
+            return list(self._groups.get(first, ()))
+
+    def _unindex(self, key):
+        group = self._groups.get(key[0])
+        if group is not None:
+            group.discard(key)
+            if not group:
+                del self._groups[key[0]]
+
+
+class BindingCache:
+    # Credentials returned by BaseService.bind, keyed by (instance_id, binding_id, body_hash), body_hash being the
+    # request_hash of the bind's service, plan, app and parameters, so a bind with another body never gets them
+    def __init__(self, ttl: float=3600, store=None):
+        self.ttl = ttl
+        self.store = store if store is not None else MemoryCacheStore()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, instance_id: str, binding_id: str, body_hash: str):
+        entry = self.store.get((instance_id, binding_id, body_hash))
+        if entry is None or entry[0] < time():
+            self.misses += 1
+            metrics.binding_cache_requests.inc('miss')
+            return None
+        self.hits += 1
+        metrics.binding_cache_requests.inc('hit')
+        return entry[1]
+
+    def put(self, instance_id: str, binding_id: str, body_hash: str, credentials):
+        self.store.set((instance_id, binding_id, body_hash), time() + self.ttl, credentials)
+
+    def invalidate(self, instance_id: str, binding_id: str=None):
+        for key in self.store.group(instance_id):
+            if binding_id is None or key[1] == binding_id:
+                self.store.delete(key)
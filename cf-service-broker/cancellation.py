@@ -0,0 +1,90 @@
+from functools import lru_cache, partial
+from inspect import signature
+from threading import Condition, Event, Thread
+from time import monotonic, time
+from typing import Callable
+from exceptions import OperationCancelledError
+import heapq
+import logging
+
+logging.basicConfig(level=logging.DEBUG)
+log = logging.getLogger()
+
+
+class CancellationToken:
+    # Passed as cancel_token to service methods that declare it.  A token is cancelled once its deadline (wall clock
+    # time, so it means the same thing in an executor's worker process) has passed or cancel() has been called.
+    # cancel() is only seen by the process that called it, so workers in other processes rely on the deadline.
+    def __init__(self, deadline: float=None):
+        self.deadline = deadline
+        self._event = Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set() or (self.deadline is not None and time() >= self.deadline)
+
+    def raise_if_cancelled(self):
+        if self.cancelled:
+            raise OperationCancelledError
+
+    def __getstate__(self):
+        return {'deadline': self.deadline, 'cancelled': self._event.is_set()}
+
+    def __setstate__(self, state):
+        self.deadline = state['deadline']
+        self._event = Event()
+        if state['cancelled']:
+            self._event.set()
+
+
+@lru_cache(maxsize=1024)
+def _function_accepts(function, keyword: str) -> bool:
+    try:
+        return keyword in signature(function).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+def accepts_keyword(func: Callable, keyword: str) -> bool:
+    # Looked up on the underlying function so bound methods of every instance, and partials of them, share one
+    # cache entry
+    if isinstance(func, partial):
+        func = func.func
+    return _function_accepts(getattr(func, '__func__', func), keyword)
+
+
+def accepts_cancel_token(func: Callable) -> bool:
+    return accepts_keyword(func, 'cancel_token')
+
+
+class DeadlineWatcher:
+    # One daemon thread that calls each callback once its timeout has elapsed, instead of a Timer thread per
+    # operation.  Callbacks run on the watcher thread and must be quick.
+    def __init__(self):
+        self._deadlines = []
+        self._sequence = 0
+        self._condition = Condition()
+        self._thread = None
+
+    def watch(self, timeout: float, callback: Callable):
+        with self._condition:
+            self._sequence += 1
+            heapq.heappush(self._deadlines, (monotonic() + timeout, self._sequence, callback))
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name='broker-deadlines', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._deadlines or self._deadlines[0][0] > monotonic():
+                    self._condition.wait(self._deadlines[0][0] - monotonic() if self._deadlines else None)
+                _, _, callback = heapq.heappop(self._deadlines)
+            try:
+                callback()
+            except Exception:
+                log.exception("deadline callback failed")
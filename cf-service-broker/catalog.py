@@ -0,0 +1,19 @@
+import gzip
+import hashlib
+import codec
+
+
+class SerializedCatalog:
+    # The catalog encoded once into bytes, with a strong ETag per representation.  The gzipped body is built on
+    # first use and then kept alongside the plain one.
+    def __init__(self, catalog: dict):
+        self.body = codec.dumps(catalog)
+        self.etag = hashlib.sha1(self.body).hexdigest()
+        self.gzip_etag = self.etag + '-gzip'
+        self._gzip_body = None
+
+    @property
+    def gzip_body(self) -> bytes:
+        if self._gzip_body is None:
+            self._gzip_body = gzip.compress(self.body, mtime=0)
+        return self._gzip_body
@@ -0,0 +1,88 @@
+import inspect
+import json
+import os
+import logging
+import exceptions
+
+logging.basicConfig(level=logging.DEBUG)
+log = logging.getLogger()
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class StdlibCodec:
+    name = 'json'
+
+    @staticmethod
+    def dumps(obj) -> bytes:
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    @staticmethod
+    def loads(data: bytes):
+        return json.loads(data)
+
+
+class OrjsonCodec:
+    # orjson is optional; it encodes straight to compact bytes and decodes without an intermediate str
+    name = 'orjson'
+
+    @staticmethod
+    def dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+
+    @staticmethod
+    def loads(data: bytes):
+        return orjson.loads(data)
+
+
+CODECS = {StdlibCodec.name: StdlibCodec, OrjsonCodec.name: OrjsonCodec}
+codec = StdlibCodec
+
+
+def set_codec(name: str=None):
+    # None picks the fastest one installed.  Everything that encodes request or response bodies goes through
+    # dumps() and loads() below, so this can be switched at any time.
+    global codec
+    if name is None:
+        name = OrjsonCodec.name if orjson is not None else StdlibCodec.name
+    if name == OrjsonCodec.name and orjson is None:
+        raise ValueError("the orjson codec needs the orjson package")
+    codec = CODECS[name]
+    _encode_constants()
+
+
+def dumps(obj) -> bytes:
+    return codec.dumps(obj)
+
+
+def loads(data: bytes):
+    return codec.loads(data)
+
+
+EMPTY_OBJECT = b'{}'
+# exception class -> its msg, encoded
+_encoded_msgs = {}
+
+
+def _encode_constants():
+    _encoded_msgs.clear()
+    for _, cls in inspect.getmembers(exceptions, inspect.isclass):
+        if isinstance(getattr(cls, 'msg', None), dict):
+            _encoded_msgs[cls] = codec.dumps(cls.msg)
+
+
+def encoded_msg(e: Exception) -> bytes:
+    # Error bodies are constants on the exception classes, so they are encoded once.  Exceptions with a msg of
+    # their own (e.g. IdenticalRequestCompleted's result) are encoded each time.
+    if 'msg' not in getattr(e, '__dict__', {}):
+        encoded = _encoded_msgs.get(type(e))
+        if encoded is not None:
+            return encoded
+    msg = getattr(e, 'msg', None)
+    return dumps(msg) if msg else EMPTY_OBJECT
+
+
+set_codec(os.environ.get('BROKER_JSON_CODEC') or None)
@@ -41,4 +41,66 @@ class NoSuchEntityError(Exception):
 
 
 class AsyncOperationStateNotHandledError(Exception):
-    pass
\ No newline at end of file
+    pass
+
+
+class BrokerBusyError(Exception):
+    msg = {"error": "BrokerBusyError",
+           "description": "The broker has too many operations in progress, please retry later"}
+
+
+class ServiceBusyError(Exception):
+    msg = {"error": "ServiceBusyError",
+           "description": "This service has too many operations in progress, please retry later"}
+
+
+class IdenticalRequestCompleted(Exception):
+    # An identical request for the same instance or binding already completed, msg is the result it returned
+    def __init__(self, result):
+        super().__init__()
+        self.msg = result
+
+
+class UnknownServiceError(Exception):
+    msg = {"error": "UnknownServiceError",
+           "description": "service_id does not match any service in the catalog"}
+
+
+class UnknownPlanError(Exception):
+    msg = {"error": "UnknownPlanError",
+           "description": "plan_id does not match any plan of the requested service"}
+
+
+class OperationTimeoutError(Exception):
+    msg = {"error": "OperationTimeoutError",
+           "description": "The service did not complete the operation within the plan's time limit"}
+
+
+class OperationCancelledError(Exception):
+    msg = {"error": "OperationCancelledError",
+           "description": "The operation was cancelled"}
+
+
+class RateLimitedError(Exception):
+    # retry_after is the number of seconds the client should wait, sent as the Retry-After header
+    msg = {"error": "RateLimitedError",
+           "description": "Too many requests for this service, plan or organization, please retry later"}
+
+    def __init__(self, retry_after: float=1):
+        super().__init__()
+        self.retry_after = retry_after
+
+
+class OperationFailedError(Exception):
+    # An operation run by another broker node failed; its description is the message
+    msg = {"error": "OperationFailedError",
+           "description": "The operation failed"}
+
+
+class InvalidRequestError(Exception):
+    # problems lists everything wrong with the request body, all found in one pass over it
+    def __init__(self, problems):
+        super().__init__("; ".join(problems))
+        self.problems = problems
+        self.msg = {"error": "InvalidRequestError",
+                    "description": "invalid request: " + "; ".join(problems)}
@@ -0,0 +1,246 @@
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from itertools import count
+from queue import SimpleQueue
+from threading import Lock, Thread
+from time import time
+from typing import Callable, Dict
+from exceptions import BrokerBusyError, ServiceBusyError, OperationCancelledError
+from profiling import ProfileSample
+import concurrent.futures
+import heapq
+import json
+import metrics
+import multiprocessing
+import os
+import progress
+import logging
+
+logging.basicConfig(level=logging.DEBUG)
+log = logging.getLogger()
+
+# Queue priorities for submit(), lower runs first
+URGENT = 0
+NORMAL = 1
+
+
+def _timed_call(func: Callable, *func_args):
+    # Runs in the worker.  Wall clock time, since the worker may be another process.
+    return time(), func(*func_args)
+
+
+class BrokerExecutor:
+    # One long-lived pool shared by every service operation the broker runs.  max_pending bounds the number of
+    # operations queued or running across the whole broker, service_limits caps concurrent operations per service guid.
+    # Queued operations are kept in a priority queue in front of the pool, which never has more than max_workers.
+    def __init__(self, max_workers: int=4, max_pending: int=64, service_limits: Dict[str, int]=None,
+                 use_processes: bool=True):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.service_limits = service_limits or {}
+        self.use_processes = use_processes
+        self.pending = 0
+        self.pending_by_service = {}
+        # outer future -> (pool future, service_id) for work that hasn't finished or been abandoned
+        self._submitted = {}
+        # pool futures of abandoned operations that are still occupying a worker
+        self.stuck = set()
+        # (priority, sequence, outer future, func, func_args, submitted) waiting for a worker, and the pool futures
+        # handed to the current pool that haven't finished
+        self._queue = []
+        self._sequence = count()
+        self._dispatched = set()
+        self._lock = Lock()
+        # Progress events from the workers, handed to each listener(instance_id, percent, phase, description) on
+        # one dispatcher thread
+        self.events = multiprocessing.Queue() if use_processes else SimpleQueue()
+        self.listeners = []
+        # Profiles of service calls sent back by process pool workers travel the same way, to each profile_listener
+        self.profile_listeners = []
+        self.pool = self._make_pool()
+        self._dispatcher = Thread(target=self._dispatch, name='broker-progress', daemon=True)
+        self._dispatcher.start()
+
+    def _make_pool(self):
+        if self.use_processes:
+            return ProcessPoolExecutor(max_workers=self.max_workers, initializer=progress.init_worker,
+                                       initargs=(self.events,))
+        return ThreadPoolExecutor(max_workers=self.max_workers)
+
+    @property
+    def progress_sink(self) -> Callable:
+        # What a ProgressReporter for work on this executor should send to; None means the worker's own queue
+        return None if self.use_processes else self.events.put
+
+    def _dispatch(self):
+        for event in iter(self.events.get, None):
+            if isinstance(event, ProfileSample):
+                for listener in list(self.profile_listeners):
+                    try:
+                        listener(event)
+                    except Exception:
+                        log.exception("profile listener failed")
+                continue
+            for listener in list(self.listeners):
+                try:
+                    listener(*event)
+                except Exception:
+                    log.exception("progress listener failed")
+
+    def submit(self, service_id: str, func: Callable, *func_args, priority: int=NORMAL) -> Future:
+        # Work waits in the broker's own queue, lowest priority first, and is only handed to the pool when a worker
+        # is free, so e.g. deletes submitted under load overtake creates that are still queued
+        self.acquire(service_id)
+        future = Future()
+        future.add_done_callback(lambda f: f.cancelled() and self._cancel(f))
+        with self._lock:
+            self._submitted[future] = (None, service_id)
+            heapq.heappush(self._queue, (priority, next(self._sequence), future, func, func_args, time()))
+        self._feed()
+        return future
+
+    def _feed(self):
+        while True:
+            with self._lock:
+                if not self._queue or len(self._dispatched) >= self.max_workers:
+                    return
+                _, _, future, func, func_args, submitted = heapq.heappop(self._queue)
+                entry = self._submitted.get(future)
+                if entry is None:
+                    # Abandoned or cancelled while queued, its slot has already been released
+                    continue
+                service_id = entry[1]
+                try:
+                    inner = self.pool.submit(_timed_call, func, *func_args)
+                except Exception as e:
+                    del self._submitted[future]
+                    self._release(service_id)
+                    error = e
+                else:
+                    error = None
+                    self._submitted[future] = (inner, service_id)
+                    self._dispatched.add(inner)
+            if error is not None:
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(error)
+                continue
+            inner.add_done_callback(partial(self._done, future, service_id, submitted))
+
+    def _done(self, future: Future, service_id: str, submitted: float, f: Future):
+        with self._lock:
+            self._dispatched.discard(f)
+            self.stuck.discard(f)
+            # Work that was abandoned or cancelled has already been released and its caller answered
+            owned = self._submitted.pop(future, None) is not None
+            if owned:
+                self._release(service_id)
+            finished = not owned or future.done() or future.running() or not future.set_running_or_notify_cancel()
+        self._feed()
+        if finished:
+            return
+        if f.cancelled():
+            future.set_exception(OperationCancelledError())
+        elif f.exception() is not None:
+            future.set_exception(f.exception())
+        else:
+            # Callers see func's own result; the worker's start time is unwrapped here to measure queueing
+            started, result = f.result()
+            metrics.executor_queue_wait.observe(max(0.0, started - submitted))
+            future.set_result(result)
+
+    def _cancel(self, future: Future):
+        with self._lock:
+            entry = self._submitted.pop(future, None)
+            if entry is None:
+                return
+            inner, service_id = entry
+            self._release(service_id)
+        if inner is not None:
+            inner.cancel()
+
+    def abandon(self, future: Future, exception: Exception):
+        # Fails a submitted operation now with exception.  If it is still queued it never runs; if it is running its
+        # worker is left to finish but no longer counts against the admission limits.  When every worker of a process
+        # pool is held by abandoned work the pool is replaced and its processes terminated.
+        with self._lock:
+            entry = self._submitted.pop(future, None)
+            if entry is None:
+                return
+            inner, service_id = entry
+            self._release(service_id)
+        # Outside the lock, since cancelling runs the pool future's done callback
+        if inner is not None and not inner.cancel():
+            with self._lock:
+                if inner in self._dispatched:
+                    self.stuck.add(inner)
+        with self._lock:
+            if future.done() or future.running() or not future.set_running_or_notify_cancel():
+                return
+            recycle = self.use_processes and len(self.stuck) >= self.max_workers
+        if recycle:
+            self._recycle()
+        future.set_exception(exception)
+
+    def _recycle(self):
+        log.warning("all %d executor workers are held by abandoned operations, replacing the process pool",
+                    self.max_workers)
+        with self._lock:
+            old = self.pool
+            self.pool = self._make_pool()
+            self.stuck = set()
+            self._dispatched = set()
+        # ProcessPoolExecutor has no public way to stop a running call, so terminate the old workers directly.
+        # Work still queued in the old pool is cancelled and its callers see OperationCancelledError.
+        processes = list((getattr(old, '_processes', None) or {}).values())
+        old.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            process.terminate()
+        self._feed()
+
+    def acquire(self, service_id: str):
+        # Reserves a slot without submitting to the pool, for work that runs elsewhere (e.g. coroutines)
+        with self._lock:
+            if self.pending >= self.max_pending:
+                raise BrokerBusyError
+            limit = self.service_limits.get(service_id)
+            in_flight = self.pending_by_service.get(service_id, 0)
+            if limit is not None and in_flight >= limit:
+                raise ServiceBusyError
+            self.pending += 1
+            self.pending_by_service[service_id] = in_flight + 1
+
+    def release(self, service_id: str):
+        with self._lock:
+            self._release(service_id)
+
+    def _release(self, service_id: str):
+        self.pending -= 1
+        self.pending_by_service[service_id] -= 1
+
+    def shutdown(self, wait: bool=True):
+        log.info("shutting down broker executor")
+        while wait:
+            # Let work still in the broker's queue through to the pool before closing it
+            with self._lock:
+                dispatched = list(self._dispatched)
+            if not dispatched:
+                break
+            concurrent.futures.wait(dispatched)
+        self.pool.shutdown(wait=wait)
+        self.events.put(None)
+        # A daemon thread still blocked in events.get() when the interpreter exits dies with a traceback
+        self._dispatcher.join(timeout=5)
+
+
+def executor_from_environment() -> BrokerExecutor:
+    # BROKER_MAX_WORKERS and BROKER_MAX_PENDING size the pool and bound the operations queued or running,
+    # BROKER_SERVICE_LIMITS is a JSON object of service guid -> concurrent operations, and BROKER_EXECUTOR is
+    # "processes" (the default) or "threads"
+    kind = os.environ.get('BROKER_EXECUTOR') or 'processes'
+    if kind not in ('processes', 'threads'):
+        raise ValueError("BROKER_EXECUTOR must be processes or threads, not %r" % kind)
+    service_limits = json.loads(os.environ.get('BROKER_SERVICE_LIMITS') or '{}')
+    return BrokerExecutor(max_workers=int(os.environ.get('BROKER_MAX_WORKERS') or 4),
+                          max_pending=int(os.environ.get('BROKER_MAX_PENDING') or 64),
+                          service_limits={k: int(v) for k, v in service_limits.items()},
+                          use_processes=kind == 'processes')
@@ -0,0 +1,91 @@
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Lock
+from time import time
+import hashlib
+import json
+
+
+def request_hash(*values) -> str:
+    return hashlib.sha256(json.dumps(values, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class TrackedRequest:
+    def __init__(self, body_hash: str):
+        self.body_hash = body_hash
+        # Resolved with the service's result, so duplicates can wait on it or reuse it once done
+        self.future = Future()
+        self.future.set_running_or_notify_cancel()
+        self.asynchronous = False
+        self.completed = None
+
+
+class RequestTracker:
+    # Remembers requests for an instance or binding key while they are in flight and for ttl seconds after they
+    # succeed, so that retries can be coalesced with the original.  Failed requests are forgotten straight away so
+    # that a retry runs again.  At most max_entries keys are kept, oldest first out.
+    def __init__(self, ttl: float=600, max_entries: int=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._requests = OrderedDict()
+        # instance_id -> keys of the instance and its bindings, for forget_instance
+        self._by_instance = {}
+        self._lock = Lock()
+
+    def begin(self, key: tuple, body_hash: str) -> (TrackedRequest, bool):
+        # Returns the request to use for key and whether the caller owns it (i.e. must run it)
+        now = time()
+        with self._lock:
+            request = self._requests.get(key)
+            if request is not None and not (request.completed is not None and request.completed < now - self.ttl):
+                return request, False
+            request = self._requests[key] = TrackedRequest(body_hash)
+            self._requests.move_to_end(key)
+            self._by_instance.setdefault(key[1], set()).add(key)
+            while len(self._requests) > self.max_entries:
+                self._unindex(self._requests.popitem(last=False)[0])
+            return request, True
+
+    def track(self, key: tuple, request: TrackedRequest, future: Future):
+        def done(f):
+            if f.cancelled():
+                self.fail(key, request, Exception("operation was cancelled"))
+            elif f.exception() is not None:
+                self.fail(key, request, f.exception())
+            else:
+                self.succeed(key, request, f.result())
+        future.add_done_callback(done)
+
+    def succeed(self, key: tuple, request: TrackedRequest, result):
+        request.completed = time()
+        request.future.set_result(result)
+
+    def fail(self, key: tuple, request: TrackedRequest, exception: BaseException):
+        with self._lock:
+            if self._requests.get(key) is request:
+                del self._requests[key]
+                self._unindex(key)
+        request.future.set_exception(exception)
+
+    def pending(self, key: tuple) -> bool:
+        # Whether a request for key is still running
+        request = self._requests.get(key)
+        return request is not None and request.completed is None
+
+    def forget(self, key: tuple):
+        with self._lock:
+            if self._requests.pop(key, None) is not None:
+                self._unindex(key)
+
+    def forget_instance(self, instance_id: str):
+        # Drops the instance and all of its bindings
+        with self._lock:
+            for key in self._by_instance.pop(instance_id, ()):
+                self._requests.pop(key, None)
+
+    def _unindex(self, key: tuple):
+        keys = self._by_instance.get(key[1])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_instance[key[1]]
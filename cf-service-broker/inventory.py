@@ -0,0 +1,199 @@
+from bisect import bisect_left, bisect_right, insort
+from threading import Lock, local
+from time import time
+from typing import List, Tuple
+import codec
+import os
+import sqlite3
+
+
+class MemoryInventory:
+    # The instances and bindings the broker has successfully created and not yet deleted, with their service and
+    # plan.  Pages come back sorted by instance_id (and binding_id), so the reconciler can diff them against a
+    # service's own listing in one pass.  A sorted list of keys per service keeps paging O(log n + limit).  Each
+    # instance also keeps the parameters last applied to it, for the broker to diff updates against.
+    # Starts out empty in every process, so it can't tell the reconciler what is safe to delete.
+    persistent = False
+
+    def __init__(self):
+        # instance_id -> (service_id, plan_id, parameters), and service_id -> sorted instance_ids
+        self._instances = {}
+        self._instance_ids = {}
+        # (instance_id, binding_id) -> (service_id, plan_id), and service_id -> sorted (instance_id, binding_id)
+        self._bindings = {}
+        self._binding_keys = {}
+        self._seeded = False
+        self._lock = Lock()
+
+    def add_instance(self, instance_id: str, service_id: str, plan_id: str, parameters: dict=None):
+        # parameters=None keeps the ones already recorded
+        with self._lock:
+            previous = self._instances.get(instance_id)
+            if previous is not None and previous[0] != service_id:
+                self._discard(self._instance_ids, previous[0], instance_id)
+            if previous is None or previous[0] != service_id:
+                insort(self._instance_ids.setdefault(service_id, []), instance_id)
+            if parameters is None and previous is not None:
+                parameters = previous[2]
+            self._instances[instance_id] = (service_id, plan_id, parameters)
+
+    def get_instance(self, instance_id: str) -> Tuple[str, str, dict]:
+        # (service_id, plan_id, parameters) of the instance, parameters None if they were never recorded
+        return self._instances.get(instance_id)
+
+    def remove_instance(self, instance_id: str):
+        # Drops the instance's bindings too
+        with self._lock:
+            entry = self._instances.pop(instance_id, None)
+            if entry is None:
+                return
+            self._discard(self._instance_ids, entry[0], instance_id)
+            keys = self._binding_keys.get(entry[0], [])
+            start = bisect_left(keys, (instance_id,))
+            end = start
+            while end < len(keys) and keys[end][0] == instance_id:
+                self._bindings.pop(keys[end], None)
+                end += 1
+            del keys[start:end]
+
+    def add_binding(self, instance_id: str, binding_id: str, service_id: str, plan_id: str):
+        key = (instance_id, binding_id)
+        with self._lock:
+            if key not in self._bindings:
+                insort(self._binding_keys.setdefault(service_id, []), key)
+            self._bindings[key] = (service_id, plan_id)
+
+    def remove_binding(self, instance_id: str, binding_id: str):
+        key = (instance_id, binding_id)
+        with self._lock:
+            entry = self._bindings.pop(key, None)
+            if entry is not None:
+                self._discard(self._binding_keys, entry[0], key)
+
+    def seeded(self) -> bool:
+        # Whether it was ever filled in from the services' own listings, see Reconciler.seed
+        return self._seeded
+
+    def mark_seeded(self):
+        self._seeded = True
+
+    def has_instance(self, instance_id: str) -> bool:
+        return instance_id in self._instances
+
+    def has_binding(self, instance_id: str, binding_id: str) -> bool:
+        return (instance_id, binding_id) in self._bindings
+
+    def instances(self, service_id: str, after: str=None, limit: int=1000) -> List[Tuple[str, str]]:
+        # (instance_id, plan_id) of the service's instances with ids after after, in order
+        with self._lock:
+            ids = self._instance_ids.get(service_id, [])
+            start = bisect_right(ids, after) if after is not None else 0
+            return [(i, self._instances[i][1]) for i in ids[start:start + limit]]
+
+    def bindings(self, service_id: str, after: tuple=None, limit: int=1000) -> List[Tuple[str, str, str]]:
+        # (instance_id, binding_id, plan_id) of the service's bindings with keys after after, in order
+        with self._lock:
+            keys = self._binding_keys.get(service_id, [])
+            start = bisect_right(keys, tuple(after)) if after is not None else 0
+            return [key + (self._bindings[key][1],) for key in keys[start:start + limit]]
+
+    @staticmethod
+    def _discard(index: dict, service_id: str, key):
+        keys = index.get(service_id, [])
+        position = bisect_left(keys, key)
+        if position < len(keys) and keys[position] == key:
+            del keys[position]
+
+
+class SQLiteInventory(MemoryInventory):
+    # Shares the inventory between broker processes and nodes, and keeps it across restarts.  Pages are range scans
+    # of the (service_id, instance_id[, binding_id]) indexes.
+    persistent = True
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self._local = local()
+        with self._connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS instances ("
+                         "instance_id TEXT PRIMARY KEY, service_id TEXT NOT NULL, plan_id TEXT NOT NULL, "
+                         "parameters TEXT)")
+            # Databases created before updates were diffed lack the parameters column
+            if 'parameters' not in {row[1] for row in conn.execute("PRAGMA table_info(instances)")}:
+                conn.execute("ALTER TABLE instances ADD COLUMN parameters TEXT")
+            conn.execute("CREATE INDEX IF NOT EXISTS instances_service ON instances (service_id, instance_id)")
+            conn.execute("CREATE TABLE IF NOT EXISTS bindings ("
+                         "instance_id TEXT NOT NULL, binding_id TEXT NOT NULL, service_id TEXT NOT NULL, "
+                         "plan_id TEXT NOT NULL, PRIMARY KEY (instance_id, binding_id))")
+            conn.execute("CREATE INDEX IF NOT EXISTS bindings_service ON bindings (service_id, instance_id, binding_id)")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def add_instance(self, instance_id: str, service_id: str, plan_id: str, parameters: dict=None):
+        encoded = codec.dumps(parameters).decode() if parameters is not None else None
+        with self._connection() as conn:
+            conn.execute("INSERT INTO instances VALUES (?, ?, ?, ?) ON CONFLICT (instance_id) DO UPDATE SET "
+                         "service_id = excluded.service_id, plan_id = excluded.plan_id, "
+                         "parameters = COALESCE(excluded.parameters, parameters)",
+                         (instance_id, service_id, plan_id, encoded))
+
+    def get_instance(self, instance_id: str) -> Tuple[str, str, dict]:
+        row = self._connection().execute("SELECT service_id, plan_id, parameters FROM instances "
+                                         "WHERE instance_id = ?", (instance_id,)).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1], codec.loads(row[2]) if row[2] is not None else None
+
+    def remove_instance(self, instance_id: str):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM bindings WHERE instance_id = ?", (instance_id,))
+            conn.execute("DELETE FROM instances WHERE instance_id = ?", (instance_id,))
+
+    def add_binding(self, instance_id: str, binding_id: str, service_id: str, plan_id: str):
+        with self._connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO bindings VALUES (?, ?, ?, ?)",
+                         (instance_id, binding_id, service_id, plan_id))
+
+    def remove_binding(self, instance_id: str, binding_id: str):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM bindings WHERE instance_id = ? AND binding_id = ?", (instance_id, binding_id))
+
+    def seeded(self) -> bool:
+        return self._connection().execute("SELECT 1 FROM meta WHERE key = 'seeded'").fetchone() is not None
+
+    def mark_seeded(self):
+        with self._connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('seeded', ?)", (str(time()),))
+
+    def has_instance(self, instance_id: str) -> bool:
+        return self._connection().execute("SELECT 1 FROM instances WHERE instance_id = ?",
+                                          (instance_id,)).fetchone() is not None
+
+    def has_binding(self, instance_id: str, binding_id: str) -> bool:
+        return self._connection().execute("SELECT 1 FROM bindings WHERE instance_id = ? AND binding_id = ?",
+                                          (instance_id, binding_id)).fetchone() is not None
+
+    def instances(self, service_id: str, after: str=None, limit: int=1000) -> List[Tuple[str, str]]:
+        return self._connection().execute("SELECT instance_id, plan_id FROM instances "
+                                          "WHERE service_id = ? AND instance_id > ? ORDER BY instance_id LIMIT ?",
+                                          (service_id, after if after is not None else '', limit)).fetchall()
+
+    def bindings(self, service_id: str, after: tuple=None, limit: int=1000) -> List[Tuple[str, str, str]]:
+        instance_id, binding_id = after if after is not None else ('', '')
+        return self._connection().execute("SELECT instance_id, binding_id, plan_id FROM bindings "
+                                          "WHERE service_id = ? AND (instance_id, binding_id) > (?, ?) "
+                                          "ORDER BY instance_id, binding_id LIMIT ?",
+                                          (service_id, instance_id, binding_id, limit)).fetchall()
+
+
+def inventory_from_environment() -> MemoryInventory:
+    # BROKER_INVENTORY_DB names a SQLite database, to share the inventory between processes or broker nodes
+    path = os.environ.get('BROKER_INVENTORY_DB')
+    return SQLiteInventory(path) if path else MemoryInventory()
@@ -0,0 +1,187 @@
+from concurrent.futures import Future
+from threading import Condition, Thread
+from time import time
+from opstore import Operation, IN_PROGRESS
+import json
+import os
+import logging
+
+logging.basicConfig(level=logging.DEBUG)
+log = logging.getLogger()
+
+
+class OperationJournal:
+    # Append-only log of async operation records, one JSON object per line:
+    #   {"t": "start", "instance_id", "kind", "service_id", "plan_id", "args", "started"}
+    #   {"t": "progress", "instance_id", "percent", "phase", "description", "updated"}
+    #   {"t": "finish", "instance_id", "state", "description", "updated"}
+    #   {"t": "op", ...}   the merged state of one operation, as written by compaction
+    # Records are written by one thread, which takes everything appended while it was busy with the previous write
+    # and commits it with a single fsync (group commit).  The merged state of every operation is kept in memory, so
+    # compaction is a rewrite of that state, done once enough records have been written since the last one.
+    def __init__(self, path: str, retention: float=3600, compact_min: int=10000):
+        self.path = path
+        # Finished operations are dropped by compaction this many seconds after they finished
+        self.retention = retention
+        self.compact_min = compact_min
+        self.entries = {}
+        self.written = 0
+        self._pending = []
+        self._closed = False
+        self._condition = Condition()
+        self._replay()
+        self._compact()
+        self._file = open(path, 'ab')
+        self._thread = Thread(target=self._run, name='broker-journal', daemon=True)
+        self._thread.start()
+
+    def start(self, instance_id: str, kind: str, service_id: str, plan_id: str, args: tuple=None,
+              wait: bool=True):
+        # Waits by default until the record is on disk, so an operation the client was told about survives a crash
+        record = {"t": "start", "instance_id": instance_id, "kind": kind, "service_id": service_id,
+                  "plan_id": plan_id, "args": list(args) if args is not None else None, "started": time()}
+        try:
+            line = self._encode(record)
+        except (TypeError, ValueError):
+            # Arguments that can't be recorded just mean the operation can't be re-run after a restart
+            record["args"] = None
+            line = self._encode(record)
+        self._append(record, line, wait)
+
+    def progress(self, instance_id: str, percent: float=None, phase: str=None, description: str=None):
+        record = {"t": "progress", "instance_id": instance_id, "percent": percent, "phase": phase,
+                  "description": description, "updated": time()}
+        self._append(record, self._encode(record), False)
+
+    def finish(self, instance_id: str, state: str, description: str=None, wait: bool=False):
+        record = {"t": "finish", "instance_id": instance_id, "state": state, "description": description,
+                  "updated": time()}
+        self._append(record, self._encode(record), wait)
+
+    def committed(self) -> Future:
+        # Resolves once every record appended so far is on disk, for callers that appended with wait=False because
+        # they can't block, like the coroutines of an AsyncBroker
+        done = Future()
+        with self._condition:
+            if self._closed:
+                done.set_result(None)
+                return done
+            self._pending.append((None, b'', done))
+            self._condition.notify()
+        return done
+
+    def operations(self):
+        # (Operation, entry) for every operation the journal knows about, entry being the merged record
+        for entry in list(self.entries.values()):
+            yield (Operation(entry['instance_id'], entry['kind'], entry['state'], entry.get('description'),
+                             entry['started'], entry['updated'], entry.get('percent'), entry.get('phase')), entry)
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+        self._file.close()
+
+    @staticmethod
+    def _encode(record: dict) -> bytes:
+        return json.dumps(record, separators=(',', ':')).encode('utf-8') + b'\n'
+
+    def _append(self, record: dict, line: bytes, wait: bool):
+        done = Future() if wait else None
+        with self._condition:
+            if self._closed:
+                # Operations still finishing after shutdown; replay treats them as interrupted
+                log.warning("operation journal is closed, dropping %s record for %s", record["t"],
+                            record["instance_id"])
+                return
+            self._pending.append((record, line, done))
+            self._condition.notify()
+        if done is not None:
+            done.result()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                batch, self._pending = self._pending, []
+            if not batch:
+                return
+            try:
+                self._file.write(b''.join(line for _, line, _ in batch))
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            except OSError as e:
+                log.exception("could not write %d records to the operation journal", len(batch))
+                for _, _, done in batch:
+                    if done is not None:
+                        done.set_exception(e)
+                continue
+            for record, _, done in batch:
+                if record is not None:
+                    self._apply(record)
+                    self.written += 1
+                if done is not None:
+                    done.set_result(None)
+            if self.written >= max(self.compact_min, 2 * len(self.entries)):
+                self._file.close()
+                self._compact()
+                self._file = open(self.path, 'ab')
+
+    def _apply(self, record: dict):
+        kind = record.pop("t")
+        if kind in ("start", "op"):
+            record.setdefault("state", IN_PROGRESS)
+            record.setdefault("updated", record["started"])
+            self.entries[record["instance_id"]] = record
+            return
+        entry = self.entries.get(record["instance_id"])
+        if entry is None:
+            return
+        if kind == "progress":
+            if entry["state"] != IN_PROGRESS:
+                return
+            for field in ("percent", "phase", "description"):
+                if record[field] is not None:
+                    entry[field] = record[field]
+        else:
+            entry["state"] = record["state"]
+            entry["description"] = record["description"]
+        entry["updated"] = record["updated"]
+
+    def _replay(self):
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            for number, line in enumerate(f, 1):
+                try:
+                    self._apply(json.loads(line))
+                except (ValueError, KeyError):
+                    # A torn write at the end of the file, from a crash part way through a batch
+                    log.warning("ignoring unreadable record %d of operation journal %s", number, self.path)
+        log.info("replayed %d operations from journal %s", len(self.entries), self.path)
+
+    def _compact(self):
+        cutoff = time() - self.retention
+        for instance_id in [i for i, e in self.entries.items() if e["state"] != IN_PROGRESS and e["updated"] < cutoff]:
+            del self.entries[instance_id]
+        temporary = self.path + '.compact'
+        with open(temporary, 'wb') as f:
+            f.write(b''.join(self._encode(dict(entry, t="op")) for entry in self.entries.values()))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path)
+        directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        self.written = 0
+
+
+def journal_from_environment() -> OperationJournal:
+    path = os.environ.get('BROKER_JOURNAL')
+    return OperationJournal(path) if path else None
@@ -0,0 +1,130 @@
+from bisect import bisect_left
+from threading import Lock
+from typing import Callable, Iterable
+
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                             for k, v in pairs)
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str]=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = Lock()
+
+    def inc(self, *labelvalues, amount: float=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for labelvalues, value in sorted(values.items()):
+            yield self.name + _format_labels(self.labelnames, labelvalues), value
+
+
+class Gauge:
+    # Values are read from callback when the metrics are rendered, so nothing is paid on the request path
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, callback: Callable, labelnames: Iterable[str]=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+
+    def samples(self):
+        value = self.callback()
+        if not self.labelnames:
+            yield self.name, value
+            return
+        for labelvalues, v in sorted(value.items()):
+            if not isinstance(labelvalues, tuple):
+                labelvalues = (labelvalues,)
+            yield self.name + _format_labels(self.labelnames, labelvalues), v
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str]=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # labelvalues -> [per-bucket counts..., +Inf count, sum]
+        self._values = {}
+        self._lock = Lock()
+
+    def observe(self, value: float, *labelvalues):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            v = self._values.get(labelvalues)
+            if v is None:
+                v = self._values[labelvalues] = [0] * (len(self.buckets) + 2)
+            v[i] += 1
+            v[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = {k: list(v) for k, v in self._values.items()}
+        for labelvalues, v in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), v):
+                cumulative += count
+                yield (self.name + '_bucket' + _format_labels(self.labelnames, labelvalues, (('le', bound),)),
+                       cumulative)
+            yield self.name + '_sum' + _format_labels(self.labelnames, labelvalues), v[-1]
+            yield self.name + '_count' + _format_labels(self.labelnames, labelvalues), cumulative
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def unregister(self, name: str):
+        self.metrics.pop(name, None)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.append('# HELP %s %s' % (metric.name, metric.documentation))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            for name, value in metric.samples():
+                lines.append('%s %s' % (name, repr(float(value))))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+http_request_duration = registry.register(Histogram(
+    'broker_http_request_duration_seconds', 'Time spent handling broker API requests',
+    ('route', 'method', 'status')))
+auth_duration = registry.register(Histogram(
+    'broker_auth_duration_seconds', 'Time spent checking request credentials'))
+json_decode_duration = registry.register(Histogram(
+    'broker_json_decode_duration_seconds', 'Time spent decoding JSON request bodies'))
+operation_duration = registry.register(Histogram(
+    'broker_operation_duration_seconds', 'Time from submitting a service operation to its completion',
+    ('service', 'plan', 'operation', 'outcome')))
+executor_queue_wait = registry.register(Histogram(
+    'broker_executor_queue_wait_seconds', 'Time service operations wait for an executor worker'))
+errors = registry.register(Counter(
+    'broker_errors_total', 'Broker errors by exception class', ('exception',)))
+binding_cache_requests = registry.register(Counter(
+    'broker_binding_cache_requests_total', 'Binding credential cache lookups by result', ('result',)))
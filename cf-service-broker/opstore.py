@@ -0,0 +1,189 @@
+from threading import Lock, local
+from time import time
+import os
+import sqlite3
+import logging
+
+logging.basicConfig(level=logging.DEBUG)
+log = logging.getLogger()
+
+IN_PROGRESS = "in progress"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+STATES = (IN_PROGRESS, SUCCEEDED, FAILED)
+# In Operation constructor order
+COLUMNS = "instance_id, kind, state, description, started, updated, percent, phase"
+
+
+class Operation:
+    def __init__(self, instance_id, kind, state=IN_PROGRESS, description=None, started=None, updated=None,
+                 percent=None, phase=None):
+        self.instance_id = instance_id
+        self.kind = kind
+        self.state = state
+        self.description = description
+        self.started = started if started is not None else time()
+        self.updated = updated if updated is not None else self.started
+        # Reported by the service while the operation is in progress; phase is "queued" until a worker picks it up
+        self.percent = percent
+        self.phase = phase
+
+    @property
+    def finished(self):
+        return self.state != IN_PROGRESS
+
+    def as_dict(self):
+        d = {"state": self.state}
+        description = self.description
+        if not description and not self.finished and self.phase:
+            description = self.phase if self.percent is None else "%s (%d%%)" % (self.phase, self.percent)
+        if description:
+            d["description"] = description
+        return d
+
+    def as_event(self):
+        d = self.as_dict()
+        d.update(percent=self.percent, phase=self.phase, updated=self.updated)
+        return d
+
+
+class MemoryOperationStore:
+    # Operations live in a dict keyed by instance_id.  Finished operations are dropped ttl seconds after their
+    # last update; the sweep runs at most once every expire_interval seconds so put() stays O(1) on average.
+    def __init__(self, ttl: float=3600, expire_interval: float=60):
+        self.ttl = ttl
+        self.expire_interval = expire_interval
+        self._ops = {}
+        self._lock = Lock()
+        self._last_expiry = time()
+
+    def put(self, op: Operation):
+        with self._lock:
+            self._ops[op.instance_id] = op
+        self._maybe_expire()
+
+    def get(self, instance_id: str) -> Operation:
+        return self._ops.get(instance_id)
+
+    def get_many(self, instance_ids) -> dict:
+        return {i: self._ops[i] for i in instance_ids if i in self._ops}
+
+    def update(self, instance_id: str, state: str, description: str=None):
+        with self._lock:
+            op = self._ops.get(instance_id)
+            if op is None:
+                return
+            op.state = state
+            op.description = description
+            op.updated = time()
+
+    def progress(self, instance_id: str, percent: float=None, phase: str=None, description: str=None):
+        # Only fields that are given change, and only while the operation is in progress, so a late event from
+        # a worker can't overwrite the outcome
+        with self._lock:
+            op = self._ops.get(instance_id)
+            if op is None or op.finished:
+                return
+            if percent is not None:
+                op.percent = percent
+            if phase is not None:
+                op.phase = phase
+            if description is not None:
+                op.description = description
+            op.updated = time()
+
+    def count_by_state(self) -> dict:
+        counts = {}
+        for op in list(self._ops.values()):
+            counts[op.state] = counts.get(op.state, 0) + 1
+        return counts
+
+    def expire(self, now: float=None):
+        cutoff = (now if now is not None else time()) - self.ttl
+        with self._lock:
+            for instance_id in [i for i, op in self._ops.items() if op.finished and op.updated < cutoff]:
+                del self._ops[instance_id]
+            self._last_expiry = time()
+
+    def _maybe_expire(self):
+        if time() - self._last_expiry >= self.expire_interval:
+            self.expire()
+
+
+class SQLiteOperationStore(MemoryOperationStore):
+    # Shares operation state between broker processes (e.g. gunicorn workers) and across restarts.  Lookups go
+    # through the instance_id primary key; expiry uses the (state, updated) index.
+    def __init__(self, path: str, ttl: float=3600, expire_interval: float=60):
+        super().__init__(ttl, expire_interval)
+        self.path = path
+        self._local = local()
+        # The threads of one process take turns writing here rather than in SQLite's busy handler, which sleeps
+        # between retries and left the slowest requests waiting far longer than the writes ahead of them took
+        self._write_lock = Lock()
+        with self._connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS operations ("
+                         "instance_id TEXT PRIMARY KEY, kind TEXT NOT NULL, state TEXT NOT NULL, description TEXT, "
+                         "started REAL NOT NULL, updated REAL NOT NULL, percent REAL, phase TEXT)")
+            # Databases created before progress reporting lack the last two columns
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(operations)")}
+            for column, kind in (('percent', 'REAL'), ('phase', 'TEXT')):
+                if column not in columns:
+                    conn.execute("ALTER TABLE operations ADD COLUMN %s %s" % (column, kind))
+            conn.execute("CREATE INDEX IF NOT EXISTS operations_state_updated ON operations (state, updated)")
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def put(self, op: Operation):
+        with self._write_lock, self._connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO operations VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                         (op.instance_id, op.kind, op.state, op.description, op.started, op.updated, op.percent,
+                          op.phase))
+        self._maybe_expire()
+
+    def get(self, instance_id: str) -> Operation:
+        row = self._connection().execute("SELECT %s FROM operations WHERE instance_id = ?" % COLUMNS,
+                                         (instance_id,)).fetchone()
+        return Operation(*row) if row else None
+
+    def get_many(self, instance_ids) -> dict:
+        instance_ids = list(instance_ids)
+        ops = {}
+        # Stay well under SQLite's limit on bound parameters per statement
+        for i in range(0, len(instance_ids), 500):
+            chunk = instance_ids[i:i + 500]
+            rows = self._connection().execute("SELECT %s FROM operations WHERE instance_id IN (%s)" %
+                                              (COLUMNS, ",".join("?" * len(chunk))), chunk)
+            ops.update((row[0], Operation(*row)) for row in rows)
+        return ops
+
+    def update(self, instance_id: str, state: str, description: str=None):
+        with self._write_lock, self._connection() as conn:
+            conn.execute("UPDATE operations SET state = ?, description = ?, updated = ? WHERE instance_id = ?",
+                         (state, description, time(), instance_id))
+
+    def progress(self, instance_id: str, percent: float=None, phase: str=None, description: str=None):
+        with self._write_lock, self._connection() as conn:
+            conn.execute("UPDATE operations SET percent = COALESCE(?, percent), phase = COALESCE(?, phase), "
+                         "description = COALESCE(?, description), updated = ? WHERE instance_id = ? AND state = ?",
+                         (percent, phase, description, time(), instance_id, IN_PROGRESS))
+
+    def count_by_state(self) -> dict:
+        return dict(self._connection().execute("SELECT state, COUNT(*) FROM operations GROUP BY state").fetchall())
+
+    def expire(self, now: float=None):
+        cutoff = (now if now is not None else time()) - self.ttl
+        with self._write_lock, self._connection() as conn:
+            conn.execute("DELETE FROM operations WHERE state IN (?, ?) AND updated < ?", (SUCCEEDED, FAILED, cutoff))
+        self._last_expiry = time()
+
+
+def operations_from_environment() -> MemoryOperationStore:
+    # BROKER_OPERATIONS_DB names a SQLite database, to share operations between processes or broker nodes
+    path = os.environ.get('BROKER_OPERATIONS_DB')
+    return SQLiteOperationStore(path) if path else MemoryOperationStore()
@@ -0,0 +1,152 @@
+from functools import partial
+from inspect import iscoroutinefunction
+from random import random
+from threading import Lock
+from typing import Callable, Iterable, List
+import cProfile
+import io
+import os
+import pstats
+import re
+import progress
+import logging
+
+logging.basicConfig(level=logging.DEBUG)
+log = logging.getLogger()
+
+SORT_KEYS = ('cumulative', 'tottime', 'calls', 'ncalls', 'filename', 'name')
+
+
+class ProfileSample:
+    # The cProfile stats of one service call, keyed by (service_id, plan_id, operation)
+    __slots__ = ('key', 'stats')
+
+    def __init__(self, key: tuple, stats: dict):
+        self.key = key
+        self.stats = stats
+
+    # pstats.Stats loads anything with create_stats() and a stats dict, as it would a cProfile.Profile
+    def create_stats(self):
+        pass
+
+
+class ProfiledCall:
+    # Wraps a service method so it runs under cProfile.  The stats go to sink, or from a process pool worker back to
+    # the broker over the queue the worker was started with, like progress events.
+    def __init__(self, func: Callable, key: tuple, sink: Callable=None):
+        self.func = func
+        self.key = key
+        self.sink = sink
+
+    def __call__(self, *args, **kwargs):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is already running in this process
+            return self.func(*args, **kwargs)
+        try:
+            return self.func(*args, **kwargs)
+        finally:
+            profile.disable()
+            profile.create_stats()
+            self._send(ProfileSample(self.key, profile.stats))
+
+    def _send(self, sample: ProfileSample):
+        sink = self.sink
+        if sink is None:
+            if progress._worker_events is None:
+                return
+            sink = progress._worker_events.put
+        try:
+            sink(sample)
+        except Exception:
+            log.exception("could not send the profile of a %s call", self.key[2])
+
+    def __getstate__(self):
+        return {'func': self.func, 'key': self.key}
+
+    def __setstate__(self, state):
+        self.func = state['func']
+        self.key = state['key']
+        self.sink = None
+
+
+class Profiler:
+    # Profiles every call to the service or plan guids in targets, and sample_percent% of all other calls.  The
+    # broker only asks a Profiler to wrap calls when it has one, so without one nothing at all is added.
+    def __init__(self, targets: Iterable[str]=(), sample_percent: float=0, dump_dir: str=None):
+        self.targets = set(targets)
+        self.sample_rate = sample_percent / 100.0
+        self.dump_dir = dump_dir
+        # (service_id, plan_id, operation) -> pstats.Stats of every profiled call, and how many calls that was
+        self._stats = {}
+        self._calls = {}
+        self._lock = Lock()
+
+    def selected(self, service_id: str, plan_id: str) -> bool:
+        return service_id in self.targets or plan_id in self.targets or (self.sample_rate > 0 and
+                                                                           random() < self.sample_rate)
+
+    def wrap(self, func: Callable, service_id: str, plan_id: str, operation: str, sink: Callable=None) -> Callable:
+        # Coroutines are left alone, their time is spread over other work on the event loop
+        if iscoroutinefunction(func.func if isinstance(func, partial) else func):
+            return func
+        if not self.selected(service_id, plan_id):
+            return func
+        return ProfiledCall(func, (service_id, plan_id, operation), sink)
+
+    def add(self, sample: ProfileSample):
+        stats = pstats.Stats(sample)
+        with self._lock:
+            if sample.key in self._stats:
+                self._stats[sample.key].add(stats)
+            else:
+                self._stats[sample.key] = stats
+            self._calls[sample.key] = self._calls.get(sample.key, 0) + 1
+
+    def summary(self) -> List[dict]:
+        with self._lock:
+            entries = [{"service_id": key[0], "plan_id": key[1], "operation": key[2], "calls": self._calls[key],
+                        "total_time": stats.total_tt} for key, stats in self._stats.items()]
+        return sorted(entries, key=lambda e: e["total_time"], reverse=True)
+
+    def report(self, key: tuple, sort: str='cumulative', limit: int=30) -> str:
+        # pstats' own text table for one key, None if it hasn't been profiled
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                return None
+            out = io.StringIO()
+            stats.stream = out
+            stats.sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+    def dump(self, directory: str=None) -> List[str]:
+        # One file per key, readable by pstats, snakeviz and the like
+        directory = directory or self.dump_dir
+        os.makedirs(directory, exist_ok=True)
+        paths = []
+        with self._lock:
+            for key, stats in self._stats.items():
+                path = os.path.join(directory, "%s.prof" % "-".join(re.sub(r'[^\w.]', '_', str(k)) for k in key))
+                stats.dump_stats(path)
+                paths.append(path)
+        log.info("dumped %d profiles to %s", len(paths), directory)
+        return paths
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+            self._calls.clear()
+
+
+def profiler_from_environment() -> Profiler:
+    # BROKER_PROFILE is a comma separated list of service and plan guids to profile every call of,
+    # BROKER_PROFILE_SAMPLE a percentage of other calls to profile, and BROKER_PROFILE_DIR where to write dump files.
+    # With neither of the first two set there is no profiler.
+    targets = [t.strip() for t in os.environ.get('BROKER_PROFILE', '').split(',') if t.strip()]
+    sample_percent = float(os.environ.get('BROKER_PROFILE_SAMPLE') or 0)
+    if not targets and not sample_percent:
+        return None
+    return Profiler(targets, sample_percent, os.environ.get('BROKER_PROFILE_DIR'))
@@ -0,0 +1,61 @@
+from typing import Callable
+from cancellation import accepts_keyword
+import codec
+import logging
+
+logging.basicConfig(level=logging.DEBUG)
+log = logging.getLogger()
+
+QUEUED = "queued"
+RUNNING = "running"
+SSE_KEEPALIVE = b": keep-alive\n\n"
+
+# Set in each process pool worker by init_worker, so reporters unpickled there know where to send events
+_worker_events = None
+
+
+def init_worker(events):
+    global _worker_events
+    _worker_events = events
+
+
+class ProgressReporter:
+    # Passed as progress to service methods that declare it:  progress(percent=40, phase='copying', description=...).
+    # Events are (instance_id, percent, phase, description) tuples handed to sink.  A reporter pickled into a process
+    # pool worker loses its sink and sends to the queue that worker was started with instead.
+    def __init__(self, instance_id: str, sink: Callable=None):
+        self.instance_id = instance_id
+        self.sink = sink
+
+    def __call__(self, percent: float=None, phase: str=None, description: str=None):
+        sink = self.sink
+        if sink is None:
+            if _worker_events is None:
+                return
+            sink = _worker_events.put
+        try:
+            sink((self.instance_id, percent, phase, description))
+        except Exception:
+            # Progress is advisory, never let reporting it fail the operation
+            log.exception("could not report progress for instance %s", self.instance_id)
+
+    def __getstate__(self):
+        return {'instance_id': self.instance_id}
+
+    def __setstate__(self, state):
+        self.instance_id = state['instance_id']
+        self.sink = None
+
+
+def accepts_progress(func: Callable) -> bool:
+    return accepts_keyword(func, 'progress')
+
+
+def run_reporting(reporter: ProgressReporter, func: Callable, *func_args):
+    # Runs in the worker, so the operation only leaves the queued phase once a worker has actually picked it up
+    reporter(phase=RUNNING)
+    return func(*func_args)
+
+
+def sse_message(event: dict) -> bytes:
+    return b"data: " + codec.dumps(event) + b"\n\n"
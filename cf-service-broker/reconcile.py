@@ -0,0 +1,401 @@
+from inspect import iscoroutinefunction
+from threading import Condition, Event, Thread
+from time import time
+from typing import Callable, Iterator, List
+from broker import Broker
+from executor import BrokerExecutor
+from inventory import MemoryInventory, SQLiteInventory, inventory_from_environment
+from registry import plan_from_metadata, services_from_environment
+from service import BaseService
+from workqueue import CoroutineRunner
+import argparse
+import codec
+import json
+import os
+import sys
+import logging
+
+logging.basicConfig(level=logging.DEBUG)
+log = logging.getLogger()
+
+PAGE_SIZE = 500
+# Deletes and unbinds per run; orphans beyond this are only reported, as that many usually means the inventory is
+# wrong rather than the backend
+MAX_REPAIRS = 50
+
+
+def pages(fetch: Callable, page_size: int, key: Callable) -> Iterator[tuple]:
+    # Every item from fetch(after, limit), a page at a time, checking that the pages really are sorted
+    after = None
+    while True:
+        page = fetch(after, page_size)
+        for item in page:
+            item = tuple(item)
+            if after is not None and key(item) <= after:
+                raise ValueError("listing is not sorted: %r came after %r" % (key(item), after))
+            after = key(item)
+            yield item
+        if len(page) < page_size:
+            return
+
+
+def diff_sorted(ours: Iterator[tuple], theirs: Iterator[tuple], key: Callable) -> Iterator[tuple]:
+    # Merges two sorted streams in one pass, yielding (our item, their item) for each key with either side None
+    # when only the other has it
+    a, b = next(ours, None), next(theirs, None)
+    while a is not None or b is not None:
+        if b is None or (a is not None and key(a) < key(b)):
+            yield a, None
+            a = next(ours, None)
+        elif a is None or key(b) < key(a):
+            yield None, b
+            b = next(theirs, None)
+        else:
+            yield a, b
+            a, b = next(ours, None), next(theirs, None)
+
+
+class ReconcileReport:
+    # Orphans exist in a service but not in the broker's inventory, and are deleted (unless dry_run).  Missing
+    # entries are in the inventory but gone from the service, and mismatched ones are on another plan; both need a
+    # person to look at them, so they are only reported.  Orphans over the run's repair limit are held, and refused
+    # says why a run that was asked to repair only reported.
+    def __init__(self, dry_run: bool):
+        self.dry_run = dry_run
+        self.refused = None
+        self.started = time()
+        self.finished = None
+        self.services = []
+        self.unsupported = []
+        self.orphaned_instances = []
+        self.missing_instances = []
+        self.mismatched_instances = []
+        self.orphaned_bindings = []
+        self.missing_bindings = []
+        self.skipped = []
+        self.held = []
+        self.repaired = []
+        self.failed = []
+
+    def as_dict(self) -> dict:
+        return {k: getattr(self, k) for k in ('dry_run', 'refused', 'started', 'finished', 'services', 'unsupported',
+                                              'orphaned_instances', 'missing_instances', 'mismatched_instances',
+                                              'orphaned_bindings', 'missing_bindings', 'skipped', 'held',
+                                              'repaired', 'failed')}
+
+    def summary(self) -> str:
+        return ("%d services checked, %d orphaned instances, %d missing, %d on another plan, %d orphaned bindings, "
+                "%d missing, %d repaired, %d repairs failed, %d skipped, %d held over the limit" %
+                (len(self.services), len(self.orphaned_instances), len(self.missing_instances),
+                 len(self.mismatched_instances), len(self.orphaned_bindings), len(self.missing_bindings),
+                 len(self.repaired), len(self.failed), len(self.skipped), len(self.held)))
+
+
+class _Repairs:
+    # Runs repairs on the broker's executor, at most max_concurrency at a time so a big cleanup doesn't crowd out
+    # the broker's own operations
+    def __init__(self, executor, max_concurrency: int, report: ReconcileReport):
+        self.executor = executor
+        self.max_concurrency = max_concurrency
+        self.report = report
+        self.running = 0
+        self.submitted = 0
+        self._condition = Condition()
+
+    def submit(self, entry: dict, service_id: str, func: Callable, *args):
+        if iscoroutinefunction(func):
+            func = CoroutineRunner(func)
+        self.submitted += 1
+        with self._condition:
+            while self.running >= self.max_concurrency:
+                self._condition.wait()
+            self.running += 1
+        try:
+            future = self.executor.submit(service_id, func, *args)
+        except Exception as e:
+            # BrokerBusyError, ServiceBusyError from a service at its cap, or anything else: the slot is freed
+            self._finished(entry, e)
+            return
+
+        def done(f):
+            self._finished(entry, Exception("repair was cancelled") if f.cancelled() else f.exception())
+        future.add_done_callback(done)
+
+    def _finished(self, entry: dict, e: BaseException):
+        with self._condition:
+            if e is None:
+                self.report.repaired.append(entry)
+            else:
+                log.error("could not repair %r: %r", entry, e)
+                self.report.failed.append(dict(entry, error=str(e) or e.__class__.__name__))
+            self.running -= 1
+            self._condition.notify_all()
+
+    def wait(self):
+        with self._condition:
+            while self.running:
+                self._condition.wait()
+
+
+class Reconciler:
+    # Compares the broker's inventory with what each service's list_instances/list_bindings say really exists,
+    # streaming both sides in sorted pages so memory and time stay linear in the number of entries.  Services that
+    # don't implement the listings are skipped.  Orphans that the broker is working on right now, or that it
+    # learnt about since the run started, are left alone.  Repairs need an inventory that outlives the process and
+    # was seeded from the services, otherwise anything created before it (or by another process) looks orphaned.
+    def __init__(self, broker, page_size: int=PAGE_SIZE, max_concurrency: int=4, max_repairs: int=MAX_REPAIRS):
+        self.broker = broker
+        self.page_size = page_size
+        self.max_concurrency = max_concurrency
+        self.max_repairs = max_repairs
+        self.last_report = None
+        self._stopped = Event()
+        self._thread = None
+
+    def repair_refusal(self) -> str:
+        # Why repairs can't be trusted to this inventory, None if they can
+        inventory = self.broker.inventory
+        if not inventory.persistent:
+            return "the inventory is in memory and starts out empty, set BROKER_INVENTORY_DB"
+        if not inventory.seeded():
+            return "the inventory was never seeded, run reconcile.py --seed once first"
+        return None
+
+    def seed(self, service_ids: List[str]=None) -> int:
+        # Adds everything the services list that the inventory lacks, e.g. instances created before the broker kept
+        # one, and marks the inventory seeded.  Real orphans are adopted too, so check a dry run's report first.
+        inventory = self.broker.inventory
+        added = 0
+        for service in self._services(service_ids):
+            try:
+                for instance_id, plan_id in pages(self._listing(service.list_instances), self.page_size,
+                                                  lambda item: item[0]):
+                    if not inventory.has_instance(instance_id):
+                        inventory.add_instance(instance_id, service.guid, plan_id)
+                        added += 1
+                if service.bindable:
+                    for instance_id, binding_id, plan_id in pages(self._listing(service.list_bindings),
+                                                                  self.page_size, lambda item: item[:2]):
+                        if not inventory.has_binding(instance_id, binding_id):
+                            inventory.add_binding(instance_id, binding_id, service.guid, plan_id)
+                            added += 1
+            except NotImplementedError:
+                log.warning("service %s has no listings to seed the inventory from", service.name)
+        inventory.mark_seeded()
+        log.info("seeded the inventory with %d instances and bindings", added)
+        return added
+
+    def _services(self, service_ids: List[str]=None) -> List[BaseService]:
+        return [s for s in list(self.broker.services.values()) if service_ids is None or s.guid in service_ids]
+
+    def run(self, dry_run: bool=False, service_ids: List[str]=None) -> ReconcileReport:
+        refused = None if dry_run else self.repair_refusal()
+        if refused is not None:
+            log.error("not repairing anything: %s", refused)
+        report = ReconcileReport(dry_run or refused is not None)
+        report.refused = refused
+        repairs = _Repairs(self.broker.executor, self.max_concurrency, report)
+        for service in self._services(service_ids):
+            report.services.append(service.guid)
+            # Bindings first, so orphaned instances lose their bindings before they are deleted
+            if service.bindable:
+                self._reconcile(service, 'bindings', report, repairs)
+                repairs.wait()
+            self._reconcile(service, 'instances', report, repairs)
+            repairs.wait()
+        report.finished = time()
+        self.last_report = report
+        log.info("reconciliation%s: %s", " (dry run)" if dry_run else "", report.summary())
+        return report
+
+    def _reconcile(self, service: BaseService, kind: str, report: ReconcileReport, repairs: _Repairs):
+        inventory = self.broker.inventory
+        if kind == 'instances':
+            key = lambda item: item[0]
+            ours = pages(lambda after, limit: inventory.instances(service.guid, after, limit), self.page_size, key)
+            theirs = pages(self._listing(service.list_instances), self.page_size, key)
+        else:
+            key = lambda item: item[:2]
+            ours = pages(lambda after, limit: inventory.bindings(service.guid, after, limit), self.page_size, key)
+            theirs = pages(self._listing(service.list_bindings), self.page_size, key)
+        try:
+            for our, their in diff_sorted(ours, theirs, key):
+                if our is None:
+                    self._orphan(service, kind, their, report, repairs)
+                elif their is None:
+                    getattr(report, 'missing_' + kind).append(self._entry(service, kind, our))
+                elif kind == 'instances' and our[1] != their[1]:
+                    report.mismatched_instances.append(dict(self._entry(service, kind, their),
+                                                            broker_plan_id=our[-1]))
+        except NotImplementedError:
+            report.unsupported.append({"service_id": service.guid, "kind": kind})
+        except Exception as e:
+            log.exception("could not reconcile %s of service %s", kind, service.name)
+            report.failed.append({"service_id": service.guid, "kind": kind, "error": str(e) or e.__class__.__name__})
+
+    @staticmethod
+    def _listing(func: Callable) -> Callable:
+        return CoroutineRunner(func) if iscoroutinefunction(func) else func
+
+    @staticmethod
+    def _entry(service: BaseService, kind: str, item: tuple) -> dict:
+        if kind == 'instances':
+            return {"service_id": service.guid, "instance_id": item[0], "plan_id": item[1]}
+        return {"service_id": service.guid, "instance_id": item[0], "binding_id": item[1], "plan_id": item[2]}
+
+    def _orphan(self, service: BaseService, kind: str, item: tuple, report: ReconcileReport, repairs: _Repairs):
+        entry = self._entry(service, kind, item)
+        getattr(report, 'orphaned_' + kind).append(entry)
+        if report.dry_run:
+            return
+        if self._busy(kind, item, report.started):
+            report.skipped.append(entry)
+            return
+        if repairs.submitted >= self.max_repairs:
+            report.held.append(entry)
+            return
+        if kind == 'instances':
+            repairs.submit(entry, service.guid, service.delete_instance, item[0])
+        else:
+            repairs.submit(entry, service.guid, service.unbind, item[0], item[1], item[2])
+
+    def _busy(self, kind: str, item: tuple, since: float) -> bool:
+        # Checked again just before repairing, as the listings may be minutes old by now
+        broker = self.broker
+        if kind == 'bindings':
+            return (broker.inventory.has_binding(item[0], item[1]) or
+                    broker.requests.pending(('binding', item[0], item[1])))
+        if broker.inventory.has_instance(item[0]) or broker.requests.pending(('instance', item[0])):
+            return True
+        op = broker.operations.get(item[0])
+        return op is not None and (not op.finished or op.updated >= since)
+
+    def start(self, interval: float, dry_run: bool=False):
+        self._thread = Thread(target=self._run, args=(interval, dry_run), name='broker-reconciler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self, interval: float, dry_run: bool):
+        while not self._stopped.wait(interval):
+            try:
+                self.run(dry_run)
+            except Exception:
+                log.exception("reconciliation failed")
+
+
+def reconciler_from_environment(broker) -> Reconciler:
+    # BROKER_RECONCILE_INTERVAL starts a background run every that many seconds.  It only reports drift unless
+    # BROKER_RECONCILE_REPAIR is set, and the inventory allows it; BROKER_RECONCILE_MAX_REPAIRS caps each run.
+    interval = os.environ.get('BROKER_RECONCILE_INTERVAL')
+    reconciler = Reconciler(broker, max_repairs=int(os.environ.get('BROKER_RECONCILE_MAX_REPAIRS', MAX_REPAIRS)))
+    if interval:
+        dry_run = not os.environ.get('BROKER_RECONCILE_REPAIR')
+        refused = None if dry_run else reconciler.repair_refusal()
+        if refused is not None:
+            log.error("BROKER_RECONCILE_REPAIR is set but %s, only reporting", refused)
+        reconciler.start(float(interval), dry_run=dry_run or refused is not None)
+    return reconciler
+
+
+class StandInInventory(MemoryInventory):
+    # The state file is taken as the whole inventory, as a seeded database would be
+    persistent = True
+
+
+class StandInService(BaseService):
+    # An in-memory backend for trying the reconciler locally, see the --stand-in option below
+    def __init__(self, *args, instances: dict=None, bindings: dict=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        # instance_id -> plan_id, and (instance_id, binding_id) -> plan_id
+        self.instances = instances if instances is not None else {}
+        self.bindings = bindings if bindings is not None else {}
+
+    def create_instance(self, instance_id, plan_id, parameters, organization_guid, space_guid):
+        self.instances[instance_id] = plan_id
+
+    def delete_instance(self, instance_id):
+        self.instances.pop(instance_id, None)
+
+    def modify_instance(self, instance_id, plan_id, parameters, previous_values):
+        self.instances[instance_id] = plan_id
+
+    def bind(self, instance_id, binding_id, plan_id, app_guid, parameters):
+        self.bindings[(instance_id, binding_id)] = plan_id
+        return {}
+
+    def unbind(self, instance_id, binding_id, plan_id):
+        self.bindings.pop((instance_id, binding_id), None)
+
+    def list_instances(self, after, limit):
+        ids = sorted(i for i in self.instances if after is None or i > after)[:limit]
+        return [(i, self.instances[i]) for i in ids]
+
+    def list_bindings(self, after, limit):
+        keys = sorted(k for k in self.bindings if after is None or k > tuple(after))[:limit]
+        return [k + (self.bindings[k],) for k in keys]
+
+
+def stand_in_broker(state: dict):
+    # state is {"services": [catalog metadata with "instances": [[instance_id, plan_id], ...] and
+    # "bindings": [[instance_id, binding_id, plan_id], ...] as the backend has them], "inventory": {"instances":
+    # [[instance_id, service_id, plan_id], ...], "bindings": [[instance_id, binding_id, service_id, plan_id], ...]}}
+    services = []
+    for d in state['services']:
+        plans = [plan_from_metadata(p) for p in d['plans']]
+        services.append(StandInService(d.get('guid', d.get('id')), d['name'], d.get('description', ''),
+                                       d.get('bindable', True), {p.guid: p for p in plans},
+                                       instances={i: p for i, p in d.get('instances', ())},
+                                       bindings={(i, b): p for i, b, p in d.get('bindings', ())}))
+    inventory = StandInInventory()
+    if 'inventory' in state:
+        inventory.mark_seeded()
+    for row in state.get('inventory', {}).get('instances', ()):
+        inventory.add_instance(*row)
+    for row in state.get('inventory', {}).get('bindings', ()):
+        inventory.add_binding(*row)
+    # Threads, so repairs change the stand-in services in this process
+    return Broker(service_list=services, executor=BrokerExecutor(use_processes=False), inventory=inventory)
+
+
+def main(argv: List[str]=None) -> int:
+    parser = argparse.ArgumentParser(description="Compare the broker's inventory with what its services report, "
+                                                 "and delete orphaned instances and bindings")
+    parser.add_argument('--dry-run', action='store_true', help="only report, change nothing")
+    parser.add_argument('--service', action='append', dest='service_ids', help="only this service guid")
+    parser.add_argument('--page-size', type=int, default=PAGE_SIZE)
+    parser.add_argument('--max-concurrency', type=int, default=4, help="repairs running at once")
+    parser.add_argument('--max-repairs', type=int, default=MAX_REPAIRS,
+                        help="deletes and unbinds per run, further orphans are only reported (%(default)s)")
+    parser.add_argument('--seed', action='store_true',
+                        help="add everything the services list to the inventory instead, and allow repairs from "
+                             "then on")
+    parser.add_argument('--inventory', help="the broker's inventory database, BROKER_INVENTORY_DB by default")
+    parser.add_argument('--stand-in', metavar='STATE_FILE',
+                        help="run against in-memory services and inventory loaded from a JSON file instead")
+    args = parser.parse_args(argv)
+    if args.stand_in:
+        with open(args.stand_in) as f:
+            broker = stand_in_broker(json.load(f))
+    else:
+        broker = Broker(service_list=services_from_environment(),
+                        inventory=SQLiteInventory(args.inventory) if args.inventory else inventory_from_environment())
+    reconciler = Reconciler(broker, args.page_size, args.max_concurrency, args.max_repairs)
+    try:
+        if args.seed:
+            if not broker.inventory.persistent:
+                parser.error("--seed needs --inventory or BROKER_INVENTORY_DB")
+            reconciler.seed(args.service_ids)
+            return 0
+        report = reconciler.run(args.dry_run, args.service_ids)
+    finally:
+        broker.shutdown()
+    sys.stdout.write(codec.dumps(report.as_dict()).decode('utf-8') + '\n')
+    return 1 if report.failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,136 @@
+from importlib import import_module
+from importlib.metadata import entry_points
+from typing import Callable, List
+from service import BaseService, Plan
+import json
+import os
+import logging
+
+logging.basicConfig(level=logging.DEBUG)
+log = logging.getLogger()
+
+ENTRY_POINT_GROUP = 'cf_service_broker.services'
+SERVICE_OPTIONS = ('dashboard_client', 'tags', 'metadata', 'requires', 'plan_updateable', 'cache_bindings',
+                   'idempotent')
+PLAN_OPTIONS = ('free', 'metadata', 'provisionable_synchronously', 'provisionable_asynchronously', 'sync_timeout',
+                'async_timeout')
+
+# (class_path, guid) -> loaded service, per process, so copies of a LazyService pickled to executor workers
+# load the real service once per worker rather than once per call
+_loaded = {}
+
+
+def import_object(path: str):
+    module_name, _, attr = path.partition(':')
+    obj = import_module(module_name)
+    for name in attr.split('.') if attr else ():
+        obj = getattr(obj, name)
+    return obj
+
+
+class LazyService(BaseService):
+    # Stands in for a BaseService subclass in the catalog using only its metadata.  The module named by
+    # class_path ("package.module:ClassName") is imported, and the real service built from the same metadata,
+    # the first time one of the service operations is called.  Not for AsyncBaseService subclasses, whose methods
+    # AsyncBroker has to see as coroutine functions.
+    def __init__(self, class_path: str, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.class_path = class_path
+        self._args = args
+        self._kwargs = kwargs
+        self._service = None
+        self._class = None
+
+    def __getstate__(self):
+        # Pickled to process pool workers without the built service, which each worker then loads once through
+        # _loaded; built services may hold clients or locks that can't be pickled anyway
+        slots = {name: getattr(self, name) for name in BaseService.__slots__ if hasattr(self, name)}
+        return dict(self.__dict__, _service=None), slots
+
+    @property
+    def service_class(self) -> type:
+        # Imported without building the service, e.g. to read its methods' signatures
+        if self._class is None:
+            self._class = import_object(self.class_path)
+        return self._class
+
+    @property
+    def loaded(self) -> bool:
+        return self._service is not None or (self.class_path, self.guid) in _loaded
+
+    def load(self) -> BaseService:
+        if self._service is None:
+            key = (self.class_path, self.guid)
+            if key not in _loaded:
+                log.info("loading service %s from %s", self.name, self.class_path)
+                _loaded[key] = import_object(self.class_path)(*self._args, **self._kwargs)
+            self._service = _loaded[key]
+        return self._service
+
+    # Keywords the broker opts services in to (cancel_token, progress, diff) are passed through; it checks the
+    # loaded service's own signatures for them, see implementation()
+    def create_instance(self, instance_id, plan_id, parameters, organization_guid, space_guid, **kwargs):
+        return self.load().create_instance(instance_id, plan_id, parameters, organization_guid, space_guid, **kwargs)
+
+    def delete_instance(self, instance_id, **kwargs):
+        return self.load().delete_instance(instance_id, **kwargs)
+
+    def modify_instance(self, instance_id, plan_id, parameters, previous_values, **kwargs):
+        return self.load().modify_instance(instance_id, plan_id, parameters, previous_values, **kwargs)
+
+    def bind(self, instance_id, binding_id, plan_id, app_guid, parameters):
+        return self.load().bind(instance_id, binding_id, plan_id, app_guid, parameters)
+
+    def unbind(self, instance_id, binding_id, plan_id):
+        return self.load().unbind(instance_id, binding_id, plan_id)
+
+    def list_instances(self, after, limit):
+        return self.load().list_instances(after, limit)
+
+    def list_bindings(self, after, limit):
+        return self.load().list_bindings(after, limit)
+
+
+def implementation(func: Callable) -> Callable:
+    # The function that really runs for func, to check its signature: a LazyService's own methods only forward to
+    # the service class's, which are looked up without building the service
+    owner = getattr(func, '__self__', None)
+    if isinstance(owner, LazyService):
+        return getattr(owner.service_class, func.__name__)
+    return func
+
+
+def plan_from_metadata(d: dict) -> Plan:
+    return Plan(d.get('guid', d.get('id')), d['name'], d['description'],
+                **{k: d[k] for k in PLAN_OPTIONS if k in d})
+
+
+def service_from_metadata(d: dict) -> LazyService:
+    # d is a catalog-style service definition plus "class", the import path of its BaseService subclass
+    plans = [plan_from_metadata(p) for p in d['plans']]
+    return LazyService(d['class'], d.get('guid', d.get('id')), d['name'], d['description'], d['bindable'],
+                       {p.guid: p for p in plans}, **{k: d[k] for k in SERVICE_OPTIONS if k in d})
+
+
+def services_from_config(path: str) -> List[LazyService]:
+    # A JSON file of the form {"services": [service metadata, ...]}
+    with open(path) as f:
+        return [service_from_metadata(d) for d in json.load(f)['services']]
+
+
+def services_from_entry_points(group: str=ENTRY_POINT_GROUP) -> List[LazyService]:
+    # Each entry point names service metadata (a dict, or a list of them) that should live in a module that is
+    # cheap to import, with "class" pointing at the heavy one
+    services = []
+    for ep in entry_points(group=group):
+        metadata = ep.load()
+        for d in metadata if isinstance(metadata, list) else [metadata]:
+            services.append(service_from_metadata(d))
+    return services
+
+
+def services_from_environment() -> List[LazyService]:
+    services = services_from_entry_points()
+    if os.environ.get('BROKER_SERVICES_CONFIG'):
+        services += services_from_config(os.environ['BROKER_SERVICES_CONFIG'])
+    return services
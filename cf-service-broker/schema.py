@@ -0,0 +1,75 @@
+from exceptions import InvalidRequestError
+
+_MISSING = object()
+
+
+class Field:
+    # items is the type every element of an array field must have
+    __slots__ = ('types', 'required', 'default', 'items')
+
+    def __init__(self, types, required: bool=False, default=None, items=None):
+        self.types = types
+        self.required = required
+        self.default = default
+        self.items = items
+
+
+# Request bodies of the OSB API, as keyword arguments for the Broker methods.  Fields not listed here (context,
+# bind_resource, maintenance_info...) are ignored, as the API asks brokers to do with fields they don't know.
+PROVISION = {
+    'service_id': Field(str, required=True),
+    'plan_id': Field(str, required=True),
+    'organization_guid': Field(str, required=True),
+    'space_guid': Field(str, required=True),
+    'parameters': Field(dict),
+    'accepts_incomplete': Field(bool, default=False),
+}
+UPDATE = {
+    'service_id': Field(str, required=True),
+    'plan_id': Field(str, required=True),
+    'parameters': Field(dict),
+    'previous_values': Field(dict),
+    'accepts_incomplete': Field(bool, default=False),
+}
+BIND = {
+    'service_id': Field(str, required=True),
+    'plan_id': Field(str, required=True),
+    'app_guid': Field(str),
+    'parameters': Field(dict),
+}
+BATCH_CREATE = dict(PROVISION, instance_id=Field(str, required=True))
+BATCH_DELETE = {
+    'instance_id': Field(str, required=True),
+    'service_id': Field(str, required=True),
+    'plan_id': Field(str, required=True),
+    'accepts_incomplete': Field(bool, default=False),
+}
+BATCH_LAST_OPERATION = {
+    'instance_ids': Field(list, required=True, items=str),
+}
+
+_TYPE_NAMES = {str: 'a string', dict: 'an object', bool: 'a boolean', list: 'an array'}
+
+
+def validate(schema: dict, data) -> dict:
+    # One pass over the schema, collecting every problem rather than stopping at the first
+    if not isinstance(data, dict):
+        raise InvalidRequestError(["request body must be a JSON object"])
+    values = {}
+    problems = []
+    for name, field in schema.items():
+        value = data.get(name, _MISSING)
+        if value is _MISSING or value is None:
+            if field.required:
+                problems.append("%s is required" % name)
+            values[name] = field.default
+        elif not isinstance(value, field.types):
+            problems.append("%s must be %s" % (name, _TYPE_NAMES.get(field.types, field.types.__name__)))
+        elif field.items is not None and not all(isinstance(v, field.items) for v in value):
+            problems.append("every element of %s must be %s" %
+                            (name, _TYPE_NAMES.get(field.items, field.items.__name__)))
+        else:
+            values[name] = value
+    if problems:
+        raise InvalidRequestError(problems)
+    return values
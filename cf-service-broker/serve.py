@@ -0,0 +1,147 @@
+from typing import List
+from registry import LazyService, services_from_environment
+import argparse
+import json
+import os
+import sys
+import logging
+
+logging.basicConfig(level=logging.DEBUG)
+log = logging.getLogger()
+
+# Defaults for gthread workers.  Binds and unbinds run on the request threads, so there are enough of them to keep
+# slow backends busy, and async operations queue on the executor for a while rather than being refused.
+THREADS = 16
+MAX_PENDING = 1024
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:
+    BaseApplication = None
+
+
+def preload_services() -> int:
+    # Imports and builds every registered service in this process.  Workers forked afterwards find them in the
+    # registry's per-process cache when their own broker loads its LazyServices, and share the memory copy-on-write.
+    # Only the services: the broker itself starts threads, which don't survive a fork, so each worker builds its own.
+    services = [s for s in services_from_environment() if isinstance(s, LazyService)]
+    for service in services:
+        service.load()
+    log.info("preloaded %d services", len(services))
+    return len(services)
+
+
+def load_app(asgi: bool=False):
+    if asgi:
+        from asgi import app
+    else:
+        from api import app
+    return app
+
+
+if BaseApplication is not None:
+    class BrokerServer(BaseApplication):
+        # gunicorn, configured from the options here rather than from its own command line.  The app is imported
+        # in each worker after the fork (gunicorn's preload_app is off), see preload_services().
+        def __init__(self, options: dict, asgi: bool=False):
+            self.options = options
+            self.asgi = asgi
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return load_app(self.asgi)
+
+
+def single_process_settings(workers: int) -> List[str]:
+    # Settings that each worker would act on separately, and that break when several do
+    if workers <= 1:
+        return []
+    problems = []
+    if os.environ.get('BROKER_JOURNAL'):
+        problems.append("BROKER_JOURNAL (each worker would replay and re-run the same journal, and compact the file "
+                        "under the others)")
+    if os.environ.get('BROKER_RECONCILE_INTERVAL') and os.environ.get('BROKER_RECONCILE_REPAIR'):
+        problems.append("BROKER_RECONCILE_REPAIR (each worker would take what the others are creating for orphans, "
+                        "run reconcile.py from a single process instead)")
+    return problems
+
+
+def serve_without_gunicorn(host: str, port: int, keep_alive: bool):
+    # Werkzeug's threaded server: one process, but no debugger or reloader, and with HTTP/1.1 keep-alive
+    from werkzeug.serving import WSGIRequestHandler, run_simple
+    log.warning("gunicorn is not installed, serving with one process on werkzeug's threaded server")
+    if keep_alive:
+        WSGIRequestHandler.protocol_version = "HTTP/1.1"
+    run_simple(host, port, load_app(), threaded=True, use_reloader=False, use_debugger=False)
+
+
+def main(argv: List[str]=None) -> int:
+    parser = argparse.ArgumentParser(description="Run the broker under gunicorn")
+    parser.add_argument('--bind', default='0.0.0.0:%s' % os.environ.get('PORT', '8080'),
+                        help="host:port, by default on $PORT as Cloud Foundry sets it (%(default)s)")
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('WEB_CONCURRENCY', 2)),
+                        help="worker processes, each with its own broker and executor (%(default)s)")
+    parser.add_argument('--threads', type=int, default=THREADS, help="request threads per worker (%(default)s)")
+    parser.add_argument('--executor-workers', type=int, default=int(os.environ.get('BROKER_MAX_WORKERS') or 4),
+                        help="processes (or threads) per worker running service operations (%(default)s)")
+    parser.add_argument('--max-pending', type=int, default=int(os.environ.get('BROKER_MAX_PENDING') or MAX_PENDING),
+                        help="service operations queued or running per worker before it answers 503 (%(default)s)")
+    parser.add_argument('--service-limits', default=os.environ.get('BROKER_SERVICE_LIMITS') or '{}',
+                        help="JSON object of service guid -> operations running at once per worker (%(default)s)")
+    parser.add_argument('--executor', choices=('processes', 'threads'),
+                        default=os.environ.get('BROKER_EXECUTOR') or 'processes',
+                        help="run service operations on processes or threads (%(default)s)")
+    parser.add_argument('--keep-alive', type=float, default=5,
+                        help="seconds to hold idle client connections open, 0 to close them (%(default)s)")
+    parser.add_argument('--timeout', type=float, default=75,
+                        help="seconds before a silent worker is restarted; keep it above the sync operation "
+                             "timeout (%(default)s)")
+    parser.add_argument('--gzip-min-size', type=int, default=int(os.environ.get('BROKER_GZIP_MIN_SIZE', 1024)),
+                        help="gzip JSON responses of at least this many bytes, 0 to turn it off (%(default)s)")
+    parser.add_argument('--asgi', action='store_true',
+                        help="serve asgi:app with uvicorn workers, which has no batch, /metrics or /admin routes")
+    parser.add_argument('--no-preload', dest='preload', action='store_false',
+                        help="let each worker import its services itself")
+    args = parser.parse_args(argv)
+
+    problems = single_process_settings(args.workers)
+    if problems:
+        parser.error("with %d workers, unset %s, or use --workers 1" % (args.workers, "; ".join(problems)))
+    try:
+        service_limits = {k: int(v) for k, v in json.loads(args.service_limits).items()}
+    except (AttributeError, TypeError, ValueError):
+        parser.error("--service-limits must be a JSON object of service guid -> operations")
+    # Read by api.py and asgi.py, and by executor_from_environment(), when the workers import them
+    os.environ['BROKER_GZIP_MIN_SIZE'] = str(args.gzip_min_size)
+    os.environ['BROKER_MAX_WORKERS'] = str(args.executor_workers)
+    os.environ['BROKER_MAX_PENDING'] = str(args.max_pending)
+    os.environ['BROKER_SERVICE_LIMITS'] = json.dumps(service_limits)
+    os.environ['BROKER_EXECUTOR'] = args.executor
+    if args.workers > 1 and not os.environ.get('BROKER_OPERATIONS_DB'):
+        log.warning("%d workers without BROKER_OPERATIONS_DB: last_operation only finds async operations started "
+                    "by the worker that answers it", args.workers)
+    if args.preload:
+        preload_services()
+    if BaseApplication is None:
+        if args.asgi:
+            parser.error("--asgi needs gunicorn and uvicorn")
+        host, _, port = args.bind.rpartition(':')
+        serve_without_gunicorn(host or '0.0.0.0', int(port), args.keep_alive > 0)
+        return 0
+    options = {'bind': args.bind, 'workers': args.workers, 'keepalive': args.keep_alive, 'timeout': args.timeout,
+               'preload_app': False}
+    if args.asgi:
+        options['worker_class'] = 'uvicorn.workers.UvicornWorker'
+    else:
+        options['worker_class'] = 'gthread'
+        options['threads'] = args.threads
+    BrokerServer(options, args.asgi).run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
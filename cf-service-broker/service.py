@@ -5,25 +5,34 @@ log = logging.getLogger()
 
 
 class BaseService:
+    # Slotted like Plan; subclasses that don't declare __slots__ can still add their own attributes
+    __slots__ = ('guid', 'plans', 'name', 'description', 'bindable', 'dashboard_client', 'tags', 'metadata',
+                 'requires', 'plan_updateable', 'cache_bindings', 'idempotent')
+
     def __init__(self, guid, name, description, bindable, plans,
                  dashboard_client=None,
                  tags=None,
                  metadata=None,
                  requires=None,
                  plan_updateable=False,
+                 cache_bindings=False,
+                 idempotent=False,
                  ):
         self.guid = guid
         self.plans = plans
         self.name = name
         self.description = description
         self.bindable = bindable
-        self.plans = plans
         # optional properties
         self.dashboard_client = dashboard_client
         self.tags = tags
         self.metadata = metadata
         self.requires = requires
         self.plan_updateable = plan_updateable
+        # broker behaviour
+        self.cache_bindings = cache_bindings
+        # Safe to call create/delete/modify again for an operation that was interrupted by a broker restart
+        self.idempotent = idempotent
 
     def create_instance(self, instance_id, plan_id, parameters, organization_guid, space_guid):
         raise NotImplementedError
@@ -40,18 +49,61 @@ class BaseService:
     def unbind(self, instance_id, binding_id, plan_id):
         raise NotImplementedError
 
+    # Optional, for reconciliation: pages of what really exists in the backend, sorted by id (code point order),
+    # starting after the given id.  A page shorter than limit is the last one.
+    def list_instances(self, after, limit):
+        # [(instance_id, plan_id), ...]
+        raise NotImplementedError
+
+    def list_bindings(self, after, limit):
+        # [(instance_id, binding_id, plan_id), ...], after being an (instance_id, binding_id) pair
+        raise NotImplementedError
+
     def as_dict(self):
         d = {'id' if k == 'guid' else k: getattr(self, k) for k in ('guid', 'name', 'description', 'bindable')}
         d['plans'] = [p.as_dict() for p in self.plans.values()]
         return d
 
 
+class AsyncBaseService(BaseService):
+    __slots__ = ()
+
+    # For services whose backends have asyncio clients.  AsyncBroker awaits these methods on its event loop
+    # instead of sending them to the executor, so they must not block.
+    async def create_instance(self, instance_id, plan_id, parameters, organization_guid, space_guid):
+        raise NotImplementedError
+
+    async def delete_instance(self, instance_id):
+        raise NotImplementedError
+
+    async def modify_instance(self, instance_id, plan_id, parameters, previous_values):
+        raise NotImplementedError
+
+    async def bind(self, instance_id, binding_id, plan_id, app_guid, parameters):
+        raise NotImplementedError
+
+    async def unbind(self, instance_id, binding_id, plan_id):
+        raise NotImplementedError
+
+    async def list_instances(self, after, limit):
+        raise NotImplementedError
+
+    async def list_bindings(self, after, limit):
+        raise NotImplementedError
+
+
 class Plan:
+    # Brokers can host thousands of plans, so no per-instance __dict__
+    __slots__ = ('guid', 'name', 'description', 'free', 'provisionable_synchronously', 'provisionable_asynchronously',
+                 'metadata', 'sync_timeout', 'async_timeout')
+
     def __init__(self, guid, name, description,
                  free=True,
                  metadata=None,
                  provisionable_synchronously=True,
                  provisionable_asynchronously=False,
+                 sync_timeout=None,
+                 async_timeout=None,
                  ):
         self.guid = guid
         self.name = name
@@ -61,6 +113,9 @@ class Plan:
         self.provisionable_synchronously = provisionable_synchronously
         self.provisionable_asynchronously = provisionable_asynchronously
         self.metadata = metadata
+        # broker behaviour, in seconds; None means the broker's defaults
+        self.sync_timeout = sync_timeout
+        self.async_timeout = async_timeout
 
     def as_dict(self):
         return {'id' if k == 'guid' else k: getattr(self, k) for k in ('guid', 'name', 'description')}
@@ -0,0 +1,157 @@
+from concurrent.futures import Future
+from threading import Lock
+from typing import Callable
+from exceptions import CurrentlyNotPossiblePlanChangeError
+import logging
+
+logging.basicConfig(level=logging.DEBUG)
+log = logging.getLogger()
+
+# What a PendingUpdate's future resolves to when it turned out to change nothing
+NO_CHANGES = object()
+
+
+def merge_parameters(base: dict, patch: dict) -> dict:
+    # The parameters of a PATCH update the ones already applied key by key, and a null value removes the key
+    merged = dict(base or {})
+    for key, value in (patch or {}).items():
+        if value is None:
+            merged.pop(key, None)
+        else:
+            merged[key] = value
+    return merged
+
+
+class InstanceDiff:
+    # What an update changes about an instance: its plan, and which top level parameters it adds, changes (with
+    # the old and new value) or removes (with the old value)
+    __slots__ = ('previous_plan_id', 'plan_id', 'added', 'changed', 'removed')
+
+    def __init__(self, previous_plan_id: str, plan_id: str, added: dict, changed: dict, removed: dict):
+        self.previous_plan_id = previous_plan_id
+        self.plan_id = plan_id
+        self.added = added
+        self.changed = changed
+        self.removed = removed
+
+    @property
+    def plan_changed(self) -> bool:
+        return self.plan_id != self.previous_plan_id
+
+    @property
+    def empty(self) -> bool:
+        return not (self.plan_changed or self.added or self.changed or self.removed)
+
+    def as_dict(self) -> dict:
+        return {"previous_plan_id": self.previous_plan_id, "plan_id": self.plan_id, "added": self.added,
+                "changed": {k: {"old": old, "new": new} for k, (old, new) in self.changed.items()},
+                "removed": self.removed}
+
+    def __repr__(self):
+        return "InstanceDiff(%r)" % self.as_dict()
+
+
+def diff_instance(previous_plan_id: str, previous: dict, plan_id: str, parameters: dict) -> InstanceDiff:
+    previous, parameters = previous or {}, parameters or {}
+    added = {k: v for k, v in parameters.items() if k not in previous}
+    changed = {k: (previous[k], v) for k, v in parameters.items() if k in previous and previous[k] != v}
+    removed = {k: v for k, v in previous.items() if k not in parameters}
+    return InstanceDiff(previous_plan_id, plan_id, added, changed, removed)
+
+
+class PendingUpdate:
+    # One backend update of an instance, standing for every PATCH merged into it.  parameters is the PATCHes'
+    # parameters merged in order, the later ones winning; previous_values is the first PATCH's.
+    __slots__ = ('service_id', 'plan_id', 'parameters', 'previous_values', 'sync', 'requests', 'future')
+
+    def __init__(self, service_id: str, plan_id: str, parameters: dict, previous_values: dict, sync: bool):
+        self.service_id = service_id
+        self.plan_id = plan_id
+        self.parameters = dict(parameters or {})
+        self.previous_values = previous_values
+        self.sync = sync
+        self.requests = 1
+        self.future = Future()
+
+    def merge(self, service_id: str, plan_id: str, parameters: dict, sync: bool):
+        if sync != self.sync:
+            # The merged update can't both answer synchronously and be polled through last_operation
+            raise CurrentlyNotPossiblePlanChangeError
+        self.service_id = service_id
+        self.plan_id = plan_id
+        # Nulls are kept, so the update still removes those keys from what was applied before
+        self.parameters.update(parameters or {})
+        self.requests += 1
+
+
+class UpdateQueue:
+    # Runs at most one update of an instance at a time.  PATCHes for an instance that arrive while its update is
+    # running merge into one pending update, which starts when the running one is done: however many arrive, the
+    # backend sees two updates.  start(instance_id, update, deferred) begins an update, returning its future, or
+    # None when there is nothing to change; deferred is True for pending updates started once their turn came.
+    def __init__(self, start: Callable):
+        self._start = start
+        # instance_id -> the PendingUpdate waiting for the running update, or None if nothing is waiting
+        self._instances = {}
+        self._lock = Lock()
+
+    def submit(self, instance_id: str, service_id: str, plan_id: str, parameters: dict, previous_values: dict,
+               sync: bool) -> (PendingUpdate, bool):
+        # The update this request is part of, and whether it was merged into one waiting for another update
+        with self._lock:
+            if instance_id in self._instances:
+                update = self._instances[instance_id]
+                if update is None:
+                    update = self._instances[instance_id] = PendingUpdate(service_id, plan_id, parameters,
+                                                                          previous_values, sync)
+                else:
+                    update.merge(service_id, plan_id, parameters, sync)
+                    log.debug("merged a PATCH of instance %s, %d waiting", instance_id, update.requests)
+                return update, True
+            self._instances[instance_id] = None
+        update = PendingUpdate(service_id, plan_id, parameters, previous_values, sync)
+        self._run(instance_id, update, False)
+        return update, False
+
+    def waiting(self, instance_id: str) -> PendingUpdate:
+        return self._instances.get(instance_id)
+
+    def _run(self, instance_id: str, update: PendingUpdate, deferred: bool):
+        try:
+            future = self._start(instance_id, update, deferred)
+        except BaseException as e:
+            self._settle(update.future, exception=e)
+            self._next(instance_id)
+            return
+        if future is None:
+            self._settle(update.future, NO_CHANGES)
+            self._next(instance_id)
+            return
+
+        def done(f):
+            if f.cancelled():
+                update.future.cancel()
+            elif f.exception() is not None:
+                self._settle(update.future, exception=f.exception())
+            else:
+                self._settle(update.future, f.result())
+            self._next(instance_id)
+        future.add_done_callback(done)
+
+    @staticmethod
+    def _settle(future: Future, result=None, exception: BaseException=None):
+        # A caller that gave up waiting may have cancelled the future already
+        if future.set_running_or_notify_cancel():
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+
+    def _next(self, instance_id: str):
+        with self._lock:
+            update = self._instances.get(instance_id)
+            if update is None:
+                self._instances.pop(instance_id, None)
+                return
+            self._instances[instance_id] = None
+        self._run(instance_id, update, True)
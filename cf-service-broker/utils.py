@@ -1,9 +1,39 @@
 from functools import wraps
-from flask import request, make_response, jsonify
+from time import perf_counter
+from flask import Response, request, make_response
+from admission import retry_after_header
+from auth import Authenticator
+from exceptions import InvalidRequestError
+from schema import validate
+import codec
+import metrics
 
 
 def json_response(o, code):
-    return make_response((jsonify(o), code, {"Content-Type": "application/json"}))
+    return Response(codec.EMPTY_OBJECT if o == {} else codec.dumps(o), code, mimetype='application/json')
+
+
+def error_response(e, code):
+    metrics.errors.inc(e.__class__.__name__)
+    return Response(codec.encoded_msg(e), code, mimetype='application/json')
+
+
+def rate_limited_response(e):
+    response = error_response(e, 429)
+    response.headers['Retry-After'] = retry_after_header(e)
+    return response
+
+
+def etag_response(body, etag, content_encoding=None):
+    if request.if_none_match.contains(etag):
+        response = make_response(('', 304))
+    else:
+        response = make_response((body, 200, {"Content-Type": "application/json"}))
+        if content_encoding:
+            response.headers['Content-Encoding'] = content_encoding
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    return response
 
 
 def check_api_version(api_version):
@@ -21,11 +51,19 @@ def check_api_version(api_version):
 
 
 def basic_auth(username, password):
+    return authenticated(Authenticator.from_passwords({username: password}))
+
+
+def authenticated(authenticator):
     def specific_basic_auth(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
+            started = perf_counter()
             auth = request.authorization
-            if not auth or not (auth.username == username and auth.password == password):
+            authorized = (auth and auth.username is not None and auth.password is not None and
+                          authenticator.check(auth.username, auth.password))
+            metrics.auth_duration.observe(perf_counter() - started)
+            if not authorized:
                 return make_response(("Not authorized", 401, {'Content-Type': 'text/plain'}))
             return f(*args, **kwargs)
         return decorated_function
@@ -38,8 +76,28 @@ def json_data_in(f):
         if request.content_type != 'application/json':
             return make_response(("Unsupported content type %s in request, application/json expected" % request.content_type,
                                   409, {"Content-Type": "text/plain"}))
-        data = request.get_json(force=True)
-        if data is None:
-            raise Exception('No data in request body')
+        started = perf_counter()
+        try:
+            data = codec.loads(request.get_data(cache=False))
+        except ValueError:
+            return json_response({"description": "request body is not valid JSON"}, 400)
+        finally:
+            metrics.json_decode_duration.observe(perf_counter() - started)
+        if not isinstance(data, dict):
+            return json_response({"description": "request body must be a JSON object"}, 400)
         return f(data, *args, **kwargs)
-    return decorated_function
\ No newline at end of file
+    return decorated_function
+
+
+def validated(schema):
+    # Turns the decoded body into the keyword arguments described by schema, or answers 400 with every problem
+    def validate_request(f):
+        @wraps(f)
+        def decorated_function(data, *args, **kwargs):
+            try:
+                data = validate(schema, data)
+            except InvalidRequestError as e:
+                return error_response(e, 400)
+            return f(data, *args, **kwargs)
+        return decorated_function
+    return validate_request
\ No newline at end of file
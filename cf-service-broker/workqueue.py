@@ -0,0 +1,281 @@
+from concurrent.futures import Future
+from threading import Event, Lock, Thread, local
+from time import time
+from typing import Iterable, List
+from uuid import uuid4
+from exceptions import OperationFailedError
+from executor import NORMAL
+from opstore import FAILED, SUCCEEDED
+import asyncio
+import json
+import os
+import socket
+import sqlite3
+import logging
+
+logging.basicConfig(level=logging.DEBUG)
+log = logging.getLogger()
+
+QUEUED = "queued"
+LEASED = "leased"
+
+
+class Job:
+    __slots__ = ('id', 'instance_id', 'kind', 'service_id', 'plan_id', 'args', 'priority', 'attempts', 'owner',
+                 'lease_expires')
+
+    def __init__(self, id, instance_id, kind, service_id, plan_id, args, priority=NORMAL, attempts=0, owner=None,
+                 lease_expires=None):
+        self.id = id
+        self.instance_id = instance_id
+        self.kind = kind
+        self.service_id = service_id
+        self.plan_id = plan_id
+        self.args = args
+        self.priority = priority
+        self.attempts = attempts
+        self.owner = owner
+        self.lease_expires = lease_expires
+
+
+class WorkQueue:
+    # Async operations shared by every broker node.  A node claims jobs under a lease it has to keep renewing; a job
+    # whose lease has run out belongs to a node that died, and another node can requeue or fail it.  The owner
+    # arguments make every change conditional on the caller still holding the job.
+    def enqueue(self, instance_id: str, kind: str, service_id: str, plan_id: str, args: Iterable,
+                priority: int=NORMAL) -> int:
+        raise NotImplementedError
+
+    def claim(self, owner: str, limit: int, lease: float) -> List[Job]:
+        raise NotImplementedError
+
+    def renew(self, owner: str, job_ids: Iterable[int], lease: float) -> set:
+        # Returns the ids of the jobs owner still holds
+        raise NotImplementedError
+
+    def complete(self, job_id: int, owner: str) -> bool:
+        raise NotImplementedError
+
+    def expired(self, now: float=None) -> List[Job]:
+        raise NotImplementedError
+
+    def requeue(self, job_id: int, owner: str) -> bool:
+        raise NotImplementedError
+
+    def count_by_state(self) -> dict:
+        raise NotImplementedError
+
+
+class SQLiteWorkQueue(WorkQueue):
+    # For nodes sharing a filesystem, and for trying multi-node mode on one machine.  Claims run in an IMMEDIATE
+    # transaction, so SQLite's file lock makes sure each job goes to one node.
+    def __init__(self, path: str):
+        self.path = path
+        self._local = local()
+        with self._connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                         "id INTEGER PRIMARY KEY AUTOINCREMENT, instance_id TEXT NOT NULL, kind TEXT NOT NULL, "
+                         "service_id TEXT NOT NULL, plan_id TEXT NOT NULL, args TEXT NOT NULL, "
+                         "priority INTEGER NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, state TEXT NOT NULL, "
+                         "owner TEXT, lease_expires REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_state_priority ON jobs (state, priority, id)")
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _job(row) -> Job:
+        return Job(row[0], row[1], row[2], row[3], row[4], json.loads(row[5]), *row[6:])
+
+    def enqueue(self, instance_id: str, kind: str, service_id: str, plan_id: str, args: Iterable,
+                priority: int=NORMAL) -> int:
+        with self._connection() as conn:
+            return conn.execute("INSERT INTO jobs (instance_id, kind, service_id, plan_id, args, priority, state) "
+                                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                (instance_id, kind, service_id, plan_id, json.dumps(list(args)), priority,
+                                 QUEUED)).lastrowid
+
+    def claim(self, owner: str, limit: int, lease: float) -> List[Job]:
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute("SELECT id, instance_id, kind, service_id, plan_id, args, priority, attempts + 1 "
+                                "FROM jobs WHERE state = ? ORDER BY priority, id LIMIT ?", (QUEUED, limit)).fetchall()
+            expires = time() + lease
+            conn.executemany("UPDATE jobs SET state = ?, owner = ?, lease_expires = ?, attempts = attempts + 1 "
+                             "WHERE id = ?", [(LEASED, owner, expires, row[0]) for row in rows])
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        return [self._job(row + (owner, expires)) for row in rows]
+
+    def renew(self, owner: str, job_ids: Iterable[int], lease: float) -> set:
+        job_ids = list(job_ids)
+        if not job_ids:
+            return set()
+        with self._connection() as conn:
+            conn.execute("UPDATE jobs SET lease_expires = ? WHERE owner = ? AND state = ? AND id IN (%s)" %
+                         ",".join("?" * len(job_ids)), [time() + lease, owner, LEASED] + job_ids)
+            return {row[0] for row in conn.execute("SELECT id FROM jobs WHERE owner = ? AND state = ? AND id IN (%s)" %
+                                                   ",".join("?" * len(job_ids)), [owner, LEASED] + job_ids)}
+
+    def complete(self, job_id: int, owner: str) -> bool:
+        with self._connection() as conn:
+            return conn.execute("DELETE FROM jobs WHERE id = ? AND owner = ?", (job_id, owner)).rowcount == 1
+
+    def expired(self, now: float=None) -> List[Job]:
+        rows = self._connection().execute("SELECT id, instance_id, kind, service_id, plan_id, args, priority, "
+                                          "attempts, owner, lease_expires FROM jobs "
+                                          "WHERE state = ? AND lease_expires < ?",
+                                          (LEASED, now if now is not None else time())).fetchall()
+        return [self._job(row) for row in rows]
+
+    def requeue(self, job_id: int, owner: str) -> bool:
+        with self._connection() as conn:
+            return conn.execute("UPDATE jobs SET state = ?, owner = NULL, lease_expires = NULL "
+                                "WHERE id = ? AND owner = ? AND state = ?",
+                                (QUEUED, job_id, owner, LEASED)).rowcount == 1
+
+    def count_by_state(self) -> dict:
+        return dict(self._connection().execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+
+
+class CoroutineRunner:
+    # Lets AsyncBaseService methods run on the executor when a job is claimed outside an event loop.  Signature
+    # lookups follow __wrapped__, so cancel_token and progress are still passed to methods that declare them.
+    def __init__(self, func):
+        self.func = func
+        self.__wrapped__ = func
+
+    def __call__(self, *args, **kwargs):
+        return asyncio.run(self.func(*args, **kwargs))
+
+
+class WorkerNode:
+    # Runs one broker node's share of the work queue on a background thread: claims queued jobs while it has fewer
+    # than concurrency of them running, renews their leases, requeues or fails jobs whose node has stopped renewing,
+    # and resolves the futures of operations this node enqueued once the shared operation store shows them finished.
+    def __init__(self, broker, queue: WorkQueue, node_id: str=None, concurrency: int=None, lease: float=30,
+                 poll_interval: float=0.5, max_attempts: int=3):
+        self.broker = broker
+        self.queue = queue
+        self.node_id = node_id or "%s:%d:%s" % (socket.gethostname(), os.getpid(), uuid4().hex[:8])
+        self.concurrency = concurrency if concurrency is not None else broker.executor.max_workers
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        # job id -> Job for jobs running on this node
+        self.held = {}
+        # instance_id -> futures of operations enqueued by this node
+        self.waiting = {}
+        self._next_renewal = 0
+        self._lock = Lock()
+        self._stopped = Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = Thread(target=self._run, name='broker-worker-node', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def submit(self, instance_id: str, kind: str, service_id: str, plan_id: str, args: tuple,
+               priority: int=NORMAL) -> Future:
+        future = Future()
+        future.set_running_or_notify_cancel()
+        self.queue.enqueue(instance_id, kind, service_id, plan_id, args, priority)
+        with self._lock:
+            self.waiting.setdefault(instance_id, []).append(future)
+        return future
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                claimed = self.run_once()
+            except Exception:
+                log.exception("worker node %s failed to poll the work queue", self.node_id)
+                claimed = 0
+            if not claimed:
+                self._stopped.wait(self.poll_interval)
+
+    def run_once(self) -> int:
+        now = time()
+        if now >= self._next_renewal:
+            self._renew()
+            self._next_renewal = now + self.lease / 3
+        self._reap(now)
+        self._resolve()
+        with self._lock:
+            free = self.concurrency - len(self.held)
+        jobs = self.queue.claim(self.node_id, free, self.lease) if free > 0 else []
+        for job in jobs:
+            self._start(job)
+        return len(jobs)
+
+    def _start(self, job: Job):
+        try:
+            future = self.broker.run_job(job)
+        except Exception as e:
+            log.exception("could not start %s of instance %s", job.kind, job.instance_id)
+            self.queue.complete(job.id, self.node_id)
+            self.broker._fail_operation(job.instance_id, e)
+            return
+        with self._lock:
+            self.held[job.id] = job
+        future.add_done_callback(lambda f: self._finished(job))
+
+    def _finished(self, job: Job):
+        with self._lock:
+            self.held.pop(job.id, None)
+        if not self.queue.complete(job.id, self.node_id):
+            log.warning("%s of instance %s finished after its lease was lost", job.kind, job.instance_id)
+
+    def _renew(self):
+        with self._lock:
+            held = list(self.held)
+        for job_id in set(held) - self.queue.renew(self.node_id, held, self.lease):
+            log.warning("worker node %s lost the lease on job %s", self.node_id, job_id)
+
+    def _reap(self, now: float):
+        for job in self.queue.expired(now):
+            service = self.broker.services.get(job.service_id)
+            if service is not None and service.idempotent and job.attempts < self.max_attempts:
+                if self.queue.requeue(job.id, job.owner):
+                    log.warning("requeued %s of instance %s from unresponsive node %s", job.kind, job.instance_id,
+                                job.owner)
+            elif self.queue.complete(job.id, job.owner):
+                log.warning("failing %s of instance %s, its node %s stopped responding", job.kind, job.instance_id,
+                            job.owner)
+                self.broker._update_operation(job.instance_id, FAILED,
+                                              "the broker node running the operation stopped responding")
+
+    def _resolve(self):
+        with self._lock:
+            instance_ids = list(self.waiting)
+        if not instance_ids:
+            return
+        for instance_id, op in self.broker.operations.get_many(instance_ids).items():
+            if not op.finished:
+                continue
+            with self._lock:
+                futures = self.waiting.pop(instance_id, [])
+            for future in futures:
+                if op.state == SUCCEEDED:
+                    future.set_result(None)
+                else:
+                    future.set_exception(OperationFailedError(op.description))
+
+
+def work_queue_from_environment() -> WorkQueue:
+    # BROKER_WORK_QUEUE names a SQLite database shared by every node, which should also share the operation store
+    path = os.environ.get('BROKER_WORK_QUEUE')
+    return SQLiteWorkQueue(path) if path else None
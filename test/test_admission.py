@@ -0,0 +1,91 @@
+from unittest import TestCase
+from threading import Event
+from admission import AdmissionController, Limit
+from exceptions import RateLimitedError
+import executor
+import os
+
+
+class AdmissionTestCase(TestCase):
+    def test_rate_limit(self):
+        controller = AdmissionController(service_limits={"s1": Limit(rate=1, burst=2)})
+        controller.admit('create', "s1", "p1").release()
+        controller.admit('create', "s1", "p1").release()
+        with self.assertRaises(RateLimitedError) as cm:
+            controller.admit('create', "s1", "p1")
+        self.assertGreater(cm.exception.retry_after, 0)
+        self.assertLessEqual(cm.exception.retry_after, 1)
+        # Cleanup isn't rate limited, and other services aren't affected
+        controller.admit('delete', "s1", "p1").release()
+        controller.admit('create', "s2", "p1").release()
+        self.assertEqual(controller.rejected, 1)
+
+    def test_concurrency_reserve(self):
+        controller = AdmissionController(plan_limits={"p1": Limit(max_concurrency=2, reserve=1)})
+        create = controller.admit('create', "s1", "p1")
+        self.assertRaises(RateLimitedError, controller.admit, 'bind', "s1", "p1")
+        delete = controller.admit('delete', "s1", "p1")
+        self.assertRaises(RateLimitedError, controller.admit, 'unbind', "s1", "p1")
+        create.release()
+        create.release()
+        delete.release()
+        controller.admit('create', "s1", "p1")
+
+    def test_per_organization(self):
+        controller = AdmissionController(organization_limit=Limit(max_concurrency=1),
+                                         organization_limits={"big": Limit(max_concurrency=2)})
+        controller.admit('create', "s1", "p1", "org1")
+        self.assertRaises(RateLimitedError, controller.admit, 'create', "s1", "p1", "org1")
+        controller.admit('create', "s1", "p1", "org2")
+        controller.admit('create', "s1", "p1", "big")
+        controller.admit('create', "s1", "p1", "big")
+        self.assertRaises(RateLimitedError, controller.admit, 'create', "s1", "p1", "big")
+
+    def test_all_or_nothing(self):
+        controller = AdmissionController(service_limits={"s1": Limit(rate=1, burst=1)},
+                                         plan_limits={"p1": Limit(max_concurrency=0)})
+        self.assertRaises(RateLimitedError, controller.admit, 'create', "s1", "p1")
+        # The refused request didn't use the service's only token
+        controller.admit('create', "s1", "p2")
+
+    def test_idle_counters_are_swept(self):
+        controller = AdmissionController(organization_limit=Limit(max_concurrency=1), max_counters=10)
+        for i in range(100):
+            controller.admit('create', "s1", "p1", "org%d" % i).release()
+        self.assertLessEqual(len(controller._counters), 10)
+
+
+class ExecutorPriorityTestCase(TestCase):
+    def test_urgent_work_overtakes_queued_work(self):
+        pool = executor.BrokerExecutor(max_workers=1, use_processes=False)
+        started, release, order = Event(), Event(), []
+
+        def block():
+            started.set()
+            release.wait(5)
+        first = pool.submit("s1", block)
+        started.wait(5)
+        futures = [pool.submit("s1", order.append, name, priority=priority)
+                   for name, priority in (("create1", executor.NORMAL), ("create2", executor.NORMAL),
+                                          ("delete", executor.URGENT))]
+        release.set()
+        for future in [first] + futures:
+            future.result(timeout=5)
+        self.assertEqual(order, ["delete", "create1", "create2"])
+        self.assertEqual(pool.pending, 0)
+        pool.shutdown()
+
+    def test_executor_from_environment(self):
+        env = {'BROKER_MAX_WORKERS': '2', 'BROKER_MAX_PENDING': '10', 'BROKER_SERVICE_LIMITS': '{"s1": 3}',
+               'BROKER_EXECUTOR': 'threads'}
+        os.environ.update(env)
+        try:
+            pool = executor.executor_from_environment()
+            self.addCleanup(pool.shutdown)
+            self.assertEqual((pool.max_workers, pool.max_pending, pool.service_limits), (2, 10, {"s1": 3}))
+            self.assertFalse(pool.use_processes)
+            os.environ['BROKER_EXECUTOR'] = 'fibers'
+            self.assertRaises(ValueError, executor.executor_from_environment)
+        finally:
+            for name in env:
+                del os.environ[name]
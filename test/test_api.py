@@ -1,9 +1,13 @@
 from unittest import TestCase
 import json
 import base64
-from time import sleep
+import gzip
+from time import sleep, time
+import admission
 import api
 import broker
+import executor
+import profiling
 import service
 from exceptions import *
 import os
@@ -87,17 +91,27 @@ class APITestCase(TestCase):
         api.broker = broker.Broker(service_list=[self.service,])
 
     def tearDown(self):
+        api.broker.shutdown()
         try:
             self.service.delete_instance(self.instance_guid)
         except OSError:
             pass
 
-    def create_instance(self, async=False):
+    def wait_for_operation(self, instance_id, timeout=10):
+        deadline = time() + timeout
+        while True:
+            resp = self.tc.get('/v2/service_instances/' + instance_id + '/last_operation', headers=self.hdrs)
+            state = json.loads(resp.data.decode(encoding='UTF-8'))['state']
+            if state != 'in progress' or time() > deadline:
+                return state
+            sleep(0.05)
+
+    def create_instance(self, asynchronous=False):
         req_data = {"organization_guid": self.org_guid,
                     "plan_id": PLAN1_GUID,
                     "service_id": SERVICE1_GUID,
                     "space_guid": self.space_guid}
-        if async:
+        if asynchronous:
             req_data['accepts_incomplete'] = True
             req_data['plan_id'] = PLAN2_GUID
         return self.tc.put('/v2/service_instances/' + self.instance_guid, headers=self.hdrs, data=json.dumps(req_data))
@@ -111,6 +125,30 @@ class TestGetCatalog(APITestCase):
         svc_def = catalog['services'][0]
         self.assertEqual(svc_def['id'], SERVICE1_GUID)
 
+    def test_get_catalog_not_modified(self):
+        resp = self.tc.get('/v2/catalog', headers=self.hdrs)
+        etag = resp.headers['ETag']
+        hdrs = dict(self.hdrs)
+        hdrs['If-None-Match'] = etag
+        resp = self.tc.get('/v2/catalog', headers=hdrs)
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.headers['ETag'], etag)
+
+    def test_get_catalog_changes_with_services(self):
+        etag = self.tc.get('/v2/catalog', headers=self.hdrs).headers['ETag']
+        api.broker.remove_service(SERVICE1_GUID)
+        resp = self.tc.get('/v2/catalog', headers=self.hdrs)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+        self.assertEqual(json.loads(resp.data.decode('ascii')), {"services": []})
+
+    def test_get_catalog_gzip(self):
+        hdrs = dict(self.hdrs)
+        hdrs['Accept-Encoding'] = 'gzip'
+        resp = self.tc.get('/v2/catalog', headers=hdrs)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        catalog = json.loads(gzip.decompress(resp.data).decode('ascii'))
+        self.assertEqual(catalog['services'][0]['id'], SERVICE1_GUID)
+
 
 class TestAuth(APITestCase):
     def test_auth_denied_noauth(self):
@@ -139,15 +177,233 @@ class TestInstance(APITestCase):
         self.assertEqual(resp.status_code, 200)
 
     def test_create_instance_async(self):
-        resp = self.create_instance(async=True)
+        resp = self.create_instance(asynchronous=True)
         self.assertEqual(resp.status_code, 202)
         resp = self.tc.get('/v2/service_instances/' + self.instance_guid + '/last_operation', headers=self.hdrs)
         d = json.loads(resp.data.decode(encoding='UTF-8'))
         self.assertEqual(d['state'], 'in progress')
-        sleep(2)
+        self.assertEqual(self.wait_for_operation(self.instance_guid), 'succeeded')
+
+    def test_last_operation_unknown_instance(self):
         resp = self.tc.get('/v2/service_instances/' + self.instance_guid + '/last_operation', headers=self.hdrs)
-        d = json.loads(resp.data.decode(encoding='UTF-8'))
-        self.assertEqual(d['state'], 'succeeded')
+        self.assertEqual(resp.status_code, 410)
+
+    def test_last_operation_stream(self):
+        self.addCleanup(api.app.config.__setitem__, 'BROKER_PROGRESS_POLL_INTERVAL',
+                        api.app.config['BROKER_PROGRESS_POLL_INTERVAL'])
+        api.app.config['BROKER_PROGRESS_POLL_INTERVAL'] = 0.05
+        resp = self.create_instance(asynchronous=True)
+        self.assertEqual(resp.status_code, 202)
+        resp = self.tc.get('/v2/service_instances/' + self.instance_guid + '/last_operation/stream',
+                           headers=self.hdrs)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'text/event-stream')
+        events = [json.loads(line[len('data: '):]) for line in resp.data.decode('UTF-8').splitlines()
+                  if line.startswith('data: ')]
+        self.assertEqual(events[0]['state'], 'in progress')
+        self.assertEqual(events[-1]['state'], 'succeeded')
+        self.assertEqual(sum(e['state'] != 'in progress' for e in events), 1)
+        resp = self.tc.get('/v2/service_instances/nosuchinstance/last_operation/stream', headers=self.hdrs)
+        self.assertEqual(resp.status_code, 410)
+
+
+    def test_create_instance_retry(self):
+        resp = self.create_instance()
+        self.assertEqual(resp.status_code, 201)
+        resp = self.create_instance()
+        self.assertEqual(resp.status_code, 200)
+
+    def test_create_instance_conflict(self):
+        resp = self.create_instance()
+        self.assertEqual(resp.status_code, 201)
+        req_data = {"organization_guid": "another org", "plan_id": PLAN1_GUID, "service_id": SERVICE1_GUID,
+                    "space_guid": self.space_guid}
+        resp = self.tc.put('/v2/service_instances/' + self.instance_guid, headers=self.hdrs, data=json.dumps(req_data))
+        self.assertEqual(resp.status_code, 409)
+
+    def test_create_instance_ignores_unknown_fields(self):
+        req_data = {"organization_guid": self.org_guid, "plan_id": PLAN1_GUID, "service_id": SERVICE1_GUID,
+                    "space_guid": self.space_guid, "context": {"platform": "cloudfoundry"}, "maintenance_info": {}}
+        resp = self.tc.put('/v2/service_instances/' + self.instance_guid, headers=self.hdrs, data=json.dumps(req_data))
+        self.assertEqual(resp.status_code, 201)
+
+    def test_create_instance_invalid_body(self):
+        req_data = {"plan_id": PLAN1_GUID, "service_id": SERVICE1_GUID, "parameters": "not an object"}
+        resp = self.tc.put('/v2/service_instances/' + self.instance_guid, headers=self.hdrs, data=json.dumps(req_data))
+        self.assertEqual(resp.status_code, 400)
+        description = json.loads(resp.data.decode('UTF-8'))['description']
+        for problem in ("organization_guid is required", "space_guid is required", "parameters must be an object"):
+            self.assertIn(problem, description)
+        resp = self.tc.put('/v2/service_instances/' + self.instance_guid, headers=self.hdrs, data='[1, 2')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_create_instance_async_retry(self):
+        resp = self.create_instance(asynchronous=True)
+        self.assertEqual(resp.status_code, 202)
+        resp = self.create_instance(asynchronous=True)
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(self.wait_for_operation(self.instance_guid), 'succeeded')
+        resp = self.create_instance(asynchronous=True)
+        self.assertEqual(resp.status_code, 200)
+
+    def test_recreate_after_delete(self):
+        self.create_instance()
+        self.tc.delete('/v2/service_instances/' + self.instance_guid + '?service_id=' + SERVICE1_GUID
+                       + '&plan_id=' + PLAN1_GUID, headers=self.hdrs)
+        resp = self.create_instance()
+        self.assertEqual(resp.status_code, 201)
+
+    def test_modify_instance_without_changes(self):
+        self.service.plan_updateable = True
+        self.create_instance()
+        url = '/v2/service_instances/' + self.instance_guid
+        req_data = {"service_id": SERVICE1_GUID, "plan_id": PLAN1_GUID, "parameters": {"size": 2}}
+        resp = self.tc.patch(url, headers=self.hdrs, data=json.dumps(req_data))
+        self.assertEqual(resp.status_code, 201)
+        resp = self.tc.patch(url, headers=self.hdrs, data=json.dumps(req_data))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data.decode(encoding='UTF-8')), {})
+
+    def test_create_instance_unknown_service(self):
+        req_data = {"organization_guid": self.org_guid, "plan_id": PLAN1_GUID, "service_id": "nosuchservice",
+                    "space_guid": self.space_guid}
+        resp = self.tc.put('/v2/service_instances/' + self.instance_guid, headers=self.hdrs, data=json.dumps(req_data))
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(json.loads(resp.data.decode('UTF-8'))['error'], 'UnknownServiceError')
+
+    def test_delete_instance_unknown_plan(self):
+        resp = self.tc.delete('/v2/service_instances/' + self.instance_guid + '?service_id=' + SERVICE1_GUID
+                              + '&plan_id=nosuchplan', headers=self.hdrs)
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(json.loads(resp.data.decode('UTF-8'))['error'], 'UnknownPlanError')
+
+    def test_create_instance_broker_busy(self):
+        api.broker.shutdown()
+        api.broker = broker.Broker(service_list=[self.service, ], executor=executor.BrokerExecutor(max_pending=0))
+        resp = self.create_instance()
+        self.assertEqual(resp.status_code, 503)
+
+    def test_create_instance_service_busy(self):
+        api.broker.shutdown()
+        api.broker = broker.Broker(service_list=[self.service, ],
+                                   executor=executor.BrokerExecutor(service_limits={SERVICE1_GUID: 0}))
+        resp = self.create_instance()
+        self.assertEqual(resp.status_code, 429)
+
+    def test_create_instance_rate_limited(self):
+        api.broker.shutdown()
+        api.broker = broker.Broker(service_list=[self.service, ], admission=admission.AdmissionController(
+            organization_limit=admission.Limit(rate=0.5, burst=1)))
+        resp = self.create_instance()
+        self.assertEqual(resp.status_code, 201)
+        self.service.delete_instance(self.instance_guid)
+        self.instance_guid = str(uuid4())
+        resp = self.create_instance()
+        self.assertEqual(resp.status_code, 429)
+        self.assertEqual(resp.headers['Retry-After'], '2')
+        self.assertEqual(json.loads(resp.data.decode('UTF-8'))['error'], 'RateLimitedError')
+
+    def test_profiles(self):
+        resp = self.tc.get('/admin/profiles', headers=self.hdrs)
+        self.assertEqual(resp.status_code, 404)
+        api.broker.shutdown()
+        api.broker = broker.Broker(service_list=[self.service, ], profiler=profiling.Profiler([PLAN1_GUID]))
+        self.assertEqual(self.create_instance().status_code, 201)
+        deadline = time() + 10
+        profiles = []
+        while not profiles and time() < deadline:
+            # The worker process sends the profile back after the create has returned
+            sleep(0.05)
+            profiles = json.loads(self.tc.get('/admin/profiles', headers=self.hdrs).data.decode('UTF-8'))['profiles']
+        self.assertEqual([(p['service_id'], p['plan_id'], p['operation'], p['calls']) for p in profiles],
+                         [(SERVICE1_GUID, PLAN1_GUID, 'create', 1)])
+        resp = self.tc.get('/admin/profiles/%s/%s/create?sort=tottime' % (SERVICE1_GUID, PLAN1_GUID),
+                           headers=self.hdrs)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('create_instance', resp.data.decode('UTF-8'))
+        resp = self.tc.post('/admin/profiles/dump', headers=self.hdrs)
+        self.assertEqual(resp.status_code, 409)
+
+
+class TestMetrics(APITestCase):
+    def test_metrics(self):
+        self.create_instance()
+        self.tc.get('/v2/catalog', headers={})
+        resp = self.tc.get('/metrics')
+        self.assertEqual(resp.status_code, 200)
+        text = resp.data.decode('UTF-8')
+        self.assertIn('broker_http_request_duration_seconds_count{route="/v2/catalog",method="GET",status="409"}', text)
+        self.assertIn('broker_operation_duration_seconds_count{service="%s",plan="%s",operation="create",'
+                      'outcome="succeeded"}' % (SERVICE1_GUID, PLAN1_GUID), text)
+        self.assertIn('broker_executor_queue_wait_seconds_count', text)
+        self.assertIn('broker_executor_pending 0.0', text)
+
+
+class TestBatch(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.extra_guids = [str(uuid4()), str(uuid4())]
+
+    def tearDown(self):
+        super().tearDown()
+        for instance_guid in self.extra_guids:
+            try:
+                self.service.delete_instance(instance_guid)
+            except OSError:
+                pass
+
+    def test_batch_create_and_poll(self):
+        operations = [{"action": "create", "instance_id": self.instance_guid, "organization_guid": self.org_guid,
+                       "plan_id": PLAN1_GUID, "service_id": SERVICE1_GUID, "space_guid": self.space_guid},
+                      {"action": "create", "instance_id": self.extra_guids[0], "organization_guid": self.org_guid,
+                       "plan_id": PLAN2_GUID, "service_id": SERVICE1_GUID, "space_guid": self.space_guid,
+                       "accepts_incomplete": True},
+                      {"action": "create", "instance_id": self.extra_guids[1], "plan_id": PLAN1_GUID},
+                      {"action": "resize", "instance_id": "whatever"}]
+        resp = self.tc.post('/v2/batch/service_instances', headers=self.hdrs,
+                            data=json.dumps({"operations": operations}))
+        self.assertEqual(resp.status_code, 200)
+        results = json.loads(resp.data.decode('UTF-8'))['results']
+        self.assertEqual([r['status'] for r in results], [201, 202, 400, 400])
+        self.assertEqual(results[0]['instance_id'], self.instance_guid)
+        resp = self.tc.post('/v2/batch/last_operation', headers=self.hdrs,
+                            data=json.dumps({"instance_ids": [self.extra_guids[0], "nosuchinstance"]}))
+        results = json.loads(resp.data.decode('UTF-8'))['results']
+        self.assertEqual(results[0]['status'], 200)
+        self.assertEqual(results[0]['body']['state'], "in progress")
+        self.assertIn(results[0]['body']['description'], ("queued", "running"))
+        self.assertEqual(results[1]['status'], 410)
+
+    def test_batch_gzipped(self):
+        instance_ids = [str(uuid4()) for _ in range(40)]
+        resp = self.tc.post('/v2/batch/last_operation', headers=dict(self.hdrs, **{'Accept-Encoding': 'gzip'}),
+                            data=json.dumps({"instance_ids": instance_ids}))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        results = json.loads(gzip.decompress(resp.data).decode('UTF-8'))['results']
+        self.assertEqual([r['instance_id'] for r in results], instance_ids)
+        resp = self.tc.post('/v2/batch/last_operation', headers=self.hdrs, data=json.dumps({"instance_ids": ["a"]}))
+        self.assertNotIn('Content-Encoding', resp.headers)
+
+    def test_batch_last_operation_ids(self):
+        resp = self.tc.post('/v2/batch/last_operation', headers=self.hdrs,
+                            data=json.dumps({"instance_ids": ["b", "a", "b"]}))
+        results = json.loads(resp.data.decode('UTF-8'))['results']
+        self.assertEqual([(r['instance_id'], r['status']) for r in results], [("b", 410), ("a", 410), ("b", 410)])
+        for body in ({"instance_ids": ["a", 1]}, {"instance_ids": "a"}, {}, {"instance_ids": [{}]}):
+            resp = self.tc.post('/v2/batch/last_operation', headers=self.hdrs, data=json.dumps(body))
+            self.assertEqual(resp.status_code, 400)
+        self.assertEqual(json.loads(resp.data.decode('UTF-8'))['description'],
+                         "invalid request: every element of instance_ids must be a string")
+
+    def test_batch_too_large(self):
+        api.app.config['BROKER_MAX_BATCH_SIZE'] = 1
+        try:
+            resp = self.tc.post('/v2/batch/last_operation', headers=self.hdrs,
+                                data=json.dumps({"instance_ids": ["a", "b"]}))
+        finally:
+            api.app.config['BROKER_MAX_BATCH_SIZE'] = 500
+        self.assertEqual(resp.status_code, 413)
 
 
 class TestBinding(APITestCase):
@@ -168,6 +424,17 @@ class TestBinding(APITestCase):
         self.assertIn('credentials', d)
         self.assertEqual(d['credentials'], {'file': self.service._path(self.instance_guid, self.binding_id)})
 
+    def test_bind_instance_retry(self):
+        self.create_instance()
+        self.bind_instance()
+        os.unlink(self.service._path(self.instance_guid, self.binding_id))
+        resp = self.bind_instance()
+        self.assertEqual(resp.status_code, 200)
+        d = json.loads(resp.data.decode(encoding='UTF-8'))
+        self.assertEqual(d['credentials'], {'file': self.service._path(self.instance_guid, self.binding_id)})
+        # The retry was answered by the broker without calling the service's bind again
+        self.assertFalse(os.path.exists(self.service._path(self.instance_guid, self.binding_id)))
+
     def test_unbind_instance(self):
         resp = self.create_instance()
         resp = self.bind_instance()
@@ -0,0 +1,202 @@
+from unittest import IsolatedAsyncioTestCase
+import asyncio
+import base64
+import json
+import asgi
+import auth
+import async_broker
+import executor
+import service
+import threading
+
+SERVICE1_GUID = '4d29b1b1-63c3-425e-97e4-913be8fdaf19'
+PLAN1_GUID = 'e1697e2c-967e-4b4c-8eea-a20d0b2a41d0'
+PLAN2_GUID = 'd9edc392-68d6-4622-a760-5be7d76efca3'
+
+
+class MemoryService(service.AsyncBaseService):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.instances = {}
+        self.bindings = {}
+
+    async def create_instance(self, instance_id, plan_id, parameters, organization_guid, space_guid, progress=None):
+        if not self.plans[plan_id].provisionable_synchronously:
+            progress(50, "filling")
+            await asyncio.sleep(0.1)
+        self.instances[instance_id] = plan_id
+
+    async def delete_instance(self, instance_id):
+        del self.instances[instance_id]
+
+    async def bind(self, instance_id, binding_id, plan_id, app_guid, parameters):
+        self.bindings[binding_id] = instance_id
+        return {"instance": instance_id}
+
+    async def unbind(self, instance_id, binding_id, plan_id):
+        del self.bindings[binding_id]
+
+
+class SyncMemoryService(service.BaseService):
+    instances = {}
+
+    def create_instance(self, instance_id, plan_id, parameters, organization_guid, space_guid):
+        self.instances[instance_id] = plan_id
+
+
+class ASGITestCase(IsolatedAsyncioTestCase):
+    authenticator = auth.Authenticator.from_passwords({'u': 'p'})
+
+    def setUp(self):
+        self.hdrs = {'X-Broker-Api-Version': '2.7',
+                     'Content-Type': 'application/json',
+                     'Authorization': 'Basic ' + base64.b64encode(b"u:p").decode("ascii")}
+        plan_1 = service.Plan(guid=PLAN1_GUID, name="small plan", description="A small generic service plan")
+        plan_2 = service.Plan(guid=PLAN2_GUID, name="large plan", description="A large generic service plan",
+                              provisionable_synchronously=False)
+        self.service = MemoryService(guid=SERVICE1_GUID, name="memory_service", description="Dicts as a service",
+                                     bindable=True, plans={plan_1.guid: plan_1, plan_2.guid: plan_2})
+        self.broker = async_broker.AsyncBroker(service_list=[self.service],
+                                               executor=executor.BrokerExecutor(use_processes=False))
+        self.app = asgi.BrokerApp(self.broker, self.authenticator)
+
+    def tearDown(self):
+        self.broker.shutdown()
+
+    async def request(self, method, path, data=None, headers=None, query_string=b''):
+        path, _, query_string = path.partition('?')
+        body = json.dumps(data).encode('utf-8') if data is not None else b''
+        scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query_string.encode('ascii'),
+                 'headers': [(k.lower().encode('latin-1'), v.encode('latin-1'))
+                             for k, v in (headers if headers is not None else self.hdrs).items()]}
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': body}
+
+        async def send(message):
+            messages.append(message)
+
+        await self.app(scope, receive, send)
+        status = messages[0]['status']
+        content = b''.join(m['body'] for m in messages[1:])
+        if (b'content-type', b'application/json') in messages[0]['headers']:
+            content = json.loads(content.decode('utf-8'))
+        return status, content
+
+    def create_request(self, plan_id=PLAN1_GUID, accepts_incomplete=False):
+        return {"organization_guid": "org1", "plan_id": plan_id, "service_id": SERVICE1_GUID,
+                "space_guid": "space1", "accepts_incomplete": accepts_incomplete}
+
+
+class TestASGI(ASGITestCase):
+    async def test_get_catalog(self):
+        status, catalog = await self.request('GET', '/v2/catalog')
+        self.assertEqual(status, 200)
+        self.assertEqual(catalog['services'][0]['id'], SERVICE1_GUID)
+
+    async def test_get_catalog_etag(self):
+        status, _ = await self.request('GET', '/v2/catalog')
+        hdrs = dict(self.hdrs, **{'Accept-Encoding': 'gzip'})
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b''}
+
+        async def send(message):
+            messages.append(message)
+        scope = {'type': 'http', 'method': 'GET', 'path': '/v2/catalog', 'query_string': b'',
+                 'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in hdrs.items()]}
+        await self.app(scope, receive, send)
+        headers = dict(messages[0]['headers'])
+        self.assertEqual(headers[b'content-encoding'], b'gzip')
+        etag = headers[b'etag'].decode('latin-1')
+        status, _ = await self.request('GET', '/v2/catalog', headers=dict(hdrs, **{'If-None-Match': etag}))
+        self.assertEqual(status, 304)
+        status, _ = await self.request('GET', '/v2/catalog', headers=dict(self.hdrs, **{'If-None-Match': etag}))
+        self.assertEqual(status, 200)
+        self.app.gzip_catalog = False
+        await self.app(scope, receive, send)
+        self.assertNotIn(b'content-encoding', dict(messages[-2]['headers']))
+
+    async def test_auth_denied(self):
+        hdrs = dict(self.hdrs)
+        hdrs['Authorization'] = 'Basic ' + base64.b64encode(b"wrong:creds").decode("ascii")
+        status, _ = await self.request('GET', '/v2/catalog', headers=hdrs)
+        self.assertEqual(status, 401)
+
+    async def test_auth_check_off_the_loop(self):
+        threads = []
+
+        class RecordingAuthenticator(auth.Authenticator):
+            def check(self, username, password):
+                threads.append(threading.get_ident())
+                return super().check(username, password)
+        self.app.authenticator = RecordingAuthenticator.from_passwords({'u': 'p'})
+        hdrs = dict(self.hdrs)
+        hdrs['Authorization'] = 'Basic ' + base64.b64encode(b"u:wrong").decode("ascii")
+        status, _ = await self.request('GET', '/v2/catalog', headers=hdrs)
+        self.assertEqual(status, 401)
+        for _ in range(2):
+            status, _ = await self.request('GET', '/v2/catalog', headers=self.hdrs)
+            self.assertEqual(status, 200)
+        # The password is hashed in an executor thread, and the second good request is answered from the cache
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(threading.get_ident(), threads)
+
+    async def test_create_and_delete_instance(self):
+        status, _ = await self.request('PUT', '/v2/service_instances/i1', self.create_request())
+        self.assertEqual(status, 201)
+        self.assertIn('i1', self.service.instances)
+        status, _ = await self.request('DELETE', '/v2/service_instances/i1?service_id=%s&plan_id=%s' %
+                                       (SERVICE1_GUID, PLAN1_GUID))
+        self.assertEqual(status, 200)
+        self.assertNotIn('i1', self.service.instances)
+
+    async def test_create_instance_async(self):
+        status, _ = await self.request('PUT', '/v2/service_instances/i1',
+                                       self.create_request(PLAN2_GUID, accepts_incomplete=True))
+        self.assertEqual(status, 202)
+        status, d = await self.request('GET', '/v2/service_instances/i1/last_operation')
+        self.assertEqual(d['state'], 'in progress')
+        await asyncio.sleep(0.3)
+        status, d = await self.request('GET', '/v2/service_instances/i1/last_operation')
+        self.assertEqual(d['state'], 'succeeded')
+
+    async def test_last_operation_stream(self):
+        self.app.progress_poll_interval = 0.02
+        await self.request('PUT', '/v2/service_instances/i1', self.create_request(PLAN2_GUID, accepts_incomplete=True))
+        status, content = await self.request('GET', '/v2/service_instances/i1/last_operation/stream')
+        self.assertEqual(status, 200)
+        events = [json.loads(line[len('data: '):]) for line in content.decode('utf-8').splitlines()
+                  if line.startswith('data: ')]
+        self.assertIn('filling (50%)', [e.get('description') for e in events])
+        self.assertEqual(events[-1]['state'], 'succeeded')
+
+    async def test_bind_and_unbind(self):
+        await self.request('PUT', '/v2/service_instances/i1', self.create_request())
+        status, d = await self.request('PUT', '/v2/service_instances/i1/service_bindings/b1',
+                                       {"plan_id": PLAN1_GUID, "service_id": SERVICE1_GUID, "app_guid": "app1"})
+        self.assertEqual(status, 201)
+        self.assertEqual(d['credentials'], {"instance": "i1"})
+        status, _ = await self.request('DELETE', '/v2/service_instances/i1/service_bindings/b1?service_id=%s&plan_id=%s'
+                                       % (SERVICE1_GUID, PLAN1_GUID))
+        self.assertEqual(status, 200)
+        self.assertEqual(self.service.bindings, {})
+
+    async def test_bind_unknown_plan_retry(self):
+        data = {"plan_id": "nosuchplan", "service_id": SERVICE1_GUID, "app_guid": "app1"}
+        for _ in range(2):
+            status, _ = await asyncio.wait_for(self.request('PUT', '/v2/service_instances/i1/service_bindings/b1',
+                                                            data), 5)
+            self.assertEqual(status, 400)
+
+    async def test_create_instance_sync_service(self):
+        sync_service = SyncMemoryService(guid="sync-service", name="sync_service", description="Blocking dicts",
+                                         bindable=False, plans=self.service.plans)
+        self.broker.add_service(sync_service)
+        data = self.create_request()
+        data['service_id'] = sync_service.guid
+        status, _ = await self.request('PUT', '/v2/service_instances/i2', data)
+        self.assertEqual(status, 201)
+        self.assertEqual(sync_service.instances, {"i2": PLAN1_GUID})
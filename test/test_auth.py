@@ -0,0 +1,53 @@
+from unittest import TestCase
+import os
+import tempfile
+from auth import Authenticator, FileAuthenticator, hash_password, verify_password
+
+
+class AuthenticatorTestCase(TestCase):
+    def test_hash_and_verify(self):
+        hashed = hash_password("secret", iterations=1000)
+        self.assertTrue(verify_password("secret", hashed))
+        self.assertFalse(verify_password("Secret", hashed))
+        self.assertNotEqual(hashed, hash_password("secret", iterations=1000))
+
+    def test_check(self):
+        authenticator = Authenticator({"cc1": hash_password("p1", iterations=1000),
+                                       "cc2": hash_password("p2", iterations=1000)})
+        self.assertFalse(authenticator.check_cached("cc1", "p1"))
+        self.assertTrue(authenticator.check("cc1", "p1"))
+        self.assertTrue(authenticator.check_cached("cc1", "p1"))
+        self.assertTrue(authenticator.check("cc2", "p2"))
+        self.assertFalse(authenticator.check("cc1", "p2"))
+        self.assertFalse(authenticator.check("nobody", "p1"))
+
+    def test_rotation_clears_cache(self):
+        authenticator = Authenticator({"cc1": hash_password("old", iterations=1000)})
+        self.assertTrue(authenticator.check("cc1", "old"))
+        authenticator.set_credentials({"cc1": hash_password("new", iterations=1000)})
+        self.assertFalse(authenticator.check("cc1", "old"))
+        self.assertTrue(authenticator.check("cc1", "new"))
+
+
+class FileAuthenticatorTestCase(TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def write(self, content, mtime):
+        with open(self.path, 'w') as f:
+            f.write(content)
+        os.utime(self.path, (mtime, mtime))
+
+    def test_reload(self):
+        self.write("# broker credentials\ncc1:%s\ncc2:plain\n" % hash_password("p1", iterations=1000), 1000)
+        authenticator = FileAuthenticator(self.path, reload_interval=0)
+        self.assertTrue(authenticator.check("cc1", "p1"))
+        self.assertTrue(authenticator.check("cc2", "plain"))
+        self.write("cc1:rotated\n", 2000)
+        self.assertFalse(authenticator.check("cc1", "p1"))
+        self.assertTrue(authenticator.check("cc1", "rotated"))
+        self.assertFalse(authenticator.check("cc2", "plain"))
@@ -0,0 +1,224 @@
+from unittest import TestCase
+from threading import Event, Thread
+from time import sleep, time
+from updates import diff_instance, merge_parameters
+import broker
+import executor
+import service
+from exceptions import *
+
+
+def make_service(guid, plan_guids):
+    plans = {p: service.Plan(guid=p, name="plan " + p, description="a plan") for p in plan_guids}
+    return service.BaseService(guid=guid, name="service " + guid, description="a service", bindable=True,
+                               plans=plans)
+
+
+class BrokerIndexTestCase(TestCase):
+    def setUp(self):
+        self.broker = broker.Broker(service_list=[make_service("s1", ["p1", "p2"]), make_service("s2", ["p3"])])
+
+    def tearDown(self):
+        self.broker.shutdown()
+
+    def test_resolve(self):
+        service, plan = self.broker.resolve("s2", "p3")
+        self.assertEqual((service.guid, plan.guid), ("s2", "p3"))
+        self.assertRaises(UnknownServiceError, self.broker.resolve, "nosuchservice", "p1")
+        self.assertRaises(UnknownPlanError, self.broker.resolve, "s1", "nosuchplan")
+        # A plan that exists, but belongs to another service
+        self.assertRaises(UnknownPlanError, self.broker.resolve, "s1", "p3")
+
+    def test_names(self):
+        self.assertEqual(self.broker.service_ids_by_name["service s1"], "s1")
+        self.assertEqual(self.broker.plan_ids_by_name[("s1", "plan p2")], "p2")
+
+    def test_add_and_remove_service(self):
+        self.broker.add_service(make_service("s1", ["p4"]))
+        self.assertRaises(UnknownPlanError, self.broker.resolve, "s1", "p1")
+        self.assertEqual(self.broker.resolve("s1", "p4")[1].guid, "p4")
+        self.broker.remove_service("s2")
+        self.assertRaises(UnknownServiceError, self.broker.resolve, "s2", "p3")
+        self.assertNotIn("p3", self.broker.plan_index)
+
+    def test_plans_are_slotted(self):
+        plan = self.broker.resolve("s1", "p1")[1]
+        self.assertFalse(hasattr(plan, '__dict__'))
+
+
+class SlowService(service.BaseService):
+    def create_instance(self, instance_id, plan_id, parameters, organization_guid, space_guid, cancel_token):
+        while not cancel_token.cancelled:
+            sleep(0.01)
+        raise OperationCancelledError
+
+    def delete_instance(self, instance_id):
+        # Ignores cancellation, so only terminating the worker can stop it
+        sleep(30)
+
+    def modify_instance(self, instance_id, plan_id, parameters, previous_values):
+        pass
+
+
+class BrokerTimeoutTestCase(TestCase):
+    def make_broker(self, use_processes):
+        plans = {"sync": service.Plan(guid="sync", name="sync", description="sync plan", sync_timeout=0.2),
+                 "async": service.Plan(guid="async", name="async", description="async plan",
+                                       provisionable_synchronously=False, async_timeout=0.2)}
+        slow = SlowService(guid="slow", name="slow", description="slow service", bindable=False, plans=plans,
+                           plan_updateable=True)
+        return broker.Broker(service_list=[slow], executor=executor.BrokerExecutor(max_workers=1,
+                                                                                   use_processes=use_processes))
+
+    def test_sync_timeout(self):
+        b = self.make_broker(use_processes=False)
+        self.assertRaises(OperationTimeoutError, b.create_instance, "i1", "org", "sync", "slow", "space")
+        b.shutdown()
+        self.assertEqual(b.executor.pending, 0)
+
+    def test_async_timeout(self):
+        b = self.make_broker(use_processes=False)
+        self.assertRaises(ProvisioningAsynchronously, b.create_instance, "i1", "org", "async", "slow", "space", None,
+                          True)
+        deadline = time() + 5
+        while b.get_provisioning_state("i1") == "in progress" and time() < deadline:
+            sleep(0.05)
+        op = b.get_operation("i1")
+        self.assertEqual(op.state, "failed")
+        self.assertIn("timed out", op.description)
+        b.shutdown()
+
+    def test_stuck_process_pool_is_replaced(self):
+        b = self.make_broker(use_processes=True)
+        started = time()
+        self.assertRaises(OperationTimeoutError, b.delete_instance, "i1", "slow", "sync")
+        # The only worker was stuck in delete_instance, so it must have been replaced for this to complete
+        b.modify_instance("i1", "slow", "sync", None, None)
+        self.assertLess(time() - started, 10)
+        b.shutdown()
+
+
+class ProgressService(service.BaseService):
+    def create_instance(self, instance_id, plan_id, parameters, organization_guid, space_guid, progress):
+        progress(50, "copying", "halfway there")
+        sleep(0.5)
+
+
+class BrokerProgressTestCase(TestCase):
+    def check_progress(self, use_processes):
+        plans = {"async": service.Plan(guid="async", name="async", description="async plan",
+                                       provisionable_synchronously=False)}
+        svc = ProgressService(guid="progress", name="progress", description="progress service", bindable=False,
+                              plans=plans)
+        b = broker.Broker(service_list=[svc], executor=executor.BrokerExecutor(max_workers=1,
+                                                                               use_processes=use_processes))
+        self.assertRaises(ProvisioningAsynchronously, b.create_instance, "i1", "org", "async", "progress", "space",
+                          None, True)
+        self.assertIn(b.get_operation("i1").phase, ("queued", "running", "copying"))
+        deadline = time() + 5
+        while b.get_operation("i1").percent is None and time() < deadline:
+            sleep(0.01)
+        op = b.get_operation("i1")
+        self.assertEqual((op.percent, op.phase), (50, "copying"))
+        self.assertEqual(op.as_dict(), {"state": "in progress", "description": "halfway there"})
+        b.shutdown()
+        self.assertEqual(b.get_provisioning_state("i1"), "succeeded")
+
+    def test_progress_from_threads(self):
+        self.check_progress(use_processes=False)
+
+    def test_progress_from_processes(self):
+        self.check_progress(use_processes=True)
+
+
+class UpdatingService(service.BaseService):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.updates = []
+        self.release = Event()
+        self.release.set()
+
+    def create_instance(self, instance_id, plan_id, parameters, organization_guid, space_guid):
+        pass
+
+    def modify_instance(self, instance_id, plan_id, parameters, previous_values, diff=None):
+        self.updates.append((plan_id, parameters, diff))
+        self.release.wait(5)
+
+
+class BrokerUpdateTestCase(TestCase):
+    def setUp(self):
+        plans = {p: service.Plan(guid=p, name=p, description="a plan") for p in ("p1", "p2")}
+        plans["async"] = service.Plan(guid="async", name="async", description="async plan",
+                                      provisionable_synchronously=False)
+        self.service = UpdatingService(guid="s1", name="updating", description="", bindable=False, plans=plans,
+                                       plan_updateable=True)
+        self.broker = broker.Broker(service_list=[self.service], executor=executor.BrokerExecutor(use_processes=False))
+        self.broker.create_instance("i1", "org", "p1", "s1", "space", {"size": 1, "tier": "a"})
+
+    def tearDown(self):
+        self.broker.shutdown()
+
+    def test_merge_and_diff(self):
+        self.assertEqual(merge_parameters({"a": 1, "b": 2}, {"b": None, "c": 3}), {"a": 1, "c": 3})
+        diff = diff_instance("p1", {"a": 1, "b": 2}, "p1", {"a": 1, "b": 3, "c": 4})
+        self.assertEqual((diff.added, diff.changed, diff.removed), ({"c": 4}, {"b": (2, 3)}, {}))
+        self.assertFalse(diff.plan_changed)
+        self.assertTrue(diff_instance("p1", {"a": 1}, "p1", {"a": 1}).empty)
+
+    def test_diff_is_passed_to_the_service(self):
+        self.assertEqual(self.broker.modify_instance("i1", "s1", "p2", {"size": 2, "tier": None}, None), {})
+        plan_id, parameters, diff = self.service.updates[-1]
+        self.assertEqual(parameters, {"size": 2, "tier": None})
+        self.assertEqual(diff.as_dict(), {"previous_plan_id": "p1", "plan_id": "p2", "added": {},
+                                          "changed": {"size": {"old": 1, "new": 2}}, "removed": {"tier": "a"}})
+        self.assertEqual(self.broker.inventory.get_instance("i1"), ("s1", "p2", {"size": 2}))
+
+    def test_async_create_then_update(self):
+        self.assertRaises(ProvisioningAsynchronously, self.broker.create_instance, "i2", "org", "async", "s1",
+                          "space", {"size": 1}, True)
+        deadline = time() + 5
+        while self.broker.get_provisioning_state("i2") == "in progress" and time() < deadline:
+            sleep(0.01)
+        self.assertEqual(self.broker.inventory.get_instance("i2"), ("s1", "async", {"size": 1}))
+        self.assertRaises(ProvisioningAsynchronously, self.broker.modify_instance, "i2", "s1", "async", {"size": 2},
+                          None, True)
+        while self.broker.get_provisioning_state("i2") == "in progress" and time() < deadline:
+            sleep(0.01)
+        self.assertEqual(self.service.updates[-1][2].changed, {"size": (1, 2)})
+        self.assertEqual(self.broker.inventory.get_instance("i2"), ("s1", "async", {"size": 2}))
+
+    def test_no_op_update(self):
+        self.assertRaises(IdenticalRequestCompleted, self.broker.modify_instance, "i1", "s1", "p1", {"size": 1},
+                          None)
+        self.assertEqual(self.service.updates, [])
+
+    def test_unknown_instance_gets_full_update(self):
+        self.broker.modify_instance("i2", "s1", "p1", {"size": 1}, None)
+        self.assertEqual(self.service.updates, [("p1", {"size": 1}, None)])
+
+    def test_successive_updates_merge(self):
+        self.service.release.clear()
+        results = []
+
+        def modify(parameters):
+            try:
+                results.append(self.broker.modify_instance("i1", "s1", "p1", parameters, None))
+            except IdenticalRequestCompleted:
+                results.append("unchanged")
+        first = Thread(target=modify, args=({"size": 2},))
+        first.start()
+        while not self.service.updates:
+            sleep(0.01)
+        others = [Thread(target=modify, args=(p,)) for p in ({"size": 3}, {"tier": "b"}, {"size": 4})]
+        for t in others:
+            t.start()
+        while self.broker.updates.waiting("i1") is None or self.broker.updates.waiting("i1").requests < 3:
+            sleep(0.01)
+        self.service.release.set()
+        for t in [first] + others:
+            t.join(5)
+        self.assertEqual(results, [{}] * 4)
+        self.assertEqual([u[1] for u in self.service.updates], [{"size": 2}, {"size": 4, "tier": "b"}])
+        self.assertEqual(self.service.updates[1][2].changed, {"size": (2, 4), "tier": ("a", "b")})
+        self.assertIsNone(self.broker.updates.waiting("i1"))
@@ -0,0 +1,89 @@
+from unittest import TestCase
+from cache import BindingCache, MemoryCacheStore
+import broker
+import service
+
+
+class CountingService(service.BaseService):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.bind_calls = 0
+
+    def bind(self, instance_id, binding_id, plan_id, app_guid, parameters):
+        self.bind_calls += 1
+        return {"user": "user%d" % self.bind_calls}
+
+    def unbind(self, instance_id, binding_id, plan_id):
+        pass
+
+
+class BindingCacheTestCase(TestCase):
+    def test_ttl(self):
+        cache = BindingCache(ttl=-1)
+        cache.put("i1", "b1", "p1", {"user": "u"})
+        self.assertIsNone(cache.get("i1", "b1", "p1"))
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+    def test_lru(self):
+        cache = BindingCache(store=MemoryCacheStore(max_entries=2))
+        cache.put("i1", "b1", "p1", 1)
+        cache.put("i1", "b2", "p1", 2)
+        cache.get("i1", "b1", "p1")
+        cache.put("i1", "b3", "p1", 3)
+        self.assertEqual(cache.get("i1", "b1", "p1"), 1)
+        self.assertIsNone(cache.get("i1", "b2", "p1"))
+
+    def test_invalidate_instance(self):
+        cache = BindingCache()
+        cache.put("i1", "b1", "p1", 1)
+        cache.put("i1", "b2", "p1", 2)
+        cache.put("i2", "b3", "p1", 3)
+        cache.invalidate("i1")
+        self.assertIsNone(cache.get("i1", "b1", "p1"))
+        self.assertIsNone(cache.get("i1", "b2", "p1"))
+        self.assertEqual(cache.get("i2", "b3", "p1"), 3)
+
+
+class BrokerBindingCacheTestCase(TestCase):
+    def setUp(self):
+        plan = service.Plan(guid="p1", name="plan", description="plan")
+        self.service = CountingService(guid="s1", name="counting", description="counts binds", bindable=True,
+                                       plans={"p1": plan}, cache_bindings=True)
+        self.broker = broker.Broker(service_list=[self.service])
+        # Expire coalesced requests straight away so only the binding cache can answer repeated binds
+        self.broker.requests.ttl = -1
+
+    def tearDown(self):
+        self.broker.shutdown()
+
+    def test_rebind_uses_cache(self):
+        first = self.broker.bind_instance("i1", "b1", "s1", "p1", "app1")
+        second = self.broker.bind_instance("i1", "b1", "s1", "p1", "app1")
+        self.assertEqual(first, second)
+        self.assertEqual(self.service.bind_calls, 1)
+        self.assertEqual(self.broker.binding_cache.hits, 1)
+
+    def test_unbind_invalidates(self):
+        self.broker.bind_instance("i1", "b1", "s1", "p1", "app1")
+        self.broker.unbind_instance("i1", "b1", "s1", "p1")
+        self.assertEqual(self.broker.bind_instance("i1", "b1", "s1", "p1", "app1"), {"user": "user2"})
+
+    def test_rebind_with_another_body(self):
+        self.broker.bind_instance("i1", "b1", "s1", "p1", "app1")
+        self.assertEqual(self.broker.bind_instance("i1", "b1", "s1", "p1", "app2"), {"user": "user2"})
+
+    def test_delete_forgets_instance(self):
+        self.broker.bind_instance("i1", "b1", "s1", "p1", "app1")
+        self.broker.bind_instance("i2", "b1", "s1", "p1", "app1")
+        self.broker.requests.forget_instance("i1")
+        self.broker.binding_cache.invalidate("i1")
+        self.assertEqual(self.broker.binding_cache.store.group("i1"), [])
+        self.assertEqual(len(self.broker.binding_cache.store.group("i2")), 1)
+        self.assertNotIn("i1", self.broker.requests._by_instance)
+        self.assertIn("i2", self.broker.requests._by_instance)
+
+    def test_not_opted_in(self):
+        self.service.cache_bindings = False
+        self.broker.bind_instance("i1", "b1", "s1", "p1", "app1")
+        self.broker.bind_instance("i1", "b1", "s1", "p1", "app1")
+        self.assertEqual(self.service.bind_calls, 2)
@@ -0,0 +1,28 @@
+from unittest import TestCase
+from exceptions import IdenticalRequestCompleted, InvalidRequestError, UnknownServiceError
+import codec
+
+
+class CodecTestCase(TestCase):
+    def tearDown(self):
+        codec.set_codec()
+
+    def test_stdlib_codec(self):
+        codec.set_codec('json')
+        self.assertEqual(codec.dumps({"a": [1, "b"]}), b'{"a":[1,"b"]}')
+        self.assertEqual(codec.loads(b'{"a":[1,"b"]}'), {"a": [1, "b"]})
+
+    def test_unavailable_codec(self):
+        if codec.orjson is None:
+            self.assertRaises(ValueError, codec.set_codec, 'orjson')
+        self.assertRaises(KeyError, codec.set_codec, 'nonesuch')
+
+    def test_encoded_msg(self):
+        e = UnknownServiceError()
+        self.assertEqual(codec.loads(codec.encoded_msg(e)), UnknownServiceError.msg)
+        # Class-level messages are encoded once and shared
+        self.assertIs(codec.encoded_msg(e), codec.encoded_msg(UnknownServiceError()))
+        self.assertEqual(codec.loads(codec.encoded_msg(IdenticalRequestCompleted({"x": 1}))), {"x": 1})
+        self.assertEqual(codec.encoded_msg(ValueError()), codec.EMPTY_OBJECT)
+        e = InvalidRequestError(["service_id is required"])
+        self.assertEqual(codec.loads(codec.encoded_msg(e))['description'], "invalid request: service_id is required")
@@ -0,0 +1,135 @@
+from unittest import TestCase
+from time import sleep, time
+import asyncio
+import json
+import os
+import tempfile
+import async_broker
+import broker
+import executor
+import service
+from journal import OperationJournal
+from exceptions import ProvisioningAsynchronously
+from opstore import IN_PROGRESS, SUCCEEDED, FAILED
+
+
+class RecordingService(service.BaseService):
+    def create_instance(self, instance_id, plan_id, parameters, organization_guid, space_guid):
+        if parameters.get("fail"):
+            raise ValueError("bad parameters")
+
+    def delete_instance(self, instance_id):
+        pass
+
+
+class JournalTestCase(TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".journal")
+        os.close(fd)
+
+    def tearDown(self):
+        for suffix in ("", ".compact"):
+            try:
+                os.unlink(self.path + suffix)
+            except FileNotFoundError:
+                pass
+
+    def test_replay(self):
+        journal = OperationJournal(self.path)
+        journal.start("i1", "create", "s1", "p1", ("i1", "p1", {}, "org", "space"))
+        journal.progress("i1", 50, "copying")
+        journal.start("i2", "delete", "s1", "p1", ("i2",))
+        journal.finish("i2", FAILED, "backend exploded", wait=True)
+        journal.close()
+        with open(self.path, 'ab') as f:
+            f.write(b'{"t":"finish","instance_id":"i1","sta')
+        ops = {op.instance_id: (op, entry) for op, entry in OperationJournal(self.path).operations()}
+        op, entry = ops["i1"]
+        self.assertEqual((op.state, op.kind, op.percent, op.phase), (IN_PROGRESS, "create", 50, "copying"))
+        self.assertEqual(entry["args"], ["i1", "p1", {}, "org", "space"])
+        self.assertEqual((ops["i2"][0].state, ops["i2"][0].description), (FAILED, "backend exploded"))
+
+    def test_compaction(self):
+        journal = OperationJournal(self.path, retention=0, compact_min=10)
+        for i in range(100):
+            journal.start("i%d" % i, "create", "s1", "p1")
+            journal.finish("i%d" % i, SUCCEEDED, wait=True)
+        journal.start("running", "create", "s1", "p1")
+        journal.close()
+        with open(self.path, 'rb') as f:
+            self.assertLess(len(f.readlines()), 25)
+        sleep(0.01)
+        self.assertEqual([op.instance_id for op, _ in OperationJournal(self.path, retention=0).operations()],
+                         ["running"])
+
+    def test_committed(self):
+        journal = OperationJournal(self.path)
+        journal.start("i1", "create", "s1", "p1", wait=False)
+        journal.committed().result(timeout=5)
+        with open(self.path, 'rb') as f:
+            self.assertEqual(json.loads(f.readline())["instance_id"], "i1")
+        journal.close()
+        self.assertTrue(journal.committed().done())
+
+    def test_async_broker_waits_for_the_start_record_off_the_loop(self):
+        waits = []
+
+        class RecordingJournal(OperationJournal):
+            def start(self, *args, wait=True):
+                waits.append(wait)
+                super().start(*args, wait=wait)
+        plans = {"async": service.Plan(guid="async", name="async", description="async plan",
+                                       provisionable_synchronously=False)}
+        svc = RecordingService(guid="s1", name="recording", description="recording service", bindable=False,
+                               plans=plans)
+        b = async_broker.AsyncBroker(service_list=[svc], executor=executor.BrokerExecutor(use_processes=False),
+                                     journal=RecordingJournal(self.path))
+        self.addCleanup(b.shutdown)
+        with self.assertRaises(ProvisioningAsynchronously):
+            asyncio.run(b.create_instance("i1", "org", "async", "s1", "space", {}, True))
+        # The 202 came after the start record was on disk, though the event loop never waited for the fsync
+        self.assertEqual(waits, [False])
+        with open(self.path, 'rb') as f:
+            self.assertEqual(json.loads(f.readline())["t"], "start")
+
+    def make_broker(self, idempotent):
+        plans = {"async": service.Plan(guid="async", name="async", description="async plan",
+                                       provisionable_synchronously=False)}
+        svc = RecordingService(guid="s1", name="recording", description="recording service", bindable=False,
+                               plans=plans, idempotent=idempotent)
+        return broker.Broker(service_list=[svc], executor=executor.BrokerExecutor(use_processes=False),
+                             journal=OperationJournal(self.path))
+
+    def interrupted_journal(self):
+        journal = OperationJournal(self.path)
+        journal.start("done", "delete", "s1", "async", ("done",))
+        journal.finish("done", SUCCEEDED)
+        journal.start("i1", "create", "s1", "async", ("i1", "async", {}, "org", "space"))
+        journal.start("i2", "create", "s1", "async", ("i2", "async", {"fail": True}, "org", "space"))
+        journal.close()
+
+    def wait_for(self, b, instance_id):
+        deadline = time() + 5
+        while b.get_provisioning_state(instance_id) == IN_PROGRESS and time() < deadline:
+            sleep(0.01)
+        return b.get_operation(instance_id)
+
+    def test_recover_resumes_idempotent_operations(self):
+        self.interrupted_journal()
+        b = self.make_broker(idempotent=True)
+        b.recover()
+        self.assertEqual(b.get_provisioning_state("done"), SUCCEEDED)
+        self.assertEqual(self.wait_for(b, "i1").state, SUCCEEDED)
+        self.assertEqual(self.wait_for(b, "i2").description, "bad parameters")
+        b.shutdown()
+        # Outcomes of the re-runs are journalled too
+        states = {op.instance_id: op.state for op, _ in OperationJournal(self.path).operations()}
+        self.assertEqual(states, {"done": SUCCEEDED, "i1": SUCCEEDED, "i2": FAILED})
+
+    def test_recover_fails_other_operations(self):
+        self.interrupted_journal()
+        b = self.make_broker(idempotent=False)
+        b.recover()
+        op = b.get_operation("i1")
+        self.assertEqual((op.state, op.description), (FAILED, "interrupted by a broker restart"))
+        b.shutdown()
@@ -0,0 +1,68 @@
+from unittest import TestCase
+import os
+import tempfile
+from time import time
+from opstore import MemoryOperationStore, SQLiteOperationStore, Operation, IN_PROGRESS, SUCCEEDED, FAILED
+
+
+class MemoryOperationStoreTestCase(TestCase):
+    def make_store(self, **kwargs):
+        return MemoryOperationStore(**kwargs)
+
+    def test_put_get_update(self):
+        store = self.make_store()
+        store.put(Operation("i1", "create"))
+        self.assertEqual(store.get("i1").state, IN_PROGRESS)
+        self.assertEqual(store.get("i1").kind, "create")
+        store.update("i1", FAILED, "backend exploded")
+        op = store.get("i1")
+        self.assertEqual(op.state, FAILED)
+        self.assertEqual(op.as_dict(), {"state": FAILED, "description": "backend exploded"})
+        self.assertIsNone(store.get("nosuchinstance"))
+
+    def test_progress(self):
+        store = self.make_store()
+        store.put(Operation("i1", "create", phase="queued"))
+        self.assertEqual(store.get("i1").as_dict(), {"state": IN_PROGRESS, "description": "queued"})
+        store.progress("i1", percent=40, phase="copying")
+        self.assertEqual(store.get("i1").as_dict(), {"state": IN_PROGRESS, "description": "copying (40%)"})
+        store.progress("i1", description="copied 4 of 10 tables")
+        op = store.get("i1")
+        self.assertEqual((op.percent, op.phase, op.description), (40, "copying", "copied 4 of 10 tables"))
+        store.update("i1", SUCCEEDED)
+        # Events that arrive after the operation finished are dropped
+        store.progress("i1", percent=90)
+        self.assertEqual(store.get("i1").as_dict(), {"state": SUCCEEDED})
+        store.progress("nosuchinstance", percent=10)
+
+    def test_expire_finished_only(self):
+        store = self.make_store(ttl=10)
+        store.put(Operation("done", "create"))
+        store.update("done", SUCCEEDED)
+        store.put(Operation("running", "create"))
+        store.expire(now=time() + 20)
+        self.assertIsNone(store.get("done"))
+        self.assertEqual(store.get("running").state, IN_PROGRESS)
+
+
+class SQLiteOperationStoreTestCase(MemoryOperationStoreTestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+
+    def tearDown(self):
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.unlink(self.path + suffix)
+            except FileNotFoundError:
+                pass
+
+    def make_store(self, **kwargs):
+        return SQLiteOperationStore(self.path, **kwargs)
+
+    def test_shared_between_stores(self):
+        self.make_store().put(Operation("i1", "delete"))
+        other = self.make_store()
+        self.assertEqual(other.get("i1").kind, "delete")
+        other.update("i1", SUCCEEDED)
+        self.assertEqual(self.make_store().get("i1").state, SUCCEEDED)
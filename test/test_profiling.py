@@ -0,0 +1,59 @@
+from unittest import TestCase
+import os
+import pstats
+import shutil
+import tempfile
+import broker
+import executor
+import service
+from profiling import Profiler, ProfiledCall
+
+
+class BusyService(service.BaseService):
+    def create_instance(self, instance_id, plan_id, parameters, organization_guid, space_guid):
+        return sum(range(1000))
+
+    def bind(self, instance_id, binding_id, plan_id, app_guid, parameters):
+        return {}
+
+    async def unbind(self, instance_id, binding_id, plan_id):
+        pass
+
+
+class ProfilingTestCase(TestCase):
+    def setUp(self):
+        self.service = BusyService("s1", "busy", "", True, {"p1": service.Plan("p1", "small", "small"),
+                                                          "p2": service.Plan("p2", "large", "large")})
+
+    def test_selection(self):
+        profiler = Profiler(["p1"])
+        func = self.service.create_instance
+        self.assertIsInstance(profiler.wrap(func, "s1", "p1", "create"), ProfiledCall)
+        self.assertIs(profiler.wrap(func, "s1", "p2", "create"), func)
+        unbind = self.service.unbind
+        self.assertIs(profiler.wrap(unbind, "s1", "p1", "unbind"), unbind)
+        self.assertIsInstance(Profiler(sample_percent=100).wrap(func, "s1", "p2", "create"), ProfiledCall)
+
+    def test_without_profiler(self):
+        b = broker.Broker([self.service], executor=executor.BrokerExecutor(use_processes=False))
+        self.addCleanup(b.shutdown)
+        func = self.service.create_instance
+        self.assertIs(b._profiled(func, "s1", "p1", "create"), func)
+
+    def test_collect_and_dump(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        profiler = Profiler(["s1"], dump_dir=directory)
+        b = broker.Broker([self.service], executor=executor.BrokerExecutor(use_processes=False), profiler=profiler)
+        self.addCleanup(b.shutdown)
+        b.create_instance("i1", "org", "p1", "s1", "space")
+        b.create_instance("i2", "org", "p1", "s1", "space")
+        b.bind_instance("i1", "b1", "s1", "p1")
+        self.assertEqual(sorted((p['operation'], p['calls']) for p in profiler.summary()), [('bind', 1), ('create', 2)])
+        self.assertIn('create_instance', profiler.report(("s1", "p1", "create")))
+        self.assertIsNone(profiler.report(("s1", "p2", "create")))
+        paths = profiler.dump()
+        self.assertEqual(sorted(os.path.basename(p) for p in paths), ["s1-p1-bind.prof", "s1-p1-create.prof"])
+        self.assertGreater(pstats.Stats(paths[0]).total_calls, 0)
+        profiler.reset()
+        self.assertEqual(profiler.summary(), [])
@@ -0,0 +1,156 @@
+from unittest import TestCase
+import json
+import os
+import tempfile
+from threading import Thread
+import broker
+import executor
+import reconcile
+import service
+from inventory import MemoryInventory, SQLiteInventory
+from opstore import Operation
+
+STATE = {
+    "services": [{"id": "s1", "name": "stand-in", "bindable": True,
+                  "plans": [{"id": "p1", "name": "small", "description": "small"},
+                            {"id": "p2", "name": "large", "description": "large"}],
+                  "instances": [["a", "p1"], ["b", "p1"], ["c", "p2"], ["x", "p1"]],
+                  "bindings": [["a", "b1", "p1"], ["x", "b9", "p1"]]}],
+    "inventory": {"instances": [["a", "s1", "p1"], ["c", "s1", "p1"], ["d", "s1", "p1"]],
+                  "bindings": [["a", "b1", "s1", "p1"], ["c", "b2", "s1", "p1"]]},
+}
+
+
+class InventoryTestCase(TestCase):
+    def check_paging(self, inventory):
+        for i in ("c", "a", "b", "d"):
+            inventory.add_instance(i, "s1", "p1")
+        inventory.add_instance("z", "s2", "p9")
+        inventory.add_binding("a", "b2", "s1", "p1")
+        inventory.add_binding("a", "b1", "s1", "p1")
+        inventory.add_binding("b", "b1", "s1", "p1")
+        self.assertEqual([tuple(r) for r in inventory.instances("s1", None, 2)], [("a", "p1"), ("b", "p1")])
+        self.assertEqual([tuple(r) for r in inventory.instances("s1", "b", 2)], [("c", "p1"), ("d", "p1")])
+        self.assertEqual([tuple(r) for r in inventory.bindings("s1", ("a", "b1"), 10)],
+                         [("a", "b2", "p1"), ("b", "b1", "p1")])
+        inventory.add_instance("a", "s1", "p2", {"size": 2})
+        self.assertEqual(tuple(inventory.instances("s1", None, 1)[0]), ("a", "p2"))
+        inventory.add_instance("a", "s1", "p2")
+        self.assertEqual(tuple(inventory.get_instance("a")), ("s1", "p2", {"size": 2}))
+        self.assertIsNone(inventory.get_instance("b")[2])
+        inventory.remove_instance("a")
+        self.assertFalse(inventory.has_instance("a"))
+        self.assertFalse(inventory.has_binding("a", "b1"))
+        self.assertEqual([tuple(r) for r in inventory.bindings("s1", None, 10)], [("b", "b1", "p1")])
+        inventory.remove_binding("b", "b1")
+        self.assertEqual(inventory.bindings("s1", None, 10), [])
+
+    def test_memory_inventory(self):
+        self.check_paging(MemoryInventory())
+
+    def test_sqlite_inventory(self):
+        fd, path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        self.addCleanup(os.unlink, path)
+        self.check_paging(SQLiteInventory(path))
+
+    def test_broker_tracks_inventory(self):
+        s = reconcile.StandInService("s1", "stand-in", "", True, {"p1": service.Plan("p1", "small", "small")},
+                                     plan_updateable=True)
+        b = broker.Broker([s], executor=executor.BrokerExecutor(use_processes=False))
+        self.addCleanup(b.shutdown)
+        b.create_instance("i1", "org", "p1", "s1", "space")
+        b.bind_instance("i1", "b1", "s1", "p1")
+        self.assertTrue(b.inventory.has_instance("i1"))
+        self.assertTrue(b.inventory.has_binding("i1", "b1"))
+        b.unbind_instance("i1", "b1", "s1", "p1")
+        self.assertFalse(b.inventory.has_binding("i1", "b1"))
+        b.delete_instance("i1", "s1", "p1")
+        self.assertFalse(b.inventory.has_instance("i1"))
+
+
+class ReconcileTestCase(TestCase):
+    def setUp(self):
+        self.broker = reconcile.stand_in_broker(STATE)
+        self.service = self.broker.services["s1"]
+
+    def tearDown(self):
+        self.broker.shutdown()
+
+    def test_diff_sorted(self):
+        ours, theirs = [(1,), (3,), (4,)], [(2,), (3,), (5,)]
+        self.assertEqual(list(reconcile.diff_sorted(iter(ours), iter(theirs), lambda item: item[0])),
+                         [((1,), None), (None, (2,)), ((3,), (3,)), ((4,), None), (None, (5,))])
+
+    def test_unsorted_listing(self):
+        fetch = lambda after, limit: [("b",), ("a",)]
+        self.assertRaises(ValueError, list, reconcile.pages(fetch, 10, lambda item: item[0]))
+
+    def test_dry_run(self):
+        report = reconcile.Reconciler(self.broker, page_size=2).run(dry_run=True)
+        self.assertEqual([e["instance_id"] for e in report.orphaned_instances], ["b", "x"])
+        self.assertEqual([e["instance_id"] for e in report.missing_instances], ["d"])
+        self.assertEqual(report.mismatched_instances,
+                         [{"service_id": "s1", "instance_id": "c", "plan_id": "p2", "broker_plan_id": "p1"}])
+        self.assertEqual([(e["instance_id"], e["binding_id"]) for e in report.orphaned_bindings], [("x", "b9")])
+        self.assertEqual([(e["instance_id"], e["binding_id"]) for e in report.missing_bindings], [("c", "b2")])
+        self.assertEqual(report.repaired, [])
+        self.assertIn("x", self.service.instances)
+
+    def test_repair(self):
+        # b was being created when the listings were read
+        self.broker.operations.put(Operation("b", "create"))
+        report = reconcile.Reconciler(self.broker, page_size=2, max_concurrency=1).run()
+        self.assertEqual(sorted(e.get("binding_id", e["instance_id"]) for e in report.repaired), ["b9", "x"])
+        self.assertEqual([e["instance_id"] for e in report.skipped], ["b"])
+        self.assertEqual(sorted(self.service.instances), ["a", "b", "c"])
+        self.assertEqual(list(self.service.bindings), [("a", "b1")])
+
+    def test_repair_limit(self):
+        report = reconcile.Reconciler(self.broker, max_repairs=1).run()
+        self.assertEqual(len(report.repaired), 1)
+        self.assertEqual(len(report.held), 2)
+
+    def test_repair_refused_by_service_limit(self):
+        self.broker.executor.service_limits = {"s1": 0}
+        reports = []
+        t = Thread(target=lambda: reports.append(reconcile.Reconciler(self.broker, max_concurrency=1).run()),
+                   daemon=True)
+        t.start()
+        t.join(5)
+        self.assertFalse(t.is_alive())
+        self.assertEqual(reports[0].repaired, [])
+        self.assertEqual(len(reports[0].failed), 3)
+        self.assertIn("x", self.service.instances)
+
+    def test_memory_inventory_refuses_repair(self):
+        self.broker.inventory = MemoryInventory()
+        report = reconcile.Reconciler(self.broker).run()
+        self.assertTrue(report.dry_run)
+        self.assertIn("BROKER_INVENTORY_DB", report.refused)
+        self.assertEqual(report.repaired, [])
+        self.assertEqual(len(self.service.instances), 4)
+
+    def test_seed(self):
+        fd, path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        self.addCleanup(os.unlink, path)
+        self.broker.inventory = SQLiteInventory(path)
+        reconciler = reconcile.Reconciler(self.broker)
+        self.assertIn("seeded", reconciler.repair_refusal())
+        self.assertEqual(reconciler.seed(), 6)
+        self.assertIsNone(reconciler.repair_refusal())
+        report = reconciler.run()
+        self.assertEqual((report.orphaned_instances, report.orphaned_bindings, report.repaired), ([], [], []))
+
+    def test_unsupported_service(self):
+        self.broker.add_service(service.BaseService("s2", "plain", "", False, {}))
+        report = reconcile.Reconciler(self.broker).run(dry_run=True, service_ids=["s2"])
+        self.assertEqual(report.unsupported, [{"service_id": "s2", "kind": "instances"}])
+
+    def test_cli(self):
+        fd, path = tempfile.mkstemp(suffix=".json")
+        with os.fdopen(fd, 'w') as f:
+            json.dump(STATE, f)
+        self.addCleanup(os.unlink, path)
+        self.assertEqual(reconcile.main(["--stand-in", path, "--dry-run"]), 0)
@@ -0,0 +1,125 @@
+from unittest import TestCase
+import json
+import os
+import shutil
+import sys
+import tempfile
+import broker
+import executor
+import registry
+import serve
+from exceptions import ProvisioningAsynchronously
+
+PLUGIN = '''
+import threading
+import service
+
+
+class PluginService(service.BaseService):
+    calls = []
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Can't be pickled: a built service must never be sent to a process pool worker
+        self.lock = threading.Lock()
+
+    def create_instance(self, instance_id, plan_id, parameters, organization_guid, space_guid, cancel_token=None,
+                        progress=None):
+        self.calls.append(('create', cancel_token is not None, progress is not None))
+
+    def modify_instance(self, instance_id, plan_id, parameters, previous_values, cancel_token=None, diff=None):
+        self.calls.append(('modify', cancel_token is not None, diff is not None))
+
+    def bind(self, instance_id, binding_id, plan_id, app_guid, parameters):
+        return {"instance": instance_id, "plan": self.plans[plan_id].name}
+
+    def unbind(self, instance_id, binding_id, plan_id):
+        pass
+'''
+
+
+class RegistryTestCase(TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.module_name = 'lazy_plugin_%d' % id(self)
+        with open(os.path.join(self.dirname, self.module_name + '.py'), 'w') as f:
+            f.write(PLUGIN)
+        sys.path.insert(0, self.dirname)
+        self.config = os.path.join(self.dirname, 'services.json')
+        with open(self.config, 'w') as f:
+            json.dump({"services": [{"class": self.module_name + ":PluginService", "id": "s1", "name": "plugin",
+                                     "description": "a lazily loaded service", "bindable": True,
+                                     "plan_updateable": True,
+                                     "plans": [{"id": "p1", "name": "small", "description": "small plan"},
+                                               {"id": "p2", "name": "large", "description": "large plan",
+                                                "free": False},
+                                               {"id": "p3", "name": "slow", "description": "async plan",
+                                                "provisionable_synchronously": False}]}]}, f)
+
+    def tearDown(self):
+        sys.path.remove(self.dirname)
+        sys.modules.pop(self.module_name, None)
+        shutil.rmtree(self.dirname)
+
+    def test_lazy_loading(self):
+        services = registry.services_from_config(self.config)
+        b = broker.Broker(service_list=services)
+        catalog = b.service_catalog()
+        self.assertEqual([p['id'] for p in catalog['services'][0]['plans']], ['p1', 'p2', 'p3'])
+        self.assertTrue(services[0].plan_updateable)
+        self.assertFalse(services[0].plans['p2'].free)
+        self.assertNotIn(self.module_name, sys.modules)
+        self.assertFalse(services[0].loaded)
+        self.assertEqual(b.bind_instance("i1", "b1", "s1", "p2"), {"instance": "i1", "plan": "large"})
+        self.assertIn(self.module_name, sys.modules)
+        self.assertTrue(services[0].loaded)
+        b.shutdown()
+
+    def test_keywords_reach_the_loaded_service(self):
+        self.addCleanup(registry._loaded.pop, (self.module_name + ":PluginService", "s1"), None)
+        b = broker.Broker(service_list=registry.services_from_config(self.config),
+                          executor=executor.BrokerExecutor(use_processes=False))
+        self.addCleanup(b.shutdown)
+        b.create_instance("i1", "org", "p1", "s1", "space")
+        b.modify_instance("i1", "s1", "p2", {"size": 2}, None)
+        self.assertRaises(ProvisioningAsynchronously, b.create_instance, "i2", "org", "p3", "s1", "space", None, True)
+        b.shutdown()
+        calls = sys.modules[self.module_name].PluginService.calls
+        self.assertEqual(calls, [('create', True, False), ('modify', True, True), ('create', True, True)])
+
+    def test_process_executor_never_pickles_the_service(self):
+        self.addCleanup(registry._loaded.pop, (self.module_name + ":PluginService", "s1"), None)
+        services = registry.services_from_config(self.config)
+        b = broker.Broker(service_list=services, executor=executor.BrokerExecutor(use_processes=True))
+        self.addCleanup(b.shutdown)
+        # Checking which keywords create_instance takes doesn't build the service in this process
+        b.create_instance("i1", "org", "p1", "s1", "space")
+        self.assertFalse(services[0].loaded)
+        # Nor is a service built here sent along with the job
+        b.bind_instance("i1", "b1", "s1", "p1")
+        self.assertTrue(services[0].loaded)
+        b.create_instance("i2", "org", "p1", "s1", "space")
+        b.shutdown()
+
+    def test_preload(self):
+        self.addCleanup(registry._loaded.pop, (self.module_name + ":PluginService", "s1"), None)
+        os.environ['BROKER_SERVICES_CONFIG'] = self.config
+        try:
+            self.assertEqual(serve.preload_services(), 1)
+        finally:
+            del os.environ['BROKER_SERVICES_CONFIG']
+        # A broker built afterwards, as in a forked worker, finds the service already built
+        self.assertTrue(registry.services_from_config(self.config)[0].loaded)
+
+    def test_serve_refuses_per_process_journal(self):
+        os.environ['BROKER_JOURNAL'] = os.path.join(self.dirname, 'journal')
+        try:
+            self.assertEqual(len(serve.single_process_settings(2)), 1)
+            self.assertEqual(serve.single_process_settings(1), [])
+            self.assertRaises(SystemExit, serve.main, ['--workers', '2', '--no-preload'])
+        finally:
+            del os.environ['BROKER_JOURNAL']
+
+    def test_serve_refuses_bad_service_limits(self):
+        for limits in ('[1]', '{"s1": "many"}', 'not json'):
+            self.assertRaises(SystemExit, serve.main, ['--service-limits', limits, '--no-preload'])
@@ -0,0 +1,122 @@
+from unittest import TestCase
+from time import sleep, time
+import os
+import tempfile
+import broker
+import executor
+import service
+from opstore import SQLiteOperationStore, IN_PROGRESS, SUCCEEDED, FAILED
+from workqueue import SQLiteWorkQueue
+
+
+class QueueService(service.BaseService):
+    def create_instance(self, instance_id, plan_id, parameters, organization_guid, space_guid):
+        return "https://dashboard/" + instance_id
+
+    def delete_instance(self, instance_id):
+        pass
+
+
+class SQLiteTestCase(TestCase):
+    def setUp(self):
+        self.paths = []
+
+    def tearDown(self):
+        for path in self.paths:
+            for suffix in ("", "-wal", "-shm"):
+                try:
+                    os.unlink(path + suffix)
+                except FileNotFoundError:
+                    pass
+
+    def temporary_path(self):
+        fd, path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        self.paths.append(path)
+        return path
+
+
+class SQLiteWorkQueueTestCase(SQLiteTestCase):
+    def test_claim_in_priority_order(self):
+        queue = SQLiteWorkQueue(self.temporary_path())
+        queue.enqueue("i1", "create", "s1", "p1", ["i1", "p1", {}, "org", "space"])
+        queue.enqueue("i2", "create", "s1", "p1", ["i2", "p1", {}, "org", "space"])
+        queue.enqueue("i3", "delete", "s1", "p1", ["i3"], priority=executor.URGENT)
+        jobs = queue.claim("a", 2, lease=30)
+        self.assertEqual([j.instance_id for j in jobs], ["i3", "i1"])
+        self.assertEqual(jobs[1].args, ["i1", "p1", {}, "org", "space"])
+        self.assertEqual([j.instance_id for j in queue.claim("b", 5, lease=30)], ["i2"])
+        self.assertEqual(queue.claim("b", 5, lease=30), [])
+        self.assertEqual(queue.renew("a", [j.id for j in jobs], lease=30), {j.id for j in jobs})
+        # Only the owner can complete a job
+        self.assertFalse(queue.complete(jobs[0].id, "b"))
+        self.assertTrue(queue.complete(jobs[0].id, "a"))
+        self.assertEqual(queue.count_by_state(), {"leased": 2})
+
+    def test_expired_leases(self):
+        queue = SQLiteWorkQueue(self.temporary_path())
+        queue.enqueue("i1", "create", "s1", "p1", [])
+        job = queue.claim("dead", 1, lease=0.01)[0]
+        sleep(0.02)
+        expired = queue.expired()
+        self.assertEqual([(j.id, j.owner, j.attempts) for j in expired], [(job.id, "dead", 1)])
+        self.assertTrue(queue.requeue(job.id, "dead"))
+        self.assertFalse(queue.requeue(job.id, "dead"))
+        self.assertEqual(queue.claim("alive", 1, lease=30)[0].attempts, 2)
+        self.assertEqual(queue.renew("dead", [job.id], lease=30), set())
+
+
+class MultiNodeTestCase(SQLiteTestCase):
+    def make_broker(self, operations_path, queue_path, concurrency, idempotent=False):
+        plans = {"async": service.Plan(guid="async", name="async", description="async plan",
+                                       provisionable_synchronously=False)}
+        svc = QueueService(guid="s1", name="queue", description="queue service", bindable=False, plans=plans,
+                           idempotent=idempotent)
+        b = broker.Broker(service_list=[svc], executor=executor.BrokerExecutor(use_processes=False),
+                          operations=SQLiteOperationStore(operations_path), work_queue=SQLiteWorkQueue(queue_path))
+        b.node.concurrency = concurrency
+        b.node.poll_interval = 0.02
+        return b
+
+    def wait_for(self, b, instance_id):
+        deadline = time() + 5
+        while b.get_provisioning_state(instance_id) == IN_PROGRESS and time() < deadline:
+            sleep(0.02)
+        return b.get_provisioning_state(instance_id)
+
+    def test_work_runs_on_another_node(self):
+        operations_path, queue_path = self.temporary_path(), self.temporary_path()
+        front = self.make_broker(operations_path, queue_path, concurrency=0)
+        worker = self.make_broker(operations_path, queue_path, concurrency=4)
+        self.assertRaises(broker.ProvisioningAsynchronously, front.create_instance, "i1", "org", "async", "s1",
+                          "space", None, True)
+        self.assertEqual(self.wait_for(front, "i1"), SUCCEEDED)
+        # The node that accepted the request hears about the outcome, so a retry is answered from its tracker
+        deadline = time() + 5
+        while front.node.waiting and time() < deadline:
+            sleep(0.02)
+        self.assertRaises(broker.IdenticalRequestCompleted, front.create_instance, "i1", "org", "async", "s1",
+                          "space", None, True)
+        self.assertEqual(worker.node.queue.count_by_state(), {})
+        front.shutdown()
+        worker.shutdown()
+
+    def check_dead_node(self, idempotent):
+        operations_path, queue_path = self.temporary_path(), self.temporary_path()
+        b = self.make_broker(operations_path, queue_path, concurrency=0, idempotent=idempotent)
+        queue = SQLiteWorkQueue(queue_path)
+        self.assertRaises(broker.ProvisioningAsynchronously, b.delete_instance, "i1", "s1", "async", True)
+        queue.claim("dead", 1, lease=0.01)
+        b.node.concurrency = 4
+        state = self.wait_for(b, "i1")
+        b.shutdown()
+        return state, b.get_operation("i1")
+
+    def test_dead_node_work_is_requeued(self):
+        state, _ = self.check_dead_node(idempotent=True)
+        self.assertEqual(state, SUCCEEDED)
+
+    def test_dead_node_work_is_failed(self):
+        state, op = self.check_dead_node(idempotent=False)
+        self.assertEqual(state, FAILED)
+        self.assertIn("stopped responding", op.description)